@@ -1 +1 @@
-from console import update_irc_search
+from console import update_irc_search, compress_irc_logs
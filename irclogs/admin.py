@@ -0,0 +1,245 @@
+"""
+trac-admin commands for the chatlog tables of db channels.  The day view
+and feed queries select by network, target and time, and without an index
+on those every one of them scans the whole table.  Searching messages needs
+the database's full text search set up, see ChatlogSearch.
+"""
+
+# Copyright (c) 2009, Robert Corsaro
+
+from datetime import datetime, timedelta
+from time import strptime
+from pytz import UTC
+
+from trac.core import *
+from trac.admin.api import IAdminCommandProvider, AdminCommandError
+from trac.db.api import _parse_db_str
+from trac.util.text import printout
+
+from irclogs.api import IRCChannelManager
+from irclogs.provider.db import DBIRCLogProvider, IRCLogDatabaseManager
+from irclogs.provider.pool import safe_uri
+
+INDEX_NAME = 'chatlog_network_target_time_idx'
+INDEX_COLUMNS = ['network', 'target', 'time']
+
+# full text search of chatlog messages: an FTS5 table on SQLite, kept up to
+# date by triggers, and an expression GIN index on PostgreSQL
+FTS_TABLE = 'chatlog_fts'
+FTS_INDEX = 'chatlog_msg_fts_idx'
+
+SQLITE_FTS = [
+    """CREATE VIRTUAL TABLE chatlog_fts USING fts5(msg, content='chatlog',
+       content_rowid='id')""",
+    """CREATE TRIGGER chatlog_fts_insert AFTER INSERT ON chatlog BEGIN
+       INSERT INTO chatlog_fts (rowid, msg) VALUES (new.id, new.msg); END""",
+    """CREATE TRIGGER chatlog_fts_delete AFTER DELETE ON chatlog BEGIN
+       INSERT INTO chatlog_fts (chatlog_fts, rowid, msg) 
+       VALUES ('delete', old.id, old.msg); END""",
+    """CREATE TRIGGER chatlog_fts_update AFTER UPDATE ON chatlog BEGIN
+       INSERT INTO chatlog_fts (chatlog_fts, rowid, msg) 
+       VALUES ('delete', old.id, old.msg);
+       INSERT INTO chatlog_fts (rowid, msg) VALUES (new.id, new.msg); END""",
+    "INSERT INTO chatlog_fts (chatlog_fts) VALUES ('rebuild')",
+]
+
+def postgres_tsvector(config, column='msg'):
+    """The tsvector expression of the full text index.  Queries must use
+    the same expression for the index to be used."""
+    return "to_tsvector('%s'::regconfig, %s)"%(config, column)
+
+def has_fulltext(cnx, scheme):
+    """True if the chatlog table of cnx has full text search set up."""
+    if scheme == 'sqlite':
+        cur = cnx.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE name = %s", 
+                    (FTS_TABLE,))
+        return bool(cur.fetchall())
+    return FTS_INDEX in chatlog_indexes(cnx, scheme)
+
+def chatlog_indexes(cnx, scheme):
+    """The indexes of the chatlog table, as a dict of index name to list of
+    columns, None for expressions.  Only SQLite and PostgreSQL are 
+    supported."""
+    cur = cnx.cursor()
+    indexes = {}
+    if scheme == 'sqlite':
+        cur.execute("PRAGMA index_list(chatlog)")
+        for row in cur.fetchall():
+            name = row[1]
+            cur.execute("PRAGMA index_info(%s)"%(cnx.quote(name)))
+            indexes[name] = [r[2] for r in cur.fetchall()]
+    elif scheme == 'postgres':
+        # one row per indexed column, expressions have no attribute
+        cur.execute("""
+          SELECT i.relname, a.attname
+          FROM (SELECT indexrelid, indrelid, indkey, 
+                       generate_series(0, indnatts - 1) AS n
+                FROM pg_index) x
+            JOIN pg_class t ON t.oid = x.indrelid
+            JOIN pg_class i ON i.oid = x.indexrelid
+            JOIN pg_namespace s ON s.oid = t.relnamespace
+            LEFT JOIN pg_attribute a 
+              ON a.attrelid = x.indrelid AND a.attnum = x.indkey[x.n]
+          WHERE t.relname = 'chatlog' AND s.nspname = current_schema()
+          ORDER BY i.relname, x.n""")
+        for name, column in cur.fetchall():
+            indexes.setdefault(name, []).append(column)
+    else:
+        raise AdminCommandError("chatlog indexes can't be managed on %s "\
+                "databases"%(scheme))
+    return indexes
+
+def range_index(indexes):
+    """The name of the index day view queries can use, or None."""
+    for name in sorted(indexes):
+        if indexes[name][:len(INDEX_COLUMNS)] == INDEX_COLUMNS:
+            return name
+    return None
+
+def query_plan(cnx, scheme, sql, args):
+    """The lines of the database's plan for a query."""
+    cur = cnx.cursor()
+    if scheme == 'sqlite':
+        cur.execute("EXPLAIN QUERY PLAN " + sql, args)
+        # the detail is the last column, whatever the SQLite version
+        return [row[-1] for row in cur.fetchall()]
+    elif scheme == 'postgres':
+        cur.execute("EXPLAIN " + sql, args)
+        return [row[0] for row in cur.fetchall()]
+    raise AdminCommandError("query plans can't be shown for %s "\
+            "databases"%(scheme))
+
+class IRCLogsAdmin(Component):
+    """Inspect and index the chatlog tables of db channels."""
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('irclogs index', '[channel]',
+               """Create the chatlog index used by day views
+
+               Checks the chatlog table of every database used by db
+               channels, or only the one of channel, and creates an index
+               on (network, target, time) if no index starts with those
+               columns.""",
+               self._complete_channel, self._do_index)
+        yield ('irclogs explain', '[channel] [date]',
+               """Show query plans of the chatlog queries
+
+               Shows how the database runs the day view of date, today by
+               default, and the feed query for every db channel, or only
+               for channel.  date is YYYY-MM-DD.""",
+               self._complete_channel, self._do_explain)
+        yield ('irclogs fulltext', '[channel]',
+               """Set up full text search of chatlog messages
+
+               Creates an FTS5 table on SQLite, filled from chatlog and
+               kept up to date by triggers, and a GIN index on PostgreSQL,
+               for the chatlog tables of every db channel, or only the one
+               of channel.""",
+               self._complete_channel, self._do_fulltext)
+
+    def _complete_channel(self, args):
+        if len(args) == 1:
+            return [ch.name() for ch in self._channels()
+                    if ch.name() is not None]
+
+    def _do_index(self, name=None):
+        dbmgr = IRCLogDatabaseManager(self.env)
+        for uri, channels in self._databases(name):
+            scheme = _parse_db_str(uri)[0]
+            cnx = dbmgr.connect(uri)
+            try:
+                index = range_index(chatlog_indexes(cnx, scheme))
+                if index:
+                    printout("%s: chatlog already indexed by %s"%(
+                        safe_uri(uri), index))
+                else:
+                    printout("%s: creating index %s on chatlog (%s)..."%(
+                        safe_uri(uri), INDEX_NAME, ', '.join(INDEX_COLUMNS)))
+                    cur = cnx.cursor()
+                    cur.execute("CREATE INDEX %s ON chatlog (%s)"%(
+                        INDEX_NAME, ', '.join([cnx.quote(c)
+                                               for c in INDEX_COLUMNS])))
+                    # so the planner knows the index is worth using
+                    cur.execute("ANALYZE chatlog")
+                    cnx.commit()
+            finally:
+                cnx.close()
+
+    def _do_explain(self, name=None, day=None):
+        if day is None:
+            day = datetime.now(UTC)
+        else:
+            try:
+                day = UTC.localize(datetime(*strptime(day, '%Y-%m-%d')[:3]))
+            except ValueError:
+                raise AdminCommandError("Invalid date %s, use YYYY-MM-DD"%(
+                    day))
+        start = day.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + timedelta(days=1)
+        provider = DBIRCLogProvider(self.env)
+        dbmgr = IRCLogDatabaseManager(self.env)
+        for uri, channels in self._databases(name):
+            scheme = _parse_db_str(uri)[0]
+            cnx = dbmgr.connect(uri)
+            try:
+                for ch in channels:
+                    tz, ttz = provider._timezones(ch, start)
+                    queries = [
+                        ('day view', provider._range_query(ch, start, end,
+                                                           tz)),
+                        ('feed', provider._last_query(ch, end, tz, 10)),
+                    ]
+                    for label, (sql, args) in queries:
+                        printout("%s %s on %s:"%(ch.channel(), label,
+                                                 safe_uri(uri)))
+                        for line in query_plan(cnx, scheme, sql, args):
+                            printout("  %s"%(line))
+            finally:
+                cnx.close()
+
+    def _do_fulltext(self, name=None):
+        from irclogs.search import ChatlogSearch
+        config = ChatlogSearch(self.env).search_config
+        dbmgr = IRCLogDatabaseManager(self.env)
+        for uri, channels in self._databases(name):
+            scheme = _parse_db_str(uri)[0]
+            cnx = dbmgr.connect(uri)
+            try:
+                if has_fulltext(cnx, scheme):
+                    printout("%s: full text search already set up"%(
+                        safe_uri(uri)))
+                    continue
+                printout("%s: setting up full text search..."%(
+                    safe_uri(uri)))
+                cur = cnx.cursor()
+                if scheme == 'sqlite':
+                    for sql in SQLITE_FTS:
+                        cur.execute(sql)
+                else:
+                    cur.execute("CREATE INDEX %s ON chatlog USING GIN (%s)"%(
+                        FTS_INDEX, postgres_tsvector(config)))
+                cnx.commit()
+            finally:
+                cnx.close()
+
+    def _channels(self):
+        return [ch for ch in IRCChannelManager(self.env).channels()
+                if ch.provider() == 'db']
+
+    def _databases(self, name=None):
+        """(uri, channels) for each database used by db channels, or by
+        the channel called name."""
+        provider = DBIRCLogProvider(self.env)
+        channels = self._channels()
+        if name is not None:
+            channels = [ch for ch in channels if ch.name() == name]
+            if not channels:
+                raise AdminCommandError("No db channel named %s"%(name))
+        databases = {}
+        for ch in channels:
+            databases.setdefault(provider._database(ch), []).append(ch)
+        return sorted(databases.items())
@@ -1,18 +1,239 @@
 import heapq
-import itertools
+import inspect
 import re
-from pytz import UnknownTimeZoneError, timezone
+import threading
+import weakref
+from Queue import Queue, Full
+from calendar import timegm
+from datetime import datetime, timedelta
+from itertools import ifilter
+from pytz import UTC, UnknownTimeZoneError, timezone
 
 from trac.core import *
 from trac.config import Option
 
+# known event types, the index is the type code.  Types from custom
+# match_order settings are added as they're seen.
+EVENT_TYPES = ['other', 'comment', 'action', 'join', 'part', 'quit', 'kick',
+               'mode', 'topic', 'nick', 'notice', 'server']
+_type_codes = dict([(t, i) for i, t in enumerate(EVENT_TYPES)])
+_type_codes_lock = threading.Lock()
+
+def type_code(name):
+    """The integer code of an event type name, registering it if needed."""
+    code = _type_codes.get(name)
+    if code is None:
+        _type_codes_lock.acquire()
+        try:
+            code = _type_codes.get(name)
+            if code is None:
+                EVENT_TYPES.append(name)
+                code = _type_codes[name] = len(EVENT_TYPES) - 1
+        finally:
+            _type_codes_lock.release()
+    return code
+
+class IRCEvent(object):
+    """An event yielded by IIRCLogsProvider.get_events_in_range().
+
+    Days of logs are tens of thousands of events, so instead of a dict per
+    event the common fields live in slots, and the type is kept as a small
+    integer code.  Rarer fields, like 'kicked' or the keys added while 
+    rendering, go in a dict that's only created when needed.
+
+    IRCEvents behave like dicts: event['nick'], event.get('comment'), 
+    'mode' in event, update(), dict(event) and friends all work, and 
+    'type' is the type name.  Fields that were never set are missing, like
+    absent keys.  Providers may still yield plain dicts."""
+
+    __slots__ = ('code', 'timestamp', 'message', 'nick', 'comment', 'action',
+                 'network', 'channel', '_extra')
+
+    def __init__(self, items=(), **kw):
+        self.code = 0
+        self._extra = None
+        self.update(items, **kw)
+
+    def _get_type(self):
+        return EVENT_TYPES[self.code]
+    def _set_type(self, name):
+        self.code = type_code(name)
+    type = property(_get_type, _set_type)
+
+    def __getitem__(self, key):
+        if key in SLOT_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if key == 'type':
+            return EVENT_TYPES[self.code]
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in SLOT_FIELDS:
+            setattr(self, key, value)
+        elif key == 'type':
+            self.code = type_code(value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in SLOT_FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif key == 'type':
+            raise KeyError("events always have a type")
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def update(self, items=(), **kw):
+        if hasattr(items, 'keys'):
+            items = [(k, items[k]) for k in items.keys()]
+        for k, v in items:
+            self[k] = v
+        for k, v in kw.items():
+            self[k] = v
+
+    def keys(self):
+        keys = ['type']
+        for k in SLOT_FIELDS:
+            if hasattr(self, k):
+                keys.append(k)
+        if self._extra:
+            keys.extend(self._extra.keys())
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+    iterkeys = __iter__
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def copy(self):
+        event = IRCEvent()
+        event.code = self.code
+        for k in SLOT_FIELDS:
+            if hasattr(self, k):
+                setattr(event, k, getattr(self, k))
+        if self._extra:
+            event._extra = dict(self._extra)
+        return event
+
+    def __eq__(self, other):
+        if not hasattr(other, 'keys'):
+            return False
+        return dict(self.items()) == dict([(k, other[k]) 
+                                          for k in other.keys()])
+
+    def __ne__(self, other):
+        return not self == other
+
+    # the type is pickled by name, codes of custom types differ between 
+    # processes
+    def __getstate__(self):
+        return self.items()
+
+    def __setstate__(self, state):
+        self.code = 0
+        self._extra = None
+        self.update(state)
+
+    def __repr__(self):
+        return 'IRCEvent(%r)'%(dict(self.items()))
+
+SLOT_FIELDS = frozenset(IRCEvent.__slots__[1:-1])
+
+class EventFilter(object):
+    """Which events a reader wants, so providers can drop the rest as early
+    as they can.  types are the event types to keep, or None for all of
+    them, and nicks the nicks whose events to drop."""
+
+    def __init__(self, types=None, nicks=()):
+        if types is not None:
+            types = frozenset(types)
+        self.types = types
+        self.nicks = frozenset(nicks)
+
+    def accepts(self, type, nick=None):
+        if self.types is not None and type not in self.types:
+            return False
+        return not self.nicks or nick not in self.nicks
+
+    def __call__(self, event):
+        return self.accepts(event['type'], event.get('nick'))
+
+    def __repr__(self):
+        return 'EventFilter(%r, %r)'%(self.types, self.nicks)
+
 class IIRCLogsProvider(Interface):
     """An interface for different sources of irc logs.  DB and file 
     implementations are provided."""
 
-    def get_events_in_range(self, channel_name, start, end):
+    def get_events_in_range(self, channel_name, start, end, limit=None, 
+                            after=None, filter=None):
         """Yeilds events, in order, within the range, enclusive.  Channel is 
         the channel name in config, and not the actual channel name.
+        Events are IRCEvents, or dicts with the same keys.
+
+        limit and after, when given, select a page of the range: at most
+        limit events, resuming after the page whose event_cursor() is 
+        after.  Providers should seek to the cursor rather than read and
+        discard what's before it, page_events() does the rest.  Providers
+        without them are paged by IRCChannel.events_in_range().
+
+        filter, an EventFilter, says which events to leave out.  Providers
+        should drop them before doing any work they don't need to; those
+        without it are filtered by IRCChannel.events_in_range().
 
           {
               'time': timestamp,
@@ -32,6 +253,12 @@ class IIRCLogsProvider(Interface):
             * newnick: nick
         """
 
+    def get_last_events(self, channel, end, count):
+        """Optional.  The last count events before end, in order, like the
+        tail of get_events_in_range() from the start of the log.  Providers
+        that can find them without reading the whole range should have it;
+        IRCChannel.last_events() falls back to two days of events."""
+
     def name(self):
         """Returns the name of the provider as used in the configuration.
         ex.
@@ -48,82 +275,293 @@ class IIRCLogIndexer(Interface):
         """
 
 def merge_iseq(iterables, key):
-    # key values so we can decide what to sort by
-    def keyed(v):
-        return key(v), v
-    iterables = map(lambda x: itertools.imap(keyed, x), iterables)
-    """
-    This is commented out because it only works on 2.6.  Trying for 2.4
-      compatibility like trac.
-    ""Thanks kniht!  Wrapper for heapq.merge that allows specifying a key.
-    http://bitbucket.org/kniht/scraps/src/tip/python/merge_iseq.py
-    ""
-    for item in heapq.merge(*iterables):
-        yield item[1]
-    """
-    # start 2.4 hackathon taken from
-    # http://code.activestate.com/recipes/491285/
-    heappop, siftup, _StopIteration = heapq.heappop, heapq._siftup, StopIteration
-
+    """Merge iterables, each sorted by key, into one sorted iterator.
+
+    Items whose key is None, like untimestamped log lines, have no place of
+    their own: they stay right after the item before them in their 
+    iterable, and the ones at the start of an iterable come first.  A 
+    single iterable is returned as is.  Ties go to the earlier iterable."""
+    iterables = list(iterables)
+    if len(iterables) == 1:
+        return iter(iterables[0])
+    return _merge(iterables, key)
+
+def _merge(iterables, key):
+    # heapq.merge() only takes a key since python 3.5, and 2.4 doesn't have
+    # it at all.  Entries are [key, index, item, iterator]; the index keeps
+    # items from ever being compared.
+    heappop, heapreplace = heapq.heappop, heapq.heapreplace
     h = []
-    h_append = h.append
-    for it in map(iter, iterables):
-        try:
-            next = it.next
-            h_append([next(), next])
-        except _StopIteration:
-            pass
+    for index, it in enumerate(iterables):
+        it = iter(it)
+        for item in it:
+            k = key(item)
+            if k is None:
+                yield item
+                continue
+            h.append((k, index, item, it))
+            break
     heapq.heapify(h)
-
-    while(1):
+    while len(h) > 1:
+        k, index, item, it = h[0]
+        yield item
+        try:
+            item = it.next()
+            k = key(item)
+            while k is None:
+                yield item
+                item = it.next()
+                k = key(item)
+        except StopIteration:
+            heappop(h)
+            continue
+        heapreplace(h, (k, index, item, it))
+    if h:
+        # the last one left needs no merging
+        k, index, item, it = h[0]
+        yield item
+        for item in it:
+            yield item
+
+class _Reader(object):
+    """Lives as long as the generator of read_ahead() does."""
+
+def read_ahead(iterable, timeout=1, batch=1):
+    """Yield the items of iterable, produced by a thread that starts right
+    away and stays a batch of items ahead of the reader.  Exceptions are
+    raised in the reader.  The thread stops if the reader goes away before
+    reading everything."""
+    queue = Queue(1)
+    reader = _Reader()
+    def _produce(alive):
+        def _put(more, items):
+            # gives up once the reader is gone
+            while alive() is not None:
+                try:
+                    queue.put((more, items), True, timeout)
+                    return True
+                except Full:
+                    pass
+            return False
         try:
-            while 1:
-                v, next = s = h[0] # raises IndexError when h is empty
-                yield v[1]         # this is a little different since we keyed
-                                   #   the values
-                s[0] = next()      # raises StopIteration when exhausted
-                siftup(h, 0)       # restore heap condition
-        except _StopIteration:
-            heappop(h)              # remove empty iter
-        except IndexError:
+            items = []
+            for item in iterable:
+                items.append(item)
+                if len(items) >= batch:
+                    if not _put(True, items):
+                        return
+                    items = []
+            if items and not _put(True, items):
+                return
+            _put(False, None)
+        except Exception, e:
+            _put(False, e)
+    thread = threading.Thread(target=_produce, args=(weakref.ref(reader),))
+    thread.setDaemon(True)
+    thread.start()
+    return _read_ahead(queue, reader)
+
+def _read_ahead(queue, reader):
+    # reader is only here to live as long as this generator
+    while True:
+        more, items = queue.get()
+        if not more:
+            if items is not None:
+                raise items
+            break
+        for item in items:
+            yield item
+
+def resume_start(start, after):
+    """Where to start reading a page of events from start, given the cursor
+    of the page before it, in the timezone of start."""
+    if after and after[0] and after[0] > start:
+        return after[0].astimezone(start.tzinfo)
+    return start
+
+def page_events(events, after=None, limit=None):
+    """Yield a page of events, at most limit of them.  after is the cursor
+    of the page before, a (timestamp, ordinal) pair from event_cursor(), 
+    and events should start at its timestamp, see resume_start().  The
+    untimestamped events before the first timestamped one belong to the
+    page before, and ordinal events from there on were on it already."""
+    if limit == 0:
+        return
+    skip = 0
+    started = True
+    if after:
+        skip = after[1]
+        started = after[0] is None
+    n = 0
+    for event in events:
+        if not started:
+            if not event.get('timestamp'):
+                continue
+            started = True
+        if skip:
+            skip -= 1
+            continue
+        yield event
+        n += 1
+        if n == limit:
             return
 
+def event_cursor(events, after=None):
+    """The cursor to resume after events, a page read with the cursor
+    after.  It's the timestamp of the last timestamped event, and the
+    number of events from the first with that timestamp on, so pages can
+    end anywhere in a burst of lines logged in the same second."""
+    timestamp, n = after or (None, 0)
+    for event in events:
+        t = event.get('timestamp')
+        if t and t != timestamp:
+            timestamp, n = t, 0
+        n += 1
+    return timestamp, n
+
+def format_cursor(cursor):
+    """A cursor as a string for urls, parsed by parse_cursor()."""
+    timestamp, n = cursor
+    if timestamp is None:
+        return '_%d'%(n)
+    us = timegm(timestamp.utctimetuple()) * 1000000 + timestamp.microsecond
+    return '%d_%d'%(us, n)
+
+def parse_cursor(text):
+    """The cursor of a format_cursor() string, with a UTC timestamp.
+    Raises ValueError if it isn't one."""
+    us, n = text.split('_')
+    n = int(n)
+    if n < 0:
+        raise ValueError("negative ordinal in cursor %s"%(text))
+    timestamp = None
+    if us:
+        timestamp = datetime(1970, 1, 1, tzinfo=UTC) + \
+                timedelta(microseconds=int(us))
+    return timestamp, n
+
+def takes_argument(func, name):
+    """Whether func can be called with the keyword argument name.  
+    Callables that can't be inspected are taken to."""
+    try:
+        args, varargs, varkw, defaults = inspect.getargspec(func)
+    except TypeError:
+        return True
+    return varkw is not None or name in args
+
 def prefix_options(prefix, options):
     """Helper method to get options out of the config object.  Gets all
     options that start with prefix, and also removes prefix portion."""
     if not prefix.endswith('.'):
         prefix = "%s."%(prefix)
-
-    # pair[0] is the  name and pair[1] is the value
-    _filter = lambda pair: pair[0].startswith(prefix)
-    _map = lambda pair: (re.sub('^%s'%(prefix), '', pair[0]), pair[1])
-    return dict(map(_map, filter(_filter, options)))
+    size = len(prefix)
+    return dict([(name[size:], value) for name, value in options 
+                 if name.startswith(prefix)])
+
+class FrozenDict(dict):
+    """A dict that can't be changed, for settings shared between 
+    requests."""
+
+    def _readonly(self, *args, **kw):
+        raise TypeError("channel settings are read-only, copy them first")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+            update = _readonly
+
+    def copy(self):
+        return dict(self)
+
+    def __reduce__(self):
+        # formats are pickled for the parser processes
+        return FrozenDict, (dict(self),)
+
+class ChannelSettings(object):
+    """The [irclogs] options of a channel, worked out once: settings, the
+    defaults overridden by its channel.<name>.* options, and format, all
+    the options with those of its format.<format>.* and its own merged in.
+    name is None if no channel.<name>.* options exist, the default channel
+    is used then.
+
+    Snapshots are immutable.  IRCChannelManager keeps one per channel for
+    as long as the configuration doesn't change, and every request reads
+    the same one."""
+
+    __slots__ = ('name', 'settings', 'format')
+
+    def __init__(self, options, name=None):
+        options = list(options)
+        custom = prefix_options('channel.%s.'%(name), options)
+        if not custom:
+            name = None
+        settings = dict([(k, v) for k, v in options if k and '.' not in k])
+        format = dict(options)
+        if name:
+            settings.update(custom)
+        format.update(prefix_options('format.%s'%(settings.get('format')),
+                                     options))
+        if name:
+            format.update(custom)
+        self.name = name
+        self.settings = FrozenDict(settings)
+        self.format = FrozenDict(format)
 
 class IRCChannel(object):
-    def __init__(self, chmgr, name=None):
+    def __init__(self, chmgr, name=None, snapshot=None):
         self._chmgr = chmgr
-        self._name = name
-        c = self._chmgr.config
-        if not prefix_options('channel.%s.'%(name), c.options('irclogs')):
-            self._name = None
+        if snapshot is None:
+            if isinstance(chmgr, IRCChannelManager):
+                snapshot = chmgr.snapshot(name)
+            else:
+                snapshot = ChannelSettings(chmgr.config.options('irclogs'),
+                                           name)
+        self._name = snapshot.name
+        self._settings = snapshot.settings
+        self._format = snapshot.format
 
     def settings(self):
-        c = self._chmgr.config
-        default_op = lambda x: re.match('^[^.]+$', x[0])
-        retoptions = dict(filter(default_op, c.options('irclogs')))
-        if self.name():
-            options= prefix_options(
-                    'channel.%s.'%(self.name()), c.options('irclogs'))
-            retoptions.update(options)
-        return retoptions
+        """The settings of the channel.  Shared, don't change them."""
+        return self._settings
 
     def setting(self, name, default=None):
-        return self.settings().get(name, default)
-
-    def events_in_range(self, start, end):
+        return self._settings.get(name, default)
+
+    def events_in_range(self, start, end, parallel=False, limit=None, 
+                        after=None, filter=None):
+        """Events of the channel from start to end.  Bulk readers of long
+        ranges should set parallel, which providers that can parse in 
+        parallel, through get_events_in_range_parallel(), take as a hint.
+        limit, after and filter page through and filter the range, see 
+        get_events_in_range() of IIRCLogsProvider."""
         prov_name = self.provider()
         provider = self._chmgr.provider(prov_name)
-        return provider.get_events_in_range(self, start, end)
+        get_events = provider.get_events_in_range
+        paged = limit is not None or after is not None
+        if not paged and parallel and \
+                hasattr(provider, 'get_events_in_range_parallel'):
+            get_events = provider.get_events_in_range_parallel
+        kw = {}
+        if filter is not None and takes_argument(get_events, 'filter'):
+            kw['filter'] = filter
+            filter = None
+        if paged and filter is None and takes_argument(get_events, 'after'):
+            return get_events(self, start, end, limit=limit, after=after, **kw)
+        # providers from before filters and paging read the whole range
+        events = get_events(self, resume_start(start, after), end, **kw)
+        if filter is not None:
+            events = ifilter(filter, events)
+        if paged:
+            events = page_events(events, after, limit)
+        return events
+
+    def last_events(self, end, count):
+        """The last count events of the channel before end."""
+        provider = self._chmgr.provider(self.provider())
+        if hasattr(provider, 'get_last_events'):
+            return provider.get_last_events(self, end, count)
+        # quiet channels may come up short
+        events = list(provider.get_events_in_range(self, 
+                end - timedelta(days=2), end))
+        return events[max(0, len(events) - count):]
 
     def name(self):
         return self._name
@@ -148,21 +586,48 @@ class IRCChannel(object):
         return self.setting('network')
 
     def format(self):
-        retval = {}
-        config = self._chmgr.config
-        default_options = [i for i in config.options('irclogs')] 
-        retval.update(default_options)
-        dformat_options = prefix_options('format.%s'%self.setting('format'),
-                default_options)
-        retval.update(dformat_options)
-        custom_options= prefix_options(
-                'channel.%s.'%(self.name()), config.options('irclogs'))
-        retval.update(custom_options)
-        return retval
+        """The format options of the channel.  Shared, don't change them."""
+        return self._format
 
     def perm(self):
         return self.setting('perm', 'IRCLOGS_VIEW')
 
+class ChannelRegistry(object):
+    """The channels of one version of the configuration, and the log
+    providers by name.  Every page view asks for the channels, for the
+    navigation items and permissions, so IRCChannelManager builds them once
+    and hands out the same IRCChannel objects until the configuration 
+    changes.  Channels that aren't configured all get the default one."""
+
+    CHANNEL_RE = re.compile('^channel\.(?P<name>[^.]+)\.')
+
+    def __init__(self, chmgr, options):
+        options = list(options)
+        names = {}
+        for option, value in options:
+            m = self.CHANNEL_RE.match(option)
+            if m:
+                names[m.group('name')] = True
+        # set order, like channel_names() always had
+        self.names = list(set(names))
+        self._snapshots = {None: ChannelSettings(options)}
+        for name in self.names:
+            self._snapshots[name] = ChannelSettings(options, name)
+        if self._snapshots[None].settings.get('channel'):
+            self.names.append(None)
+        self._channels = {}
+        for name, snapshot in self._snapshots.items():
+            self._channels[name] = IRCChannel(chmgr, name, snapshot)
+        self.providers = {}
+        for provider in chmgr.providers:
+            self.providers.setdefault(provider.name(), provider)
+
+    def snapshot(self, name):
+        return self._snapshots.get(name) or self._snapshots[None]
+
+    def channel(self, name):
+        return self._channels.get(name) or self._channels[None]
+
 class IRCChannelManager(Component):
     """
     Get channels.
@@ -187,47 +652,93 @@ class IRCChannelManager(Component):
     charset = Option('irclogs', 'charset', 'utf-8',
         doc="""Default charset that logs are retrieved in.""")
 
+    def __init__(self):
+        self._registry = None
+        self._registry_version = None
+        self._registry_lock = threading.Lock()
+
+    def _config_version(self):
+        """Changes whenever channel settings may have: trac.ini or a file
+        it inherits from was reread, components declared more options, or
+        [irclogs] was changed in memory with config.set()."""
+        config = self.config
+        mtimes = [getattr(c, '_lastmtime', None)
+                  for c in [config] + getattr(config, 'parents', [])]
+        section = config.parser._sections.get('irclogs')
+        return mtimes, len(Option.registry), section
+
+    def registry(self):
+        """The ChannelRegistry of the current configuration, built again
+        only once it has changed."""
+        version = self._config_version()
+        self._registry_lock.acquire()
+        try:
+            if version != self._registry_version:
+                mtimes, declared, section = version
+                self._registry = ChannelRegistry(self,
+                        self.config.options('irclogs'))
+                self._registry_version = (mtimes, declared, 
+                                          section and dict(section))
+            return self._registry
+        finally:
+            self._registry_lock.release()
+
+    def snapshot(self, name):
+        """The ChannelSettings of the channel called name."""
+        return self.registry().snapshot(name)
+
     def channels(self):
         """
         Yield all channels
         """
-        for chname in self.channel_names():
-            yield self.channel(chname)
+        registry = self.registry()
+        for chname in registry.names:
+            yield registry.channel(chname)
 
     def channel_names(self):
         """
         Yield all channel names.  None means that there is a default 
         channel.
         """
-        CHANNEL_RE = re.compile('^channel\.(?P<name>[^.]+)\..*$')
-        def _name(x):
-            m = CHANNEL_RE.match(x)
-            if m:
-                return m.groupdict()['name']
-            else:
-                None
-        ops = self.config.options('irclogs')
-        # set makes uniq
-        for c in filter(None, set(map(_name, map(lambda x: x[0], ops)))):
-            yield c
-        if self.config.get('irclogs', 'channel'):
-            yield None
+        return iter(self.registry().names)
 
     def provider(self, name):
         """
         Return the log provider for the channel object.
         """
-        for p in self.providers:
-            if name == p.name():
-                return p
-        raise Exception(
-                "IRCLogsProvider named %s not found."%(name))
+        provider = self.registry().providers.get(name)
+        if provider is None:
+            raise Exception(
+                    "IRCLogsProvider named %s not found."%(name))
+        return provider
 
     def channel(self, name):
         """
         Get channel by name.
         """
-        return IRCChannel(self, name)
+        return self.registry().channel(name)
+
+    def merged_events(self, channels, start, end, filter=None, batch=200):
+        """Yield the events of several channels from start to end, merged
+        in time order, each with the name of its channel as 'source'.
+        channels are IRCChannels or channel names.
+
+        Every channel is read by a thread of its own, batch events ahead of
+        the merge, so reading them all takes about as long as reading the
+        slowest one does."""
+        channels = [isinstance(ch, IRCChannel) and ch or self.channel(ch)
+                    for ch in channels]
+        sources = [self._tagged(ch, start, end, filter) for ch in channels]
+        if len(sources) > 1:
+            sources = [read_ahead(events, batch=batch) for events in sources]
+        return merge_iseq(sources, lambda x: x.get('timestamp'))
+
+    def _tagged(self, channel, start, end, filter):
+        # all the provider's work happens in the reading thread
+        name = channel.name()
+        for event in channel.events_in_range(start, end, filter=filter):
+            event['source'] = name
+            yield event
 
     def to_user_tz(self, req, datetime):
         deftz = self.config.get('trac', 'default_timezone', 'UTC')
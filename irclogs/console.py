@@ -17,3 +17,66 @@ def update_irc_search():
         for indexer in chmgr.indexers:
             indexer.update_index()
 
+
+def compress_irc_logs():
+    """Compress the file logs of every channel older than a number of days,
+    7 by default, into seekable chunked gzip files."""
+    args = sys.argv
+    if len(args) < 2:
+        print 'Usage: %s <environment path> [days]'%(args[0])
+    else:
+        from datetime import date, timedelta
+        from trac.env import Environment
+        from irclogs import api
+        env = Environment(args[1])
+        days = 7
+        if len(args) > 2:
+            days = int(args[2])
+        before = date.today() - timedelta(days=days)
+        chmgr = api.IRCChannelManager(env)
+        provider = chmgr.provider('file')
+        for channel in chmgr.channels():
+            if channel.provider() != 'file':
+                continue
+            for path in provider.compress_logs(channel, before):
+                print path
+
+
+def import_irc_logs():
+    """Import the file logs of channels, all file channels by default, 
+    into the chatlog table of their database, the one they would use with
+    the db provider.  Imports that were interrupted carry on where they 
+    stopped, and days that are in already are skipped."""
+    args = sys.argv
+    if len(args) < 2:
+        print 'Usage: %s <environment path> [channel ...]'%(args[0])
+    else:
+        from datetime import datetime
+        from pytz import UTC
+        from trac.env import Environment
+        from irclogs import api
+        from irclogs.provider.db import DBIRCLogProvider, \
+                IRCLogDatabaseManager
+        from irclogs.provider.importer import ChatlogImporter
+        env = Environment(args[1])
+        chmgr = api.IRCChannelManager(env)
+        provider = chmgr.provider('file')
+        db = DBIRCLogProvider(env)
+        dbmgr = IRCLogDatabaseManager(env)
+        names = args[2:]
+        for channel in chmgr.channels():
+            if names and channel.name() not in names:
+                continue
+            if channel.provider() != 'file':
+                continue
+            uri = db._database(channel)
+            tz = db._timezones(channel, datetime.now(UTC))[0]
+            importer = ChatlogImporter(provider, channel, 
+                    lambda: dbmgr.connect(uri), tz, log=env.log)
+            def _progress(day, count):
+                print '%s %s: %d lines'%(channel.channel(), day, count)
+            # today's log is still being written
+            importer.run(datetime.now(tz).date(), _progress)
+            print '%s: %d lines of %d days in %.1fs, %d lines/s'%(
+                channel.channel(), importer.events, importer.days,
+                importer.seconds, importer.rate())
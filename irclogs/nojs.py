@@ -22,7 +22,9 @@ from trac.util.datefmt import utc
 from genshi.builder import tag
 from irclogs.api import *
 
-def generate_nojs_calendar(req, context, entries):
+def generate_nojs_calendar(req, context, entries=None):
+    """entries are the days of the month that have logs, or None if that
+    isn't known."""
     weeks = []
     for week in calendar.monthcalendar(context['year'], context['month']):
         w = []
@@ -36,7 +38,7 @@ def generate_nojs_calendar(req, context, entries):
                                          '%02d' % day),
                     # today is the selected day, not today..yuk
                     'today':    day == context['day'],
-                    'has_log':  True
+                    'has_log':  entries is None or day in entries
                 })
             else:
                 w.append({
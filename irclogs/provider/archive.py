@@ -0,0 +1,146 @@
+"""
+Compressed log files.  Old days are often compressed to save disk, so every
+configured log path is also looked for with a .gz, .bz2 or .xz suffix, and
+read through the matching decompressor.  xz needs the lzma module, which
+python 2 only has as the backports.lzma package.
+
+compress_log() writes gzip files made of many small members, one for every
+interval of log time.  To zcat they're ordinary gzip files, but a ChunkIndex
+of the member offsets lets range reads decompress only the members they
+need.  Plain gzip files just have a single member.
+"""
+
+# Copyright (c) 2009, Robert Corsaro
+
+import bz2
+import gzip
+import zlib
+
+from irclogs.provider.offsets import OffsetIndex, epoch
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+SUFFIXES = ('.gz', '.bz2', '.xz')
+
+# bytes of compressed data read at a time when scanning gzip members
+READ_SIZE = 64 * 1024
+
+def compression(path):
+    """The compression suffix of path, or None for plain files."""
+    for suffix in SUFFIXES:
+        if path.endswith(suffix):
+            return suffix
+    return None
+
+def open_log(path, offset=0):
+    """Open the log file at path for reading, decompressing on the fly.
+    offset is where to start reading: a byte offset into plain files, or
+    the offset of a member, as found in a ChunkIndex, into gzip files.  It's
+    ignored for other compressed files."""
+    suffix = compression(path)
+    if suffix == '.gz':
+        f = gzip.GzipFile(path, 'rb')
+        # the next member header is read from wherever the file is
+        f.fileobj.seek(offset)
+        return f
+    if suffix == '.bz2':
+        return bz2.BZ2File(path, 'r')
+    if suffix == '.xz':
+        if lzma is None:
+            raise IOError("can't read %s, lzma isn't installed"%(path))
+        return lzma.LZMAFile(path, 'r')
+    f = open(path, 'rb')
+    f.seek(offset)
+    return f
+
+def compress_log(src, dest, timestamp, interval):
+    """Write the plain log file src to dest as gzip, starting a new member
+    at the first line of every interval seconds of log.  timestamp is a
+    function returning the aware datetime of a raw line, or None.  Returns
+    the number of members written."""
+    fin = open(src, 'rb')
+    try:
+        fout = open(dest, 'wb')
+        try:
+            members = 0
+            member = None
+            last_bucket = None
+            for line in fin:
+                dt = timestamp(line)
+                if dt is not None:
+                    bucket = int(epoch(dt) // interval)
+                    if bucket != last_bucket and member is not None:
+                        member.close()
+                        member = None
+                    last_bucket = bucket
+                if member is None:
+                    member = gzip.GzipFile('', 'wb', 9, fout)
+                    members += 1
+                member.write(line)
+            if member is not None:
+                member.close()
+        finally:
+            fout.close()
+    finally:
+        fin.close()
+    return members
+
+class ChunkIndex(OffsetIndex):
+    """OffsetIndex of a gzip file, with one entry for each member that
+    starts on a line boundary.  Offsets are compressed offsets, for
+    open_log().  Compressed files are never appended to, so any change
+    rebuilds the index."""
+
+    def __init__(self, path, key, interval=0):
+        OffsetIndex.__init__(self, path, key, 0)
+
+    def update(self, st, timestamp):
+        if self.is_current(st):
+            return False
+        self.__init__(self.path, self.key)
+        f = open(self.path, 'rb')
+        try:
+            decomp = None
+            pending = ''
+            # compressed offset of data
+            base = 0
+            data = f.read(READ_SIZE)
+            while data:
+                if decomp is None:
+                    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    if not pending:
+                        self.entries.append((self.last_seen, base))
+                try:
+                    text = decomp.decompress(data)
+                except zlib.error:
+                    # trailing garbage, like gzip itself, ignore it
+                    break
+                lines = (pending + text).split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    self._seen(timestamp(line + '\n'))
+                if decomp.unused_data:
+                    # end of this member, the rest of data is the next one
+                    base += len(data) - len(decomp.unused_data)
+                    data = decomp.unused_data
+                    decomp = None
+                else:
+                    base += len(data)
+                    data = f.read(READ_SIZE)
+            if pending:
+                self._seen(timestamp(pending))
+        finally:
+            f.close()
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        return True
+
+    def _seen(self, dt):
+        if dt is not None:
+            self.last_seen = max(self.last_seen, epoch(dt))
@@ -0,0 +1,225 @@
+"""
+Caches of parsed log files.  Finished log files never change, so their
+events are parsed once and stored on disk in a compact binary form, and
+later views of the same day skip regexes and timestamp parsing entirely.
+Files still being written keep their parsed events in memory, along with
+how far they were read.
+"""
+
+# Copyright (c) 2009, Robert Corsaro
+
+import marshal
+import os
+import os.path
+import threading
+import zlib
+from calendar import timegm
+from datetime import datetime
+
+from trac.util import AtomicFile, md5
+
+from irclogs.api import IRCEvent
+
+VERSION = 1
+
+def to_pairs(events):
+    """(epoch, event) pairs for events with UTC timestamps.  The timestamp
+    is taken out of the event and kept as epoch seconds, or None."""
+    pairs = []
+    for event in events:
+        event = IRCEvent(event)
+        epoch = None
+        if event.get('timestamp'):
+            epoch = timegm(event['timestamp'].utctimetuple())
+        event.pop('timestamp', None)
+        pairs.append((epoch, event))
+    return pairs
+
+def events_in_range(pairs, start, end, target_tz, filter=None):
+    """Yield copies of the events in (epoch, event) pairs from start to end,
+    with timestamps in target_tz.  Untimestamped events are kept with the
+    timestamped event before them.  Events filter, an EventFilter, doesn't
+    accept are skipped."""
+    start = timegm(start.utctimetuple()) + start.microsecond / 1e6
+    end = timegm(end.utctimetuple()) + end.microsecond / 1e6
+    inrange = True
+    for epoch, event in pairs:
+        if epoch is not None:
+            if epoch >= end:
+                break
+            inrange = epoch >= start
+            if inrange and (filter is None or filter(event)):
+                event = event.copy()
+                event.timestamp = datetime.fromtimestamp(epoch, target_tz)
+                yield event
+        elif inrange and (filter is None or filter(event)):
+            yield event.copy()
+
+class DayCache(object):
+    """Parsed events of log files, one cache file per log file.
+
+    Entries are validated against the path, size and mtime of the log file
+    and the key of the format used to parse it.  Timestamps are stored as
+    UTC epoch seconds and converted to the reader's timezone on the way out.
+
+    The total size of the cache directory is capped at max_size bytes.
+    Hits touch the cache file, and the least recently touched files are
+    evicted first."""
+
+    def __init__(self, path, max_size, log=None):
+        self.path = path
+        self.max_size = max_size
+        self.log = log
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def filename(self, path):
+        name = md5(os.path.abspath(path)).hexdigest()
+        return os.path.join(self.path, '%s.day'%(name))
+
+    def get(self, path, st, key):
+        """Cached events of the log file at path, as a list of
+        (epoch, event) pairs, or None.  st is the os.stat() of the log
+        file."""
+        filename = self.filename(path)
+        events = None
+        try:
+            f = open(filename, 'rb')
+            try:
+                data = marshal.loads(zlib.decompress(f.read()))
+            finally:
+                f.close()
+            version, cpath, size, mtime, ckey, keysets, rows = data
+            if (version, cpath, size, mtime, ckey) == \
+                    (VERSION, path, st.st_size, st.st_mtime, key):
+                events = [(epoch, IRCEvent(zip(keysets[keyset], values)))
+                          for epoch, keyset, values in rows]
+                os.utime(filename, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError,
+                zlib.error):
+            pass
+        self._lock.acquire()
+        try:
+            if events is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self._lock.release()
+        return events
+
+    def put(self, path, st, key, events):
+        """Store events, dicts as yielded by parse_lines() with UTC
+        timestamps, for the log file at path.  Returns them as (epoch, event)
+        pairs, like get()."""
+        keysets = []
+        keyset_index = {}
+        rows = []
+        pairs = to_pairs(events)
+        for epoch, event in pairs:
+            keys = tuple(sorted(event.keys()))
+            if keys not in keyset_index:
+                keyset_index[keys] = len(keysets)
+                keysets.append(keys)
+            rows.append((epoch, keyset_index[keys],
+                         tuple([event[k] for k in keys])))
+        data = zlib.compress(marshal.dumps((VERSION, path, st.st_size,
+            st.st_mtime, key, keysets, rows)), 1)
+        filename = self.filename(path)
+        self._lock.acquire()
+        try:
+            try:
+                size = self._total_size()
+                if os.path.exists(filename):
+                    size -= os.path.getsize(filename)
+                f = AtomicFile(filename, 'wb')
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+                self._size = size + len(data)
+                if self._size > self.max_size:
+                    self._evict(filename)
+            except (IOError, OSError), e:
+                if self.log:
+                    self.log.warn("unable to cache %s: %s"%(path, e))
+        finally:
+            self._lock.release()
+        return pairs
+
+    def stats(self):
+        return 'day cache: %d hits, %d misses, %d evictions, %d bytes'%(
+                self.hits, self.misses, self.evictions, self._size or 0)
+
+    def _total_size(self):
+        if self._size is None:
+            self._size = sum([os.path.getsize(os.path.join(self.path, name))
+                              for name in os.listdir(self.path)
+                              if name.endswith('.day')])
+        return self._size
+
+    def _evict(self, keep):
+        """Remove least recently used entries until the cache fits."""
+        entries = []
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            if name.endswith('.day') and filename != keep:
+                st = os.stat(filename)
+                entries.append((st.st_mtime, st.st_size, filename))
+        entries.sort()
+        size = sum([e[1] for e in entries]) + os.path.getsize(keep)
+        for mtime, fsize, filename in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(filename)
+            except OSError:
+                continue
+            size -= fsize
+            self.evictions += 1
+        self._size = size
+
+class TailCursor(object):
+    """Read position in a log file that's still being written, along with
+    the events parsed so far.  update() only parses what was appended since
+    the last call.  If the file was replaced, which rotation does, or
+    truncated, the cursor starts over from the beginning.
+
+    pairs is only ever appended to, or replaced when starting over, so
+    readers can iterate it without holding the lock."""
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.inode = None
+        self.offset = 0
+        self.pairs = []
+        self.last_used = 0
+        self.lock = threading.Lock()
+
+    def update(self, st, parse):
+        """Parse the complete lines appended to the file.  st is its 
+        os.stat(), parse a function turning raw lines into events with UTC
+        timestamps.  Returns the number of bytes parsed."""
+        inode = (st.st_dev, st.st_ino)
+        if inode != self.inode or st.st_size < self.offset:
+            self.inode = inode
+            self.offset = 0
+            self.pairs = []
+        if st.st_size == self.offset:
+            return 0
+        f = open(self.path, 'rb')
+        try:
+            f.seek(self.offset)
+            data = f.read(st.st_size - self.offset)
+        finally:
+            f.close()
+        # a partially written line is left for next time
+        end = data.rfind('\n') + 1
+        if end:
+            self.pairs.extend(to_pairs(parse(data[:end - 1].split('\n'))))
+            self.offset += end
+        return end
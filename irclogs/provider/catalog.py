@@ -0,0 +1,134 @@
+"""
+Which days of a channel have log files.  Formatting every path pattern for
+every date and stat()ing the results is wasteful, and can't answer "which
+days of this month have logs" for the calendar at all.  A LogCatalog scans
+the log directories once, and rescans only when one of their mtimes
+changes, which happens whenever a log file is created, renamed or removed.
+"""
+
+# Copyright (c) 2009, Robert Corsaro
+
+import glob
+import os
+import os.path
+import re
+import threading
+import time
+from datetime import date
+from time import strptime
+
+from irclogs.provider.archive import SUFFIXES, lzma
+
+GLOB_CHARS = re.compile('[*?[]')
+
+def glob_dirs(pattern):
+    """Every directory the files matching the glob pattern can be in, and
+    the directories those are listed in, down from the deepest directory
+    without wildcards."""
+    parts = os.path.dirname(pattern).split(os.sep)
+    i = 0
+    while i < len(parts) and not GLOB_CHARS.search(parts[i]):
+        i += 1
+    root = os.sep.join(parts[:i]) or os.sep
+    dirs = [root]
+    for j in range(i + 1, len(parts) + 1):
+        dirs.extend(filter(os.path.isdir, glob.glob(os.sep.join(parts[:j]))))
+    return dirs
+
+def scan(patterns):
+    """Yield (date, index, path) for every log file matching patterns, a
+    list of (strftime format, glob pattern) of log paths, plain files
+    before their compressed variants.  index is the position of the
+    pattern."""
+    for index, (fileformat, pattern) in enumerate(patterns):
+        for suffix in ('',) + SUFFIXES:
+            if suffix == '.xz' and lzma is None:
+                continue
+            for found in glob.glob(pattern + suffix):
+                name = found[:len(found)-len(suffix)]
+                try:
+                    t = strptime(name, fileformat)
+                except ValueError:
+                    continue
+                yield date(*t[:3]), index, found
+
+class LogCatalog(object):
+    """Log files of one channel by date.  days maps each date to the log
+    files to read for it, in pattern order, and months maps (year, month)
+    to a bitmap of the days that have any.
+
+    refresh() stat()s the directories seen by the last scan, and scans
+    again if any of them changed.  Directories modified just before a scan
+    are rescanned until they settle, since file systems with coarse mtimes
+    may not show a second change."""
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.days = {}
+        self.months = {}
+        self.dirs = {}
+        self.racy = False
+        self.scans = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Bring the catalog up to date.  Returns True if it rescanned."""
+        self.lock.acquire()
+        try:
+            if self.dirs and not self.racy and \
+                    self.dirs == self._mtimes(self.dirs.keys()):
+                return False
+            self._scan()
+            return True
+        finally:
+            self.lock.release()
+
+    def _mtimes(self, dirs):
+        mtimes = {}
+        for d in dirs:
+            try:
+                mtimes[d] = os.stat(d).st_mtime
+            except OSError:
+                mtimes[d] = None
+        return mtimes
+
+    def _scan(self):
+        dirs = []
+        for fileformat, pattern in self.patterns:
+            dirs.extend(glob_dirs(pattern))
+        # mtimes before listing, so changes during the scan are noticed
+        # next time
+        mtimes = self._mtimes(dirs)
+        found = {}
+        for day, index, path in scan(self.patterns):
+            found.setdefault(day, {}).setdefault(index, path)
+        days = {}
+        months = {}
+        for day, paths in found.items():
+            days[day] = [paths[i] for i in sorted(paths)]
+            key = (day.year, day.month)
+            months[key] = months.get(key, 0) | (1 << day.day)
+        self.days, self.months, self.dirs = days, months, mtimes
+        # a directory changed within the mtime resolution of the scan could
+        # change again without its mtime changing
+        now = time.time()
+        self.racy = bool([m for m in mtimes.values() 
+                          if m is not None and m >= now - 2])
+        self.scans += 1
+
+    def files(self, day):
+        """The log files to read for day, a date, or []."""
+        return self.days.get(day, [])
+
+    def days_before(self, day):
+        """The dates with logs up to and including day, newest first."""
+        return sorted([d for d in self.days if d <= day], reverse=True)
+
+    def has_day(self, day):
+        return bool(self.months.get((day.year, day.month), 0) &
+                    (1 << day.day))
+
+    def month_days(self, year, month):
+        """The days of the month, as numbers, that have logs."""
+        bits = self.months.get((year, month), 0)
+        return [d for d in range(1, 32) if bits & (1 << d)]
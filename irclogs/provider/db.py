@@ -4,18 +4,77 @@ Parse logs from db into structured data.
 
 # Copyright (c) 2009, Robert Corsaro
 
+import os.path
 import re
+import threading
 from time import strptime, strftime
 from datetime import datetime, timedelta
 from pytz import timezone, UnknownTimeZoneError
 
 from trac.core import *
-from trac.config import Option
-from trac.db.api import DatabaseManager
+from trac.config import BoolOption, IntOption, Option
+from trac.db.api import IDatabaseConnector, _parse_db_str
+from trac.db.util import IterableCursor
 
-from irclogs.api import IIRCLogsProvider, IRCChannelManager
+from irclogs.api import IIRCLogsProvider, IRCChannelManager, IRCEvent, \
+        page_events, read_ahead, resume_start, type_code
+from irclogs.provider.file import TimezoneConverter
+from irclogs.provider.pool import ConnectionPool, safe_uri
 
-ENCODED_FIELDS = ('network', 'channel', 'nick', 'type', 'message', 'comment')
+# only the columns _events() uses, in this order, and id for keyset paging
+COLUMNS = '"time", network, target, nick, type, msg, id'
+
+def streaming_cursor(cnx, name='irclogs_events', log=None):
+    """A cursor on cnx, a trac database connection or a PooledConnection of
+    one, that fetches rows from the server as fetchmany() asks for them.
+    Plain cursors of psycopg2 and MySQLdb read the whole result into memory
+    on execute(), and so do the eager cursors trac uses for SQLite.
+
+    PostgreSQL gets a named, server-side, cursor, MySQL an unbuffered
+    SSCursor and SQLite a lazy cursor.  Other databases get a plain one.
+    Close the cursor before giving the connection back: an unbuffered MySQL
+    cursor ties up the connection until all its rows are read."""
+    wrapper = getattr(cnx, 'cnx', cnx)
+    raw = getattr(wrapper, 'cnx', None)
+    module = raw.__class__.__module__.split('.')[0]
+    if module == 'psycopg2':
+        cursor = raw.cursor(name)
+    elif module == 'MySQLdb':
+        cursor = _mysql_stream_cursor()(raw)
+    elif module in ('sqlite3', 'pysqlite2'):
+        from trac.db.sqlite_backend import PyFormatCursor
+        cursor = raw.cursor(PyFormatCursor)
+        # rolled back with the connection, like trac's own cursors
+        cursor.cnx = wrapper
+        wrapper._active_cursors[cursor] = True
+    else:
+        return wrapper.cursor()
+    return IterableCursor(cursor, log)
+
+_MySQLStreamCursor = None
+
+def _mysql_stream_cursor():
+    """An unbuffered MySQLdb cursor class decoding strings from utf-8, like
+    trac's MySQLUnicodeCursor."""
+    global _MySQLStreamCursor
+    if _MySQLStreamCursor is None:
+        from MySQLdb.cursors import SSCursor
+        class MySQLStreamCursor(SSCursor):
+            def fetchmany(self, size=None):
+                return [tuple([(isinstance(v, str) and [v.decode('utf-8')] 
+                                or [v])[0] for v in row])
+                        for row in SSCursor.fetchmany(self, size) or ()]
+        _MySQLStreamCursor = MySQLStreamCursor
+    return _MySQLStreamCursor
+
+def fetch_batches(cursor, size):
+    """Yield the rows of an executed cursor, fetching size at a time."""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
 
 class DBIRCLogProvider(Component):
     """
@@ -41,16 +100,194 @@ class DBIRCLogProvider(Component):
     If using the Gozerbot chatlog plugin, it will create this table 
     automatically in not already present.
 
+    Queries select by network, target and time.  `trac-admin <env> irclogs
+    index` creates an index on those columns, and `trac-admin <env> irclogs
+    explain` shows how the database runs the queries.
+
     """
 
     implements(IIRCLogsProvider)
 
+    fetch_size = IntOption('irclogs', 'db_fetch_size', 1000,
+        doc="""Chatlog rows fetched from the database at a time.  Rows are
+        read through server-side cursors where the database has them, so
+        only this many are held in memory however long the range.""")
+
+    chunk_hours = IntOption('irclogs', 'db_chunk_hours', 24,
+        doc="""Ranges longer than this many hours are read in chunks of it,
+        each in pages of db_fetch_size rows selected after the (time, id)
+        of the page before.  Every page is a short query of its own, so no
+        transaction stays open while a long range is read.  0 reads any
+        range with one query.""")
+
+    prefetch = BoolOption('irclogs', 'db_read_ahead', 'false',
+        doc="""Fetch the next page of a chunked range in a thread while
+        the current one is being used.""")
+
     # IRCLogsProvider interface
-    def get_events_in_range(self, ch, start, end):
-        global ENCODED_FIELDS
+    def get_events_in_range(self, ch, start, end, limit=None, after=None,
+                            filter=None):
+        """Pages, with limit and after, are selected from the cursor's
+        time on, with a LIMIT covering the rows at that time that were on
+        the page before.  filter becomes part of the WHERE clause."""
+        if limit is None and after is None:
+            return self._select(ch, start, end, filter=filter)
+        start = resume_start(start, after)
+        rows = limit
+        if rows is not None and after:
+            rows += after[1]
+        return page_events(self._select(ch, start, end, rows, filter), 
+                           after, limit)
+
+    def name(self):
+        return 'db'
+    # end IRCLogsProvider interface
 
-        ch_mgr = IRCChannelManager(self.env)
+    def _select(self, ch, start, end, limit=None, filter=None):
+        """Yield the events of ch from start to end, at most limit, that 
+        filter accepts."""
+        if filter is not None and filter.types is not None and \
+                not filter.types:
+            return
         self.log.debug(ch.settings())
+        tz, ttz = self._timezones(ch, start)
+        if self.chunk_hours > 0 and \
+                end - start > timedelta(hours=self.chunk_hours):
+            pages = self._pages(ch, start, end, tz, limit, filter)
+            if self.prefetch:
+                pages = read_ahead(pages)
+            for rows in pages:
+                for line in self._events(ch, rows, tz, ttz):
+                    yield line
+            return
+        sql, args = self._range_query(ch, start, end, tz, limit, filter)
+        cnx = self._getdb(ch)
+        cur = None
+        # readers that stop early, like pages, close the generator, and
+        # the cursor must be closed before the connection goes back
+        try:
+            try:
+                self.log.debug("executing %s with %s"%(sql, args))
+                cur = streaming_cursor(cnx, log=self.log)
+                cur.execute(sql, args)
+                rows = fetch_batches(cur, max(self.fetch_size, 1))
+                for line in self._events(ch, rows, tz, ttz):
+                    yield line
+            except Exception, e:
+                self.log.error(e)
+                raise e
+        finally:
+            try:
+                if cur is not None:
+                    cur.close()
+            finally:
+                cnx.close()
+
+    def _pages(self, ch, start, end, tz, limit=None, filter=None):
+        """Yield the rows of ch from start to end, at most limit, that
+        filter accepts, in lists of at most db_fetch_size.  The range is
+        split into chunks of db_chunk_hours, and each chunk is read by
+        keyset: every page is selected after the (time, id) of the last row
+        of the page before."""
+        size = max(self.fetch_size, 1)
+        chunk = timedelta(hours=self.chunk_hours)
+        while start < end and limit != 0:
+            chunk_end = min(start + chunk, end)
+            key = None
+            while limit != 0:
+                count = size
+                if limit is not None:
+                    count = min(count, limit)
+                sql, args = self._range_query(ch, start, chunk_end, tz,
+                                              count, filter, key)
+                rows = self._fetch(ch, sql, args)
+                if limit is not None:
+                    limit -= len(rows)
+                if rows:
+                    yield rows
+                if len(rows) < count:
+                    break
+                key = rows[-1][0], rows[-1][6]
+            start = chunk_end
+
+    def _fetch(self, ch, sql, args):
+        """All the rows of a query on the database of ch."""
+        self.log.debug("executing %s with %s"%(sql, args))
+        cnx = self._getdb(ch)
+        try:
+            try:
+                cur = cnx.cursor()
+                cur.execute(sql, args)
+                rows = cur.fetchall()
+            except Exception, e:
+                self.log.error(e)
+                raise e
+        finally:
+            cnx.close()
+        return rows
+
+    def _range_query(self, ch, start, end, tz, limit=None, filter=None,
+                     key=None):
+        """The SQL and arguments selecting the rows of ch from start to
+        end, at most limit, that filter accepts.  If key, the (time, id)
+        of a row, is given, only rows after it are selected."""
+        sql = """
+          SELECT %s FROM chatlog 
+          WHERE network = %%s AND target = %%s AND time >= %%s AND
+            time < %%s"""%(COLUMNS)
+        args = [ch.network() or '', ch.channel(), 
+                self._db_time(start, tz), self._db_time(end, tz)]
+        if filter is not None:
+            if filter.types is not None:
+                types = sorted(filter.types)
+                sql += " AND type IN (%s)"%(','.join(['%s'] * len(types)))
+                args.extend(types)
+            if filter.nicks:
+                nicks = sorted(filter.nicks)
+                sql += " AND nick NOT IN (%s)"%(
+                        ','.join(['%s'] * len(nicks)))
+                args.extend(nicks)
+        if key is not None:
+            sql += ' AND ("time" > %s OR ("time" = %s AND id > %s))'
+            args.extend([key[0], key[0], key[1]])
+        sql += ' ORDER BY "time", id'
+        if limit is not None:
+            sql += " LIMIT %s"
+            args.append(limit)
+        return sql, args
+
+    def _last_query(self, ch, end, tz, count):
+        """The SQL and arguments selecting the last count rows of ch before
+        end, newest first."""
+        sql = """
+          SELECT %s FROM chatlog 
+          WHERE network = %%s AND target = %%s AND time < %%s 
+          ORDER BY "time" DESC, id DESC LIMIT %%s"""%(COLUMNS)
+        return sql, [ch.network() or '', ch.channel(), 
+                     self._db_time(end, tz), count]
+
+    def get_last_events(self, ch, end, count):
+        """The last count events of ch before end, in order."""
+        tz, ttz = self._timezones(ch, end)
+        sql, args = self._last_query(ch, end, tz, count)
+        cnx = self._getdb(ch)
+        try:
+            try:
+                cur = cnx.cursor()
+                cur.execute(sql, args)
+                rows = list(cur)
+                rows.reverse()
+                events = list(self._events(ch, rows, tz, ttz))
+            except Exception, e:
+                self.log.error(e)
+                raise e
+        finally:
+            cnx.close()
+        return events
+
+    def _timezones(self, ch, dt):
+        """The timezone of the chatlog times of ch, and the timezone of
+        dt, a requested time, to return timestamps in."""
         def_tzname = self.config.get('irclogs', 'timezone', 'utc')
         tzname = ch.setting('timezone', def_tzname)
         try:
@@ -60,77 +297,137 @@ class DBIRCLogProvider(Component):
                     "parsed as UTC")
             tzname = 'UTC'
             tz = timezone(tzname)
-        cnx = self._getdb(ch)
         try:
-            ttz = timezone(start.tzname())
+            ttz = timezone(dt.tzname())
         except UnknownTimeZoneError:
             self.log.warn("timezone %s not supported, irclog output will be "\
-                    "%s"%(start.tzname(), tzname))
+                    "%s"%(dt.tzname(), tzname))
             ttz = tz
+        return tz, ttz
+
+    def _db_time(self, dt, tz):
+        """dt as a naive time in tz, the timezone of the time column, so
+        that comparisons don't depend on how the database treats offsets."""
+        return tz.normalize(dt.astimezone(tz)).replace(tzinfo=None)
+
+    def _events(self, ch, rows, tz, ttz):
+        """Yield an IRCEvent for each chatlog row of COLUMNS.
+
+        Times are converted by a TimezoneConverter, which only looks up
+        offsets when a row leaves the DST span of the one before.  Whether
+        rows need decoding with the channel charset is decided once, on the
+        first row: drivers return either unicode or bytes for a column."""
+        convert = TimezoneConverter(tz, ttz)
+        charset = ch.setting('charset')
+        decode = None
+        new = IRCEvent.__new__
+        for row in rows:
+            if decode is None:
+                decode = bool(charset) and not isinstance(row[5], unicode)
+            # COLUMNS are time, network, target, nick, type, msg, id
+            if decode:
+                network, channel, nick, type, msg = [
+                        unicode(v, charset, 'ignore') for v in row[1:6]]
+            else:
+                network, channel, nick, type, msg = row[1:6]
+            event = new(IRCEvent)
+            event._extra = None
+            event.code = type_code(type)
+            event.timestamp = convert(row[0])
+            event.network = network
+            event.channel = channel
+            event.nick = nick
+            event.message = event.comment = msg
+            event.action = msg.lstrip('* ')
+            yield event
 
-        try:
-            self.log.debug("""executing
-              SELECT * FROM chatlog 
-              WHERE network = %s AND target = %s AND time >= %s AND
-                time < %s ORDER BY "time" """)
-            self.log.debug("with %s, %s, %s, %s"%(ch.network() or '', ch.channel(), start, end))
-            cur = cnx.cursor()
-            cur.execute("""
-              SELECT * FROM chatlog 
-              WHERE network = %s AND target = %s AND time >= %s AND
-                time < %s ORDER BY "time" """,(
-                  ch.network() or '',
-                  ch.channel(),
-                  start,
-                  end
-              )
-            )
-            ignore_charset = False
-            for l in cur:
-                timestamp = l[1]
-                timestamp = tz.localize(timestamp)
-                dt = ttz.normalize(timestamp.astimezone(ttz))
-                line = {
-                    'timestamp': dt,
-                    'network': l[2],
-                    'channel': l[3],
-                    'nick': l[4],
-                    'type': l[5],
-                    'message': l[6],
-                    'comment': l[6],
-                    'action': l[6].lstrip('* ')
-                }
-                ignore_charset = ignore_charset or isinstance(line['message'],
-                                                              unicode)
-                if (not ignore_charset) and ch.setting('charset'):
-                    for k in ENCODED_FIELDS:
-                        line[k] = unicode(line[k], ch.setting('charset'), 
-                                          errors='ignore')
-                        continue
-                yield line
-            cnx.close()
-        except Exception, e:
-            cnx.close()
-            self.log.error(e)
-            raise e
-    
-    def name(self):
-        return 'db'
-    # end IRCLogsProvider interface
     def _getdb(self, channel):
-        dbm = IRCLogDatabaseManager(self.env)
+        """A pooled connection to the database of channel."""
+        return IRCLogDatabaseManager(self.env).connect(self._database(channel))
+
+    def _database(self, channel):
+        """The connection URI of the chatlog database of channel."""
         trac_db = self.config.get('trac', 'database')
         irc_db = self.config.get('irclogs', 'database', trac_db)
-        chan_db = channel.setting('database', irc_db)
-        dbm.set_database(chan_db)
-        return dbm.get_connection()
-        
-                
-class IRCLogDatabaseManager(DatabaseManager):
-    """ Provide access to chatlog db """
-
-    connection_uri = None
-
-    def set_database(self, database):
-        self.connection_uri = database
-    
+        return channel.setting('database', irc_db)
+
+class IRCLogDatabaseManager(Component):
+    """Connections to chatlog databases, pooled per connection URI.  The
+    URI is passed to every call instead of being set on this component,
+    which is shared by all threads."""
+
+    connectors = ExtensionPoint(IDatabaseConnector)
+
+    pool_size = IntOption('irclogs', 'db_pool_size', 5,
+        doc="""Most connections kept open to each chatlog database.""")
+
+    pool_idle_timeout = IntOption('irclogs', 'db_pool_idle_timeout', 600,
+        doc="""Seconds a pooled connection can sit unused before it's
+        closed.""")
+
+    pool_check_interval = IntOption('irclogs', 'db_pool_check_interval', 30,
+        doc="""Pooled connections unused for this many seconds are checked
+        with a trivial query before they're used again.  0 checks every
+        time.""")
+
+    def __init__(self):
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+
+    def connect(self, uri):
+        """A connection to the database at uri, from its pool.  close() it
+        to give it back."""
+        pool = self._pool(uri)
+        cnx = pool.get(self.config.getint('trac', 'timeout', 20) or None)
+        self.log.debug(pool.stats())
+        return cnx
+
+    def _pool(self, uri):
+        self._pools_lock.acquire()
+        try:
+            pool = self._pools.get(uri)
+            if pool is None:
+                connector, args = self.get_connector_for(uri)
+                def _connect():
+                    return connector.get_connection(**args)
+                pool = self._pools[uri] = ConnectionPool(_connect, 
+                        self.pool_size, self.pool_idle_timeout, 
+                        self.pool_check_interval, safe_uri(uri), self.log)
+            return pool
+        finally:
+            self._pools_lock.release()
+
+    def get_connector_for(self, uri):
+        """DatabaseManager.get_connector() for uri instead of the trac
+        database: the connector for its scheme, and its arguments."""
+        scheme, args = _parse_db_str(uri)
+        candidates = [
+            (priority, connector)
+            for connector in self.connectors
+            for scheme_, priority in connector.get_supported_schemes()
+            if scheme_ == scheme
+        ]
+        if not candidates:
+            raise TracError('Unsupported database type "%s"'%(scheme))
+        priority, connector = max(candidates)
+        if priority < 0:
+            raise TracError(connector.error)
+        if scheme == 'sqlite':
+            # relative to the environment, like the trac database
+            if args['path'] != ':memory:' and \
+                    not args['path'].startswith('/'):
+                args['path'] = os.path.join(self.env.path,
+                                            args['path'].lstrip('/'))
+        if self.config.getbool('trac', 'debug_sql'):
+            args['log'] = self.log
+        return connector, args
+
+    def shutdown(self):
+        """Close the idle connections of every pool."""
+        self._pools_lock.acquire()
+        try:
+            for pool in self._pools.values():
+                pool.shutdown()
+            self._pools = {}
+        finally:
+            self._pools_lock.release()
@@ -24,20 +24,60 @@ import re
 from time import strptime, strftime
 from datetime import datetime, timedelta
 from pytz import timezone, UnknownTimeZoneError, UTC
+from pytz.tzinfo import DstTzInfo, StaticTzInfo
+from bisect import bisect_right
 import os.path
 import itertools
 import operator
 import heapq
+import shutil
+import mmap
+import sre_constants
+import sre_parse
+import threading
+import time
 
 from trac.core import *
-from trac.config import Option, ListOption
+from trac.config import Option, BoolOption, IntOption, ListOption
+from trac.util import md5
 
 from irclogs.api import *
+from irclogs.provider.archive import ChunkIndex, compress_log, \
+        compression, open_log
+from irclogs.provider.catalog import LogCatalog, scan
+from irclogs.provider.cache import DayCache, TailCursor, events_in_range
+from irclogs.provider.offsets import OffsetIndex, epoch
 
 # this is used for comparison only, and never included in yielded
 # values
 OLDDATE = datetime(1977,8,3,0,0,0,tzinfo=timezone('utc'))
 
+def required_literals(pattern):
+    """Literal strings that must appear in any string matching pattern, a
+    compiled regex, longest first.  Only mandatory parts of the pattern are
+    considered, so the result may be empty but is never wrong."""
+    if pattern.flags & (re.IGNORECASE | re.VERBOSE):
+        return ()
+    found = set()
+    def _walk(seq):
+        run = []
+        for op, av in seq:
+            if op == sre_constants.LITERAL and av < 128:
+                run.append(chr(av))
+                continue
+            if run:
+                found.add(''.join(run))
+                run = []
+            if op == sre_constants.SUBPATTERN:
+                _walk(av[-1])
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) \
+                    and av[0] >= 1:
+                _walk(av[2])
+        if run:
+            found.add(''.join(run))
+    _walk(sre_parse.parse(pattern.pattern, pattern.flags))
+    return tuple(sorted(found, key=len, reverse=True))
+
 class FileIRCLogProvider(Component):
     """Provide logs from irc log files.  All default regex config parameters
     match the default Supybot log files, where defaults are provided.
@@ -50,6 +90,65 @@ class FileIRCLogProvider(Component):
 
     implements(IIRCLogsProvider)
 
+    def __init__(self):
+        # CompiledFormat registry, keyed by CompiledFormat.fingerprint()
+        self._formats = {}
+        self._formats_mtime = None
+        self._formats_lock = threading.Lock()
+        # OffsetIndex by log file path
+        self._indexes = {}
+        self._indexes_lock = threading.Lock()
+        self._day_cache = None
+        # TailCursor by log file path
+        self._cursors = {}
+        self._cursors_lock = threading.Lock()
+        # LogCatalog by path patterns
+        self._catalogs = {}
+        self._catalogs_lock = threading.Lock()
+
+    cache_dir = Option('irclogs', 'cache_dir', 'irclogs-cache',
+        doc="""Directory where the file provider keeps its caches, like the
+        offset indexes of log files.  Relative paths are relative to the 
+        environment directory.""")
+
+    offset_interval = IntOption('irclogs', 'offset_interval', 60,
+        doc="""Seconds of log between the entries of the offset index kept 
+        for each log file.  The index lets short time ranges, like quotes
+        and permalinks, be read without parsing the whole file.  0 disables
+        offset indexes.""")
+
+    day_cache_size = IntOption('irclogs', 'day_cache_size', 64,
+        doc="""Maximum size, in megabytes, of the cache of parsed log files
+        kept in cache_dir.  The least recently used files are evicted 
+        first.  0 disables the cache.""")
+
+    day_cache_age = IntOption('irclogs', 'day_cache_age', 3600,
+        doc="""Log files that haven't been modified for this many seconds 
+        are considered finished, and their parsed events are cached.""")
+
+    tail_cursors = IntOption('irclogs', 'tail_cursors', 16,
+        doc="""Number of log files still being written, like today's, whose
+        parsed events are kept in memory between requests.  Later requests,
+        like live feed polls, only parse the lines appended since.  0 
+        disables this.""")
+
+    chunk_interval = IntOption('irclogs', 'chunk_interval', 900,
+        doc="""Seconds of log in each gzip member of the log files written
+        by the compress-irc-logs command.  Reading part of a compressed day
+        decompresses whole members.""")
+
+    parse_workers = IntOption('irclogs', 'parse_workers', 0,
+        doc="""Number of processes parsing days in parallel when long ranges
+        are read in bulk, like by the search indexer.  0 means one per CPU,
+        1 disables parallel parsing.""")
+
+    mmap_reader = BoolOption('irclogs', 'mmap_reader', False,
+        doc="""Memory map log files instead of reading them line by line.
+        Lines are matched as raw bytes, lines outside the requested time
+        range are skipped before they're classified, and only the fields
+        that are returned are decoded.  Formats whose charset isn't ASCII 
+        compatible are always read line by line.""")
+
     # not to be confused with default_format(), which doesn't consider
     # a named format.
     format = Option('irclogs', 'format', 'supy', 
@@ -213,46 +312,35 @@ class FileIRCLogProvider(Component):
     Option('irclogs', 'format.bip.notice_regex',  '%(timestamp_regex)s\s(?P<message>TODO)$')
 
     # IRCLogsProvider interface
-    def get_events_in_range(self, channel, start, end):
+    def get_events_in_range(self, channel, start, end, limit=None, 
+                            after=None, filter=None):
         """Channel is the config channel name.  start and end are datetimes
         in the users tz.  If the start and end times have different timezones,
-        you're fucked."""
+        you're fucked.  Pages, with limit and after, are read from the 
+        cursor's timestamp on, which the offset indexes and day cache seek
+        to.  Lines filter rejects are dropped as soon as they're 
+        classified, see CompiledFormat.parse_lines()."""
+        if limit is None and after is None:
+            return self._events_in_range(channel, start, end, filter)
+        start = resume_start(start, after)
+        return page_events(self._events_in_range(channel, start, end, filter),
+                           after, limit)
+
+    def _events_in_range(self, channel, start, end, filter=None):
         self.log.debug('retrieving %s logs.  start: %s, end: %s'%(channel.name(), start, end))
-        ch_mgr = IRCChannelManager(self.env)
-        tzname = channel.setting('timezone', 'utc')
-        try:
-            tz = timezone(tzname)
-        except UnknownTimeZoneError:
-            self.log.warn("input timezone %s not supported, irclogs will be "\
-                    "parsed as UTC")
-            tzname = 'UTC'
-            tz = UTC
-        dates = self._get_file_dates(start, end, tz)
-        filesets = self._get_files(channel, dates)
-        # target tz
-        # convert to pytz timezone
-        try:
-            ttz = timezone(str(start.tzinfo))
-        except UnknownTimeZoneError:
-            self.log.warn("timezone %s not supported, irclog output will be "\
-                    "%s"%(start.tzinfo, tzname))
-            ttz = tz
+        filesets, ttz = self._range_files(channel, start, end)
 
 
         def _get_lines():
-            for fileset in filesets:
-                # only existing files
-                files = filter(lambda x: os.path.exists(x), fileset)
+            for files in filesets:
                 if len(files) > 0:
-                    files = [file(f) for f in files]
                     parsers = list(
-                        [self.parse_lines(f, channel=channel, \
-                            target_tz=ttz) for f in files])
+                        [self._read_file(f, channel, ttz, start, end, 
+                                         filter) for f in files])
                     def _key(x):
-                        return x.get('timestamp', OLDDATE)
+                        return x.get('timestamp')
                     for l in merge_iseq(parsers, _key): 
                         yield l
-                    [f.close() for f in files]
 
         for line in _get_lines():
             if line.get('timestamp'):
@@ -264,7 +352,388 @@ class FileIRCLogProvider(Component):
     def name(self):
         return 'file'
     # end IRCLogsProvider interface
+
+    def get_events_in_range_parallel(self, channel, start, end, filter=None):
+        """get_events_in_range() for long ranges, with the days parsed by
+        parse_workers processes.  Untimestamped lines are kept only when the
+        line before them is in range.  Falls back to get_events_in_range()
+        for single days, a single worker, or without multiprocessing."""
+        from irclogs.provider.parallel import OrderedResults, cpu_count, \
+                multiprocessing, parse_fileset
+        workers = self.parse_workers
+        if workers <= 0:
+            workers = cpu_count()
+        filesets, ttz = self._range_files(channel, start, end)
+        filesets = [files for files in filesets if files]
+        if multiprocessing is None or workers < 2 or len(filesets) < 2:
+            for line in self.get_events_in_range(channel, start, end, 
+                                                 filter=filter):
+                yield line
+            return
+        self.log.debug('parsing %d days of %s logs with %d workers'%(
+            len(filesets), channel.name(), workers))
+        format = channel.format()
+        tasks = [(fileset, format, filter) for fileset in filesets]
+        for pairs in OrderedResults(parse_fileset, tasks, workers):
+            for line in events_in_range(pairs, start, end, ttz):
+                yield line
+
+    def _range_files(self, channel, start, end):
+        """The existing log files to read for each day of the range, and
+        the timezone to return timestamps in."""
+        tz, ttz = self._timezones(channel, start)
+        catalog = self._catalog(channel)
+        filesets = [catalog.files(d) 
+                    for d in self._get_file_dates(start, end, tz)]
+        return filesets, ttz
+
+    def _timezones(self, channel, dt):
+        """The timezone of the log files of channel, and the timezone of
+        dt, a requested time, to return timestamps in."""
+        tzname = channel.setting('timezone', 'utc')
+        try:
+            tz = timezone(tzname)
+        except UnknownTimeZoneError:
+            self.log.warn("input timezone %s not supported, irclogs will be "\
+                    "parsed as UTC")
+            tzname = 'UTC'
+            tz = UTC
+        # target tz
+        # convert to pytz timezone
+        try:
+            ttz = timezone(str(dt.tzinfo))
+        except UnknownTimeZoneError:
+            self.log.warn("timezone %s not supported, irclog output will be "\
+                    "%s"%(dt.tzinfo, tzname))
+            ttz = tz
+        return tz, ttz
+
+    def get_last_events(self, channel, end, count):
+        """The last count events of channel before end, in order.  Log 
+        files are read backwards from the end in blocks, newest day first,
+        so only the tail of the log is parsed.  Untimestamped lines stay
+        with the timestamped line before them."""
+        tz, ttz = self._timezones(channel, end)
+        last = tz.normalize(
+                (end - timedelta(microseconds=1)).astimezone(tz)).date()
+        format = self._compiled_format(channel)
+        catalog = self._catalog(channel)
+        # runs of events, newest first
+        def _key(run):
+            return -epoch(run[0].get('timestamp') or OLDDATE)
+        events = []
+        newest = True
+        for day in catalog.days_before(last):
+            runs = []
+            for path in catalog.files(day):
+                cursor = None
+                if newest:
+                    # feeds poll the file being written
+                    cursor = self._tail_cursor_to(path, end, channel, format)
+                if cursor:
+                    runs.append(self._cursor_runs(cursor, ttz))
+                else:
+                    runs.append(self._reverse_runs(path, format, ttz))
+            newest = False
+            for run in merge_iseq(runs, _key):
+                timestamp = run[0].get('timestamp')
+                if timestamp and timestamp >= end:
+                    continue
+                events.extend(run[::-1])
+                if len(events) >= count:
+                    break
+            if len(events) >= count:
+                break
+        events = events[:count]
+        events.reverse()
+        return events
+
+    def _reverse_runs(self, path, format, target_tz):
+        """Yield the events of the log file at path from the end, as lists
+        of a timestamped event followed by the untimestamped events after
+        it.  Lines before the first timestamp come last, on their own."""
+        if compression(path):
+            # can't seek backwards, but old days are the least likely read
+            f = open_log(path)
+            blocks = [f.readlines()]
+        else:
+            f = open(path, 'rb')
+            blocks = reverse_blocks(f)
+        run = []
+        for lines in blocks:
+            events = list(format.parse_lines(lines, target_tz, self.log))
+            events.reverse()
+            for event in events:
+                run.append(event)
+                if event.get('timestamp'):
+                    run.reverse()
+                    yield run
+                    run = []
+        f.close()
+        if run:
+            run.reverse()
+            yield run
+
+    def _cursor_runs(self, cursor, target_tz):
+        """_reverse_runs() of a file, from the events of its TailCursor."""
+        run = []
+        pairs = cursor.pairs[:]
+        pairs.reverse()
+        for seconds, event in pairs:
+            event = event.copy()
+            if seconds is not None:
+                event.timestamp = datetime.fromtimestamp(seconds, target_tz)
+            run.append(event)
+            if seconds is not None:
+                run.reverse()
+                yield run
+                run = []
+        if run:
+            run.reverse()
+            yield run
+
+    def _tail_cursor_to(self, path, end, channel, format, st=None):
+        """The TailCursor of the log file at path for a read up to end, if
+        the read is open ended: end is after the last write to the file, so
+        the read takes all of its tail.  Bounded reads should seek with the
+        offset index instead of parsing the whole file."""
+        if compression(path):
+            return None
+        if st is None:
+            st = os.stat(path)
+        if epoch(end) <= st.st_mtime:
+            return None
+        return self._tail_cursor(path, st, channel, format)
+
+    def _read_file(self, path, channel, target_tz, start, end, filter=None):
+        """Parse the log file at path.  Finished files are served from the
+        day cache, and open ended reads of files being written, like the
+        day view of today, from their tail cursor.  Otherwise, if the file
+        has an offset index, reading starts at the index entry before start
+        and stops at the first line at or after end.  Events filter rejects
+        are skipped."""
+        format = self._compiled_format(channel)
+        st = os.stat(path)
+        compressed = compression(path)
+        cache = self._get_day_cache()
+        if cache and time.time() - st.st_mtime >= self.day_cache_age:
+            pairs = cache.get(path, st, format.key)
+            if pairs is None:
+                pairs = cache.put(path, st, format.key, 
+                        self._parse_file(path, channel, UTC))
+            self.log.debug(cache.stats())
+            for line in events_in_range(pairs, start, end, target_tz, 
+                                        filter):
+                yield line
+            return
+        cursor = self._tail_cursor_to(path, end, channel, format, st)
+        if cursor:
+            for line in events_in_range(cursor.pairs, start, end, target_tz,
+                                        filter):
+                yield line
+            return
+        index = self._offset_index(path, format)
+        offset = 0
+        if index is not None:
+            offset = index.seek(start)
+        if self.mmap_reader and not compressed and format.byte_format():
+            f = file(path)
+            buf = map_file(f)
+            for line in self.parse_buffer(buf, channel, target_tz, start, end,
+                                          offset, index is not None, filter):
+                yield line
+            close_map(buf)
+            f.close()
+            return
+        f = open_log(path, offset)
+        for line in self.parse_lines(f, channel=channel, target_tz=target_tz,
+                                     filter=filter):
+            if index is not None and line.get('timestamp') and \
+                    line['timestamp'] >= end:
+                break
+            yield line
+        f.close()
+
+    def _parse_file(self, path, channel, target_tz):
+        """All events of the log file at path, as a list."""
+        format = self._compiled_format(channel)
+        if self.mmap_reader and not compression(path) and \
+                format.byte_format():
+            f = file(path)
+            buf = map_file(f)
+            events = list(self.parse_buffer(buf, channel, target_tz))
+            close_map(buf)
+        else:
+            f = open_log(path)
+            events = list(self.parse_lines(f, channel=channel, 
+                                           target_tz=target_tz))
+        f.close()
+        return events
+
+    def _tail_cursor(self, path, st, channel, format):
+        """The TailCursor of a log file that's still being written, brought
+        up to date, or None if cursors are disabled.  Only the tail_cursors
+        most recently used files keep a cursor."""
+        if self.tail_cursors <= 0:
+            return None
+        self._cursors_lock.acquire()
+        try:
+            cursor = self._cursors.get(path)
+            if cursor is None or cursor.key != format.key:
+                cursor = self._cursors[path] = TailCursor(path, format.key)
+            cursor.last_used = time.time()
+            if len(self._cursors) > self.tail_cursors:
+                lru = sorted([(c.last_used, p) for p, c 
+                              in self._cursors.items()])
+                for last_used, p in lru[:-self.tail_cursors]:
+                    del self._cursors[p]
+        finally:
+            self._cursors_lock.release()
+        def _parse(lines):
+            return self.parse_lines(lines, channel=channel, target_tz=UTC)
+        cursor.lock.acquire()
+        try:
+            parsed = cursor.update(st, _parse)
+        finally:
+            cursor.lock.release()
+        self.log.debug("tail cursor of %s: parsed %d new bytes, %d "\
+                "events"%(path, parsed, len(cursor.pairs)))
+        return cursor
+
+    def _offset_index(self, path, format):
+        """The up to date OffsetIndex of the log file at path, or None if
+        indexes are disabled or can't be stored."""
+        interval = self.offset_interval
+        if interval <= 0 or format.timestamp_re is None:
+            return None
+        cls = OffsetIndex
+        suffix = compression(path)
+        if suffix == '.gz':
+            # one entry per gzip member instead
+            cls, interval = ChunkIndex, 0
+        elif suffix:
+            return None
+        self._indexes_lock.acquire()
+        try:
+            index = self._indexes.get(path)
+            if index is None or index.key != format.timestamp_key or \
+                    index.interval != interval:
+                cachedir = self._cache_path('offsets')
+                if cachedir is None:
+                    return None
+                index = cls.load(cls.sidecar(cachedir, path),
+                        path, format.timestamp_key, interval)
+                self._indexes[path] = index
+            if index.update(os.stat(path), format.line_timestamp()):
+                cachedir = self._cache_path('offsets')
+                try:
+                    index.save(OffsetIndex.sidecar(cachedir, path))
+                except (IOError, OSError), e:
+                    self.log.warn("unable to save offset index of %s: %s"%(
+                        path, e))
+            return index
+        finally:
+            self._indexes_lock.release()
+
+    def _get_day_cache(self):
+        """The DayCache, or None if it's disabled or can't be stored."""
+        if self.day_cache_size <= 0:
+            return None
+        if self._day_cache is None:
+            path = self._cache_path('days')
+            if path is None:
+                return None
+            self._day_cache = DayCache(path, 
+                    self.day_cache_size * 1024 * 1024, self.log)
+        return self._day_cache
+
+    def _cache_path(self, name):
+        """The named subdirectory of cache_dir, created if needed.  Returns
+        None if it can't be created."""
+        path = self.cache_dir
+        if not os.path.isabs(path):
+            path = os.path.join(self.env.path, path)
+        path = os.path.join(path, name)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                self.log.warn("irclogs cache disabled, unable to create "\
+                        "%s: %s"%(path, e))
+                return None
+        return path
                 
+    def compress_logs(self, channel, before):
+        """Compress the log files of channel dated before the date before
+        with compress_log(), and remove the originals.  Files that have been
+        compressed already are left alone.  Returns the paths written."""
+        format = self._compiled_format(channel)
+        timestamp = format.line_timestamp()
+        written = []
+        for date, path in sorted(self._log_paths(channel)):
+            if date >= before or compression(path) or \
+                    os.path.exists(path + '.gz'):
+                continue
+            dest = path + '.gz'
+            members = compress_log(path, dest + '.tmp', timestamp, 
+                                   self.chunk_interval)
+            shutil.copystat(path, dest + '.tmp')
+            os.rename(dest + '.tmp', dest)
+            os.remove(path)
+            self._offset_index(dest, format)
+            self.log.info("compressed %s, %d chunks"%(path, members))
+            written.append(dest)
+        return written
+
+    def _log_paths(self, channel):
+        """Yield (date, path) for every log file of channel on disk, 
+        compressed or not, by matching the configured paths."""
+        for date, index, path in scan(self._path_patterns(channel)):
+            yield date, path
+
+    def _path_patterns(self, channel):
+        """(strftime format, glob pattern) of each configured log path of
+        channel, with the channel and network filled in."""
+        format = channel.format()
+        mapping = {
+            'channel': channel.channel(),
+            'network': channel.setting('network'),
+            'channel_name': channel.channel()[1:],
+        }
+        for k, v in mapping.items():
+            mapping[k] = ('%s'%(v)).replace('%', '%%')
+        paths = format['paths']
+        if not isinstance(paths, list):
+            paths = list((paths,))
+        patterns = []
+        for path in paths:
+            fileformat = os.path.join(format['basepath'], path)
+            # fill in the channel, but keep the strftime directives
+            fileformat = re.sub('%(?!\()', '%%', fileformat)%(mapping)
+            pattern = re.sub('%.', _glob_directive, fileformat)
+            patterns.append((fileformat, pattern))
+        return tuple(patterns)
+
+    def _catalog(self, channel):
+        """The LogCatalog of channel, refreshed."""
+        patterns = self._path_patterns(channel)
+        self._catalogs_lock.acquire()
+        try:
+            catalog = self._catalogs.get(patterns)
+            if catalog is None:
+                catalog = self._catalogs[patterns] = LogCatalog(patterns)
+        finally:
+            self._catalogs_lock.release()
+        if catalog.refresh():
+            self.log.debug("scanned log files of %s: %d days"%(
+                channel.name(), len(catalog.days)))
+        return catalog
+
+    def get_log_days(self, channel, year, month):
+        """Days of the month, as numbers, that have log files, in the
+        timezone of the logs."""
+        return self._catalog(channel).month_days(year, month)
+
     def _get_file_dates(self, start, end, file_tz=UTC):
         """Get files that are within the start-end range, taking into
         account that the file timezone can be different from the start-end
@@ -274,48 +743,15 @@ class FileIRCLogProvider(Component):
         normal_start = file_tz.normalize(start.astimezone(file_tz))
         normal_end = file_tz.normalize(end.astimezone(file_tz))
 
-        # get dates for files
-        yield normal_start.date()
-        d = normal_start
+        # get dates for files, the range is exclusive of end
+        d = normal_start.date()
+        last = max(d, (normal_end - timedelta(microseconds=1)).date())
         oneday = timedelta(days=1)
-        while d < normal_end:
+        while d <= last:
+            yield d
             d = d + oneday
-            yield d.date()
-        if d.day < normal_end.day:
-            yield normal_end.date()
-
-    def _get_files(self, channel, dates):
-        """Assumes dates are already normalized for the file formats
-        timezone. Generator returns a list of files for each date.
-
-        psuedo example:
-        
-        for fileset in _get_files([1/2, 1/3, 1/4]):
-            print "> %s"%(str(fileset))
 
-        > [file-1.2-a.log, file-1.2-b.log]
-        > [file-1.3-a.log, file-1.3-b.log]
-        > [file-1.4-a.log, file-1.4-b.log]
-        """
-        basepath = channel.format()['basepath']
-        for date in dates:
-            filepaths = []
-            paths = channel.format()['paths']
-            if not isinstance(paths, list):
-                paths = list((paths,))
-            for path in paths:
-                fileformat = os.path.join(basepath, path)
-                fileformat = date.strftime(fileformat)
-                fileformat = fileformat%({
-                    'channel': channel.channel(),
-                    'network': channel.setting('network'),
-                    'channel_name': channel.channel()[1:],
-                })
-                filepaths.append(fileformat)
-                self.log.debug("parsing %s"%(fileformat))
-            yield filepaths
-
-    def parse_lines(self, lines, channel=None, target_tz=None):
+    def parse_lines(self, lines, channel=None, target_tz=None, filter=None):
         """Parse irc log lines into structured data.  format should
         contain all information about parsing the lines.
           * lines: all irc lines, any generator or list will do
@@ -333,55 +769,537 @@ class FileIRCLogProvider(Component):
           * target_tz: optional target timezone.  This is the timezone of the 
                 return data timedate objects.  Will not convert to target_tz 
                 if None.
+          * filter: optional EventFilter.  Lines it rejects are skipped.
         """
+        format = self._compiled_format(channel)
+        return format.parse_lines(lines, target_tz, self.log, filter)
+
+    def parse_buffer(self, buf, channel=None, target_tz=None, start=None, 
+                     end=None, pos=0, stop=False, filter=None):
+        """parse_lines() for raw log data in buf, a string or an mmap, from
+        byte offset pos on.  The regexes run on the raw bytes, without
+        copying lines out of buf, and only the captured fields are decoded.
+
+        If start and end are given, lines timestamped outside of them are
+        skipped before they're classified, along with the untimestamped
+        lines following them.  If stop is set, parsing stops at the first
+        line at or after end; use it when pos came from an OffsetIndex.
+        Lines filter rejects are skipped, like in parse_lines().
+
+        The channel format must have a byte_format()."""
+        format = self._compiled_format(channel)
+        bformat = format.byte_format()
+        classify = bformat.classify
+        dispatch = bformat.dispatch
+        keep_other = True
+        if filter is not None:
+            dispatch = dispatch[:format.dispatch_length(filter.types)]
+            keep_other = filter.accepts('other')
+        decode = format.decoder(target_tz)
+        charset = format.charset
+        ts_match = bformat.timestamp_re and bformat.timestamp_re.match
+        find = buf.find
+        size = len(buf)
+        inrange = True
+
+        while pos < size:
+            nl = find('\n', pos)
+            if nl == -1:
+                nl = size
+            eol = nl
+            while eol > pos and buf[eol-1] == '\r':
+                eol -= 1
+            line_start = pos
+            pos = nl + 1
+            if eol == line_start:
+                continue
+            tsstr = ts = None
+            if start is not None and ts_match:
+                m = ts_match(buf, line_start, eol)
+                if m and m.group('timestamp'):
+                    tsstr = m.group('timestamp')
+                    try:
+                        ts = decode(tsstr)
+                    except ValueError:
+                        tsstr = None
+                if ts is not None:
+                    if ts >= end:
+                        if stop:
+                            break
+                        inrange = False
+                    else:
+                        inrange = ts >= start
+            if not inrange:
+                continue
+            result = classify(buf, line_start, eol, dispatch)
+            if result:
+                if filter is not None and filter.types is not None and \
+                        result.type not in filter.types:
+                    continue
+                if charset:
+                    for k, v in result.items():
+                        if isinstance(v, str) and \
+                                k != 'timestamp' and k != 'type':
+                            # we must ignore errors because irc is nuts
+                            result[k] = unicode(v, charset, 'ignore')
+                if filter is not None and not filter(result):
+                    continue
+                if result['timestamp']:
+                    if tsstr is not None and result['timestamp'] == tsstr:
+                        result['timestamp'] = ts
+                    else:
+                        result['timestamp'] = decode(result['timestamp'])
+                yield result
+            else:
+                if not keep_other:
+                    continue
+                line = buf[line_start:eol]
+                if charset:
+                    line = unicode(line, charset, 'ignore')
+                    if not line:
+                        continue
+                yield IRCEvent(type='other', message=line)
+                self.log.warn("didn't parse: %s"%line)
+
+    def _compiled_format(self, channel):
+        """Get the CompiledFormat for the channel from the registry, building
+        it if this combination of format options hasn't been seen yet.  The
+        registry is emptied whenever trac.ini is reread."""
         format = channel.format()
+        fingerprint = CompiledFormat.fingerprint(format)
+        mtime = getattr(self.config, '_lastmtime', None)
+        self._formats_lock.acquire()
+        try:
+            if mtime != self._formats_mtime:
+                self._formats = {}
+                self._formats_mtime = mtime
+            compiled = self._formats.get(fingerprint)
+            if compiled is None:
+                compiled = CompiledFormat(format, self.log)
+                self._formats[fingerprint] = compiled
+            return compiled
+        finally:
+            self._formats_lock.release()
+
+class CompiledFormat(object):
+    """The parts of a channel format that are expensive to build: compiled
+    regexes, in match order, and the file timezone.  Instances are immutable
+    and shared between requests through FileIRCLogProvider's registry."""
+
+    # format options, besides the *_regex ones, that affect parsing
+    KEYS = ('match_order', 'timestamp_regex', 'timestamp_format', 'timezone',
+            'charset')
+
+    def fingerprint(cls, format):
+        """Key identifying the effective parsing options of a format dict."""
+        match_order = re.split('[,|: ]+', format['match_order'])
+        keys = list(cls.KEYS) + ['%s_regex'%(x) for x in match_order]
+        return tuple([(k, format.get(k)) for k in keys])
+    fingerprint = classmethod(fingerprint)
+
+    def __init__(self, format, log=None):
+        tzname = format['timezone']
         try:
-            tz = timezone(format['timezone'])
+            self.tz = timezone(tzname)
         except UnknownTimeZoneError:
-            self.log.warn("input timezone %s not supported, irclogs will be "\
-                "parsed as UTC")
-            format['timezone'] = 'utc'
-            tz = timezone('utc')
+            if log:
+                log.warn("input timezone %s not supported, irclogs will be "\
+                    "parsed as UTC"%(tzname))
+            self.tz = timezone('utc')
+        self.timestamp_format = format['timestamp_format']
+        self.timestamp_layout = timestamp_layout(self.timestamp_format)
+        self.timestamp_re = re.compile(format['timestamp_regex'])
+        if 'timestamp' not in self.timestamp_re.groupindex:
+            self.timestamp_re = None
+        self.timestamp_key = md5(repr((format['timestamp_regex'], 
+            self.timestamp_format, str(self.tz)))).hexdigest()
+        self.key = md5(repr(self.fingerprint(format))).hexdigest()
+        self.charset = format.get('charset')
 
         def _map(x):
             regex_string = format['%s_regex'%(x)]
             regex_string = regex_string%({
                 'timestamp_regex': format['timestamp_regex']
             })
-            regex = re.compile(regex_string)
-            return { 'type': x, 'regex': regex }
-        match_order = re.split('[,|: ]+', format['match_order'])
-        matchers = map(_map, match_order)
-
-        def _parse_timestamp(tsstr):
-            t = strptime(tsstr, format['timestamp_format'])
-            dt = tz.localize(datetime(*t[:6]))
-            if target_tz:
-                dt = target_tz.normalize(dt.astimezone(target_tz))
-            return dt
+            return (x, re.compile(regex_string))
+        self.match_order = re.split('[,|: ]+', format['match_order'])
+        self.matchers = tuple(map(_map, self.match_order))
+        self._dispatch()
+        self._byte_format = None
+
+    def _dispatch(self):
+        """Precompute the literal markers each matcher requires, like
+        'has joined' or '<', so that classify() only runs the regexes a line
+        could possibly match.  Markers required by every matcher, usually
+        bits of the timestamp, are checked once per line."""
+        markers = [required_literals(regex) for msgtype, regex in self.matchers]
+        common = markers and reduce(
+                lambda x, y: x.intersection(y), map(set, markers)) or set()
+        self.common = tuple(sorted(common, key=len, reverse=True))
+        self.dispatch = tuple([(msgtype, regex, tuple(
+                    [l for l in lits if l not in common]))
+                for (msgtype, regex), lits in zip(self.matchers, markers)])
+
+    def classify(self, line, dispatch=None):
+        """Match line against the matchers in match order.  Returns the
+        groupdict of the first that matches as an IRCEvent, with its type set,
+        or None.  dispatch, if given, is the part of self.dispatch to try."""
+        for marker in self.common:
+            if marker not in line:
+                return None
+        if dispatch is None:
+            dispatch = self.dispatch
+        for msgtype, regex, markers in dispatch:
+            for marker in markers:
+                if marker not in line:
+                    break
+            else:
+                m = regex.match(line)
+                if m:
+                    result = IRCEvent(m.groupdict())
+                    result.type = msgtype
+                    return result
+        return None
+
+    def dispatch_length(self, types):
+        """How many entries of dispatch to try when only events of types, 
+        or all of them if None, are wanted.  Matchers of other types still
+        run when they come before a wanted one, so lines get the type they
+        would unfiltered.  If 'other' isn't wanted either, the matchers 
+        after the last wanted type are left out, since the lines they'd
+        match would be dropped anyway."""
+        if types is None or 'other' in types:
+            return len(self.dispatch)
+        n = 0
+        for i, (msgtype, regex, markers) in enumerate(self.dispatch):
+            if msgtype in types:
+                n = i + 1
+        return n
+
+    def byte_format(self):
+        """The ByteFormat of this format, built on first use, or None if
+        its regexes can't be matched against raw bytes."""
+        if self._byte_format is None:
+            try:
+                self._byte_format = ByteFormat(self)
+            except (UnicodeError, LookupError, ValueError):
+                self._byte_format = False
+        return self._byte_format or None
+
+    def classify_loop(self, line):
+        """classify() without marker dispatch; the old match_order loop."""
+        for msgtype, match_re in self.matchers:
+            m = match_re.match(line)
+            if m:
+                result = IRCEvent(m.groupdict())
+                result.type = msgtype
+                return result
+        return None
+
+    def parse_lines(self, lines, target_tz=None, log=None, filter=None):
+        """Generator behind FileIRCLogProvider.parse_lines().  Lines filter
+        rejects are dropped right after they're classified, before their
+        timestamps are parsed, and only the matchers the filter needs run,
+        see dispatch_length()."""
+        classify = self.classify
+        decode = self.decoder(target_tz)
+        charset = self.charset
+        dispatch = self.dispatch
+        keep_other = True
+        if filter is not None:
+            dispatch = dispatch[:self.dispatch_length(filter.types)]
+            keep_other = filter.accepts('other')
 
         for line in lines:
             line = line.rstrip('\r\n')
-            if format.get('charset'):
+            if charset:
                 # we must ignore errors because irc is nuts
-                line = unicode(line, format['charset'], errors='ignore')
+                line = unicode(line, charset, errors='ignore')
             if not line:
                 continue
-            matched = False
-            for matcher in matchers:
-                msgtype = matcher['type']
-                match_re = matcher['regex']
-                m = match_re.match(line)
+            result = classify(line, dispatch)
+            if result:
+                if filter is not None and not filter(result):
+                    continue
+                if result['timestamp']:
+                    result['timestamp'] = decode(result['timestamp'])
+                yield result
+            elif keep_other:
+                yield IRCEvent(type='other', message=line)
+                if log:
+                    log.warn("didn't parse: %s"%line)
+
+    def parse_timestamp(self, tsstr, target_tz=None):
+        t = strptime(tsstr, self.timestamp_format)
+        dt = self.tz.localize(datetime(*t[:6]))
+        if target_tz:
+            dt = target_tz.normalize(dt.astimezone(target_tz))
+        return dt
+
+    def decoder(self, target_tz=None):
+        """A TimestampDecoder for one pass over a file."""
+        return TimestampDecoder(self, target_tz)
+
+    def line_timestamp(self, target_tz=UTC):
+        """A function returning the timestamp at the start of a raw log line,
+        as a datetime in target_tz, or None if there isn't one.  Only the
+        timestamp_regex is matched, not the whole line."""
+        match = self.timestamp_re.match
+        decode = self.decoder(target_tz)
+        def _timestamp(line):
+            m = match(line)
+            if m and m.group('timestamp'):
+                try:
+                    return decode(m.group('timestamp'))
+                except ValueError:
+                    pass
+            return None
+        return _timestamp
+
+class ByteFormat(object):
+    """The regexes of a CompiledFormat, compiled to match raw bytes in the
+    file charset, for FileIRCLogProvider.parse_buffer().  Only ASCII
+    compatible charsets, where a newline is a newline and ASCII literals
+    are the same bytes, can be matched this way.
+
+    The regexes are compiled in MULTILINE mode and matched with pos and
+    endpos set to the bounds of a line, so ^ and $ keep meaning the start
+    and end of the line."""
+
+    def __init__(self, format):
+        charset = format.charset or 'ascii'
+        if ASCII_PROBE.encode(charset) != str(ASCII_PROBE):
+            raise ValueError("%s isn't ASCII compatible"%(charset))
+        def _compile(regex):
+            return re.compile(regex.pattern.encode(charset), 
+                    regex.flags | re.MULTILINE)
+        self.timestamp_re = None
+        if format.timestamp_re is not None:
+            self.timestamp_re = _compile(format.timestamp_re)
+        self.common = tuple([m.encode(charset) for m in format.common])
+        self.dispatch = tuple([(msgtype, _compile(regex), 
+                tuple([m.encode(charset) for m in markers]))
+            for msgtype, regex, markers in format.dispatch])
+
+    def classify(self, buf, pos, endpos, dispatch=None):
+        """CompiledFormat.classify() for the line in buf between pos and
+        endpos.  The values of the result are byte strings."""
+        find = buf.find
+        for marker in self.common:
+            if find(marker, pos, endpos) == -1:
+                return None
+        if dispatch is None:
+            dispatch = self.dispatch
+        for msgtype, regex, markers in dispatch:
+            for marker in markers:
+                if find(marker, pos, endpos) == -1:
+                    break
+            else:
+                m = regex.match(buf, pos, endpos)
                 if m:
-                    result = m.groupdict()
-                    if result['timestamp']:
-                        timestamp = _parse_timestamp(result['timestamp'])
-                        result['timestamp'] = timestamp
-                    result['type'] = msgtype
-                    yield result
-                    matched = True
+                    result = IRCEvent(m.groupdict())
+                    result.type = msgtype
+                    return result
+        return None
+
+# widths of the strftime directives usually found in log paths
+GLOB_WIDTHS = {'Y': 4, 'y': 2, 'm': 2, 'd': 2, 'H': 2, 'M': 2, 'S': 2, 'j': 3}
+
+def _glob_directive(m):
+    """glob pattern matching what a strftime directive produces."""
+    d = m.group(0)[1]
+    if d == '%':
+        return '%'
+    if d in GLOB_WIDTHS:
+        return '[0-9]' * GLOB_WIDTHS[d]
+    return '*'
+
+# every ASCII character a format regex is likely to contain
+ASCII_PROBE = u''.join(map(unichr, range(1, 128)))
+
+def map_file(f):
+    """A read only mmap of the open file f.  Empty files can't be mapped,
+    an empty string stands in for them."""
+    if os.fstat(f.fileno()).st_size == 0:
+        return ''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def close_map(buf):
+    if isinstance(buf, mmap.mmap):
+        buf.close()
+
+# bytes read at a time when reading log files backwards
+REVERSE_BLOCK = 64 * 1024
+
+def reverse_blocks(f, size=REVERSE_BLOCK):
+    """Yield the complete lines of the open file f, without line endings,
+    in lists of about size bytes.  The lists start at the end of the file
+    and work back, the lines in each are in file order."""
+    f.seek(0, 2)
+    pos = f.tell()
+    partial = ''
+    while pos > 0:
+        n = min(size, pos)
+        pos -= n
+        f.seek(pos)
+        lines = (f.read(n) + partial).split('\n')
+        # the first line may continue in the block before
+        partial = ''
+        if pos > 0:
+            partial = lines.pop(0)
+        yield lines
+
+# strptime directives the fast path understands, with their field widths
+# and the value strptime uses when they're missing from the format.
+LAYOUT_FIELDS = {
+    'Y': (0, 4, 1900),
+    'm': (1, 2, 1),
+    'd': (2, 2, 1),
+    'H': (3, 2, 0),
+    'M': (4, 2, 0),
+    'S': (5, 2, 0),
+}
+
+def timestamp_layout(format):
+    """Describe a fixed width strptime format, like %Y-%m-%dT%H:%M:%S, as
+    (length, fields, literals, defaults).  fields are (position, slice) for
+    the datetime arguments, literals are (slice, text) for everything in 
+    between.  Returns None for formats with any other directive."""
+    fields = []
+    literals = []
+    defaults = [f[2] for f in sorted(LAYOUT_FIELDS.values())]
+    pos = 0
+    i = 0
+    while i < len(format):
+        c = format[i]
+        if c == '%':
+            d = format[i+1:i+2]
+            if d in LAYOUT_FIELDS:
+                index, width, default = LAYOUT_FIELDS[d]
+                fields.append((index, slice(pos, pos + width)))
+                pos += width
+                i += 2
+                continue
+            if d != '%':
+                return None
+            i += 1
+        literals.append((slice(pos, pos + 1), c))
+        pos += 1
+        i += 1
+    return pos, tuple(fields), tuple(literals), tuple(defaults)
+
+class TimezoneConverter(object):
+    """Turns naive local times of tz into aware datetimes in target_tz, or
+    in tz without one, exactly like localize(), astimezone() and 
+    normalize() but much cheaper.
+
+    Logs are in time order, and the UTC offset only changes at DST
+    transitions, so the converter remembers the span of local time, and of
+    UTC for the target timezone, around the last transition lookup.  Times
+    in those spans skip localize(), astimezone() and normalize().  Spans 
+    stop short of ambiguous and missing local times around transitions,
+    which always take the slow path."""
+
+    def __init__(self, tz, target_tz=None):
+        self.tz = tz
+        self.target_tz = target_tz
+        # (start, end, offset, tzinfo), naive local time for the file tz
+        # and naive UTC for the target tz.  None means unbounded.
+        self._local = None
+        self._target = None
+
+    def __call__(self, naive):
+        local = self._local
+        if local is None or not _in_span(naive, local):
+            dt = self.tz.localize(naive)
+            local = self._local = _local_span(self.tz, dt)
+            if local is None:
+                if self.target_tz:
+                    dt = self.target_tz.normalize(
+                            dt.astimezone(self.target_tz))
+                return dt
+        if not self.target_tz:
+            return naive.replace(tzinfo=local[3])
+        utc = naive - local[2]
+        target = self._target
+        if target is None or not _in_span(utc, target):
+            target = self._target = _utc_span(self.target_tz, utc)
+            if target is None:
+                dt = naive.replace(tzinfo=local[3])
+                return self.target_tz.normalize(dt.astimezone(self.target_tz))
+        return (utc + target[2]).replace(tzinfo=target[3])
+
+class TimestampDecoder(TimezoneConverter):
+    """Turns timestamp strings from one log file into datetimes, exactly like
+    CompiledFormat.parse_timestamp() but much cheaper.
+
+    Fixed width formats are sliced straight into integers instead of going 
+    through strptime.  Anything the layout doesn't account for falls back to
+    strptime.  Time zones are converted by TimezoneConverter."""
+
+    def __init__(self, format, target_tz=None):
+        TimezoneConverter.__init__(self, format.tz, target_tz)
+        self.format = format
+        self.layout = format.timestamp_layout
+
+    def __call__(self, tsstr):
+        return TimezoneConverter.__call__(self, self._parse(tsstr))
+
+    def _parse(self, tsstr):
+        layout = self.layout
+        if layout and len(tsstr) == layout[0]:
+            for sl, text in layout[2]:
+                if tsstr[sl] != text:
                     break
-            if not matched:
-                yield {'type': 'other', 'message': line}
-                self.log.warn("didn't parse: %s"%line)
-
+            else:
+                args = list(layout[3])
+                for index, sl in layout[1]:
+                    value = tsstr[sl]
+                    if not value.isdigit():
+                        break
+                    args[index] = int(value)
+                else:
+                    return datetime(*args)
+        t = strptime(tsstr, self.format.timestamp_format)
+        return datetime(*t[:6])
+
+def _in_span(dt, span):
+    return (span[0] is None or span[0] <= dt) and \
+           (span[1] is None or dt < span[1])
+
+def _local_span(tz, dt):
+    """The span of naive local times that tz.localize() maps to the same
+    tzinfo as dt, or None if that can't be worked out."""
+    if not isinstance(tz, DstTzInfo):
+        if tz is UTC or isinstance(tz, StaticTzInfo):
+            return (None, None, dt.utcoffset(), dt.tzinfo)
+        return None
+    transitions = tz._utc_transition_times
+    infos = tz._transition_info
+    offset = dt.tzinfo._utcoffset
+    i = max(0, bisect_right(transitions, dt.replace(tzinfo=None) - offset) - 1)
+    if infos[i][0] != offset:
+        return None
+    start = end = None
+    if i > 0:
+        start = transitions[i] + max(offset, infos[i-1][0])
+    if i + 1 < len(transitions):
+        end = transitions[i+1] + min(offset, infos[i+1][0])
+    return (start, end, offset, dt.tzinfo)
+
+def _utc_span(tz, utc):
+    """The span of naive UTC times that tz shows with the same offset and
+    tzinfo as utc, or None if that can't be worked out."""
+    if not isinstance(tz, DstTzInfo):
+        if tz is UTC or isinstance(tz, StaticTzInfo):
+            return (None, None, tz.utcoffset(None), tz)
+        return None
+    transitions = tz._utc_transition_times
+    i = max(0, bisect_right(transitions, utc) - 1)
+    info = tz._transition_info[i]
+    start = end = None
+    if i > 0:
+        start = transitions[i]
+    if i + 1 < len(transitions):
+        end = transitions[i+1]
+    return (start, end, info[0], tz._tzinfos[info])
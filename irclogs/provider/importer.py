@@ -0,0 +1,178 @@
+"""
+Copy the file logs of a channel into a chatlog table, so the channel can be
+switched to the db provider.  Days are parsed with the channel's format and
+inserted in batches, one transaction each, and a checkpoint of how many
+events of the day are in, updated in the same transaction, lets an
+interrupted import carry on without inserting anything twice.
+"""
+
+# Copyright (c) 2009, Robert Corsaro
+
+import time
+from datetime import datetime
+
+from irclogs.api import merge_iseq
+from irclogs.provider.archive import open_log
+
+CHECKPOINT_TABLE = """
+    CREATE TABLE chatlog_import (
+        network VARCHAR(256) NOT NULL,
+        target  VARCHAR(256) NOT NULL,
+        day     CHAR(10) NOT NULL,
+        events  INTEGER NOT NULL,
+        done    INTEGER NOT NULL,
+        PRIMARY KEY (network, target, day)
+    )"""
+
+def event_row(event, network, target, last):
+    """The chatlog row of event, (time, network, target, nick, type, msg).
+    Events without a timestamp get last, the time of the event before."""
+    type = event['type']
+    if type == 'comment':
+        msg = event.get('comment')
+    elif type == 'action':
+        # DBIRCLogProvider strips it again
+        msg = '* %s'%(event.get('action'))
+    else:
+        msg = event.get('message')
+    timestamp = event.get('timestamp')
+    if timestamp is not None:
+        last = timestamp.replace(tzinfo=None)
+    return (last, network, target, event.get('nick') or '', type, msg or '')
+
+class ChatlogImporter(object):
+    """Imports the log files of a file channel into the chatlog table of a
+    database.  provider is the FileIRCLogProvider, connect a function
+    returning a connection to the database.  Times are stored in tz, the
+    timezone DBIRCLogProvider reads the channel's chatlog times in.
+
+    Only whole days before the one given to run() are imported, the day
+    being logged isn't finished.  Days are only ever imported once:
+    chatlog_import remembers how many events of each day have been
+    inserted, and which days are done."""
+
+    def __init__(self, provider, channel, connect, tz, batch_size=5000,
+                 log=None):
+        self.provider = provider
+        self.channel = channel
+        self.connect = connect
+        self.tz = tz
+        self.batch_size = max(batch_size, 1)
+        self.log = log
+        self.network = channel.network() or ''
+        self.target = channel.channel()
+        self.events = 0
+        self.days = 0
+        self.seconds = 0.0
+
+    def run(self, before, progress=None):
+        """Import every day with logs before the date before.  progress, if
+        given, is called with the date and number of events inserted after
+        each day."""
+        started = time.time()
+        catalog = self.provider._catalog(self.channel)
+        days = sorted([d for d in catalog.days if d < before])
+        cnx = self.connect()
+        try:
+            self._checkpoint_table(cnx)
+            done = self._done_days(cnx)
+            for day in days:
+                if day.isoformat() in done:
+                    continue
+                count = self._import_day(cnx, day, catalog.files(day))
+                self.days += 1
+                self.events += count
+                if progress:
+                    progress(day, count)
+            cnx.close()
+        except Exception, e:
+            cnx.rollback()
+            cnx.close()
+            raise e
+        self.seconds = time.time() - started
+
+    def rate(self):
+        """Events imported per second."""
+        return self.events / max(self.seconds, 1e-6)
+
+    def _checkpoint_table(self, cnx):
+        cur = cnx.cursor()
+        try:
+            cur.execute("SELECT day FROM chatlog_import WHERE 1 = 0")
+            cur.fetchall()
+        except Exception:
+            cnx.rollback()
+            cur = cnx.cursor()
+            cur.execute(CHECKPOINT_TABLE)
+            cnx.commit()
+
+    def _done_days(self, cnx):
+        cur = cnx.cursor()
+        cur.execute("""
+          SELECT day FROM chatlog_import
+          WHERE network = %s AND target = %s AND done = 1""",
+          (self.network, self.target))
+        return dict([(row[0], True) for row in cur.fetchall()])
+
+    def _events(self, files):
+        """The events of the open log files of a day, merged like a range
+        read."""
+        return merge_iseq([self.provider.parse_lines(f, channel=self.channel,
+                                                     target_tz=self.tz)
+                           for f in files], lambda x: x.get('timestamp'))
+
+    def _import_day(self, cnx, day, paths):
+        """Insert the events of day not inserted by an earlier run, in
+        batches.  Returns how many were inserted."""
+        key = (self.network, self.target, day.isoformat())
+        cur = cnx.cursor()
+        cur.execute("""
+          SELECT events FROM chatlog_import
+          WHERE network = %s AND target = %s AND day = %s""", key)
+        row = cur.fetchone()
+        if row is None:
+            skip = 0
+            cur.execute("""
+              INSERT INTO chatlog_import (network, target, day, events, done)
+              VALUES (%s, %s, %s, 0, 0)""", key)
+        else:
+            skip = row[0]
+        last = datetime(day.year, day.month, day.day)
+        inserted = 0
+        batch = []
+        files = []
+        try:
+            for path in paths:
+                files.append(open_log(path))
+            for i, event in enumerate(self._events(files)):
+                row = event_row(event, self.network, self.target, last)
+                last = row[0]
+                if i < skip:
+                    continue
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    inserted += self._insert(cnx, key, batch, skip + inserted)
+                    batch = []
+        finally:
+            for f in files:
+                f.close()
+        inserted += self._insert(cnx, key, batch, skip + inserted, True)
+        if self.log:
+            self.log.debug("imported %d events of %s %s"%(inserted,
+                self.target, day))
+        return inserted
+
+    def _insert(self, cnx, key, rows, before, done=False):
+        """Insert rows and move the checkpoint of the day past them, in one
+        transaction.  before is the number of events inserted already."""
+        cur = cnx.cursor()
+        if rows:
+            cur.executemany("""
+              INSERT INTO chatlog ("time", network, target, nick, type, msg)
+              VALUES (%s, %s, %s, %s, %s, %s)""", rows)
+        cur.execute("""
+          UPDATE chatlog_import SET events = %s, done = %s
+          WHERE network = %s AND target = %s AND day = %s""",
+          (before + len(rows), done and 1 or 0) + key)
+        cnx.commit()
+        return len(rows)
@@ -0,0 +1,142 @@
+"""
+Sparse time indexes for irc log files.  An OffsetIndex maps timestamps to
+byte offsets, one entry per interval, so that reading a few seconds of log
+doesn't mean parsing the whole day.
+
+Indexes are stored as small sidecar files under the plugin cache directory,
+never next to the logs, since the bot usually owns the log directory.
+"""
+
+# Copyright (c) 2009, Robert Corsaro
+
+import os
+import os.path
+from bisect import bisect_right
+from calendar import timegm
+
+from trac.util import AtomicFile, md5
+
+MAGIC = 'irclogs-offsets'
+VERSION = 1
+
+def epoch(dt):
+    """Seconds since the epoch for an aware datetime."""
+    return timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+class OffsetIndex(object):
+    """Offsets into one log file.
+
+    Each entry is (before, offset): every timestamped line in the file ahead
+    of offset is at or before the epoch `before`.  Entries are added for the
+    first line of every `interval` seconds, so seeking to the last entry
+    whose `before` is earlier than the wanted start never skips a line the
+    caller wants, even if the file isn't quite in order.
+
+    The index remembers the size and mtime of the file it was built from.
+    If the file only grew, the new bytes are scanned and appended; any other
+    change rebuilds it."""
+
+    def __init__(self, path, key, interval):
+        self.path = path
+        self.key = key
+        self.interval = interval
+        self.size = 0
+        self.mtime = None
+        self.entries = []
+        # state needed to continue scanning where the last scan stopped
+        self.last_bucket = None
+        self.last_seen = 0
+
+    def sidecar(cls, cachedir, path):
+        """Where the index of the log file at path is stored."""
+        name = md5(os.path.abspath(path)).hexdigest()
+        return os.path.join(cachedir, '%s.idx'%(name))
+    sidecar = classmethod(sidecar)
+
+    def load(cls, filename, path, key, interval):
+        """Read a stored index, or return a new empty one if it's missing,
+        unreadable or was built with other settings."""
+        index = cls(path, key, interval)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return index
+        try:
+            try:
+                header = f.readline().split()
+                if header[:4] != [MAGIC, str(VERSION), key, str(interval)]:
+                    return index
+                size, mtime, last_bucket, last_seen = header[4:8]
+                entries = []
+                for line in f:
+                    before, offset = line.split()
+                    entries.append((float(before), int(offset)))
+            except (ValueError, IndexError):
+                return cls(path, key, interval)
+        finally:
+            f.close()
+        index.size = int(size)
+        index.mtime = float(mtime)
+        index.last_bucket = last_bucket != '-' and int(last_bucket) or None
+        index.last_seen = float(last_seen)
+        index.entries = entries
+        return index
+    load = classmethod(load)
+
+    def save(self, filename):
+        f = AtomicFile(filename, 'wb')
+        try:
+            f.write('%s %d %s %d %d %r %s %r\n'%(MAGIC, VERSION, self.key,
+                self.interval, self.size, self.mtime,
+                self.last_bucket is None and '-' or self.last_bucket,
+                self.last_seen))
+            for before, offset in self.entries:
+                f.write('%r %d\n'%(before, offset))
+        finally:
+            f.close()
+
+    def is_current(self, st):
+        """True if the index covers the file as described by os.stat()"""
+        return self.size == st.st_size and self.mtime == st.st_mtime
+
+    def update(self, st, timestamp):
+        """Bring the index up to date with the log file.  timestamp is a
+        function returning the aware datetime of a raw line, or None.
+        Returns False if the index was already current."""
+        if self.is_current(st):
+            return False
+        if st.st_size < self.size or st.st_size == self.size:
+            # truncated or rewritten in place
+            self.__init__(self.path, self.key, self.interval)
+        f = open(self.path, 'rb')
+        try:
+            f.seek(self.size)
+            offset = self.size
+            for line in f:
+                if not line.endswith('\n'):
+                    # partially written, index it next time
+                    break
+                dt = timestamp(line)
+                if dt is not None:
+                    seconds = epoch(dt)
+                    bucket = int(seconds // self.interval)
+                    if bucket != self.last_bucket:
+                        self.entries.append((self.last_seen, offset))
+                        self.last_bucket = bucket
+                    self.last_seen = max(self.last_seen, seconds)
+                offset += len(line)
+        finally:
+            f.close()
+        self.size = offset
+        self.mtime = st.st_mtime
+        return True
+
+    def seek(self, start):
+        """Byte offset to start reading at to get every line from start on.
+        start is an aware datetime."""
+        i = bisect_right(self.entries, (epoch(start), -1))
+        if i <= 1:
+            # the first entry is the first timestamp, the lines before it
+            # go with the start of the file
+            return 0
+        return self.entries[i-1][1]
@@ -0,0 +1,98 @@
+"""
+Parse the days of a long range of file logs in parallel.  Reindexing years
+of a channel is CPU bound, and each day's files can be parsed on their own,
+so filesets are handed to a pool of worker processes and their events come
+back in order through a bounded reorder buffer.
+
+Needs the multiprocessing module, python 2.6 or later.
+"""
+
+# Copyright (c) 2009, Robert Corsaro
+
+from pytz import UTC
+
+from irclogs.api import merge_iseq
+from irclogs.provider.archive import open_log
+from irclogs.provider.cache import to_pairs
+from irclogs.provider.file import CompiledFormat
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+# CompiledFormats of a worker process, by fingerprint
+_formats = {}
+
+def parse_fileset(task):
+    """Pool worker: parse the existing log files of one day, given as
+    (paths, format dict, EventFilter or None), and merge them.  Returns
+    (epoch, event) pairs with UTC epochs, which are much cheaper to send 
+    back than datetimes."""
+    paths, format, filter = task
+    fingerprint = CompiledFormat.fingerprint(format)
+    compiled = _formats.get(fingerprint)
+    if compiled is None:
+        compiled = _formats[fingerprint] = CompiledFormat(format)
+    files = [open_log(path) for path in paths]
+    def _key(x):
+        return x.get('timestamp')
+    parsers = [compiled.parse_lines(f, UTC, filter=filter) for f in files]
+    pairs = to_pairs(merge_iseq(parsers, _key))
+    for f in files:
+        f.close()
+    return pairs
+
+def cpu_count():
+    if multiprocessing is None:
+        return 1
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class OrderedResults(object):
+    """Iterate over func(task) for each of tasks, computed by a process
+    pool, in task order.  No more than window tasks are submitted ahead of
+    the one being waited for, which bounds the memory held by results that
+    finished out of order.  The pool is shut down when iteration ends or
+    the iterator is dropped."""
+
+    def __init__(self, func, tasks, workers, window=None):
+        self.func = func
+        self.tasks = iter(tasks)
+        self.window = window or workers * 2
+        self.pending = []
+        self.pool = multiprocessing.Pool(workers)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self.pool and len(self.pending) < self.window:
+            try:
+                task = self.tasks.next()
+            except StopIteration:
+                break
+            self.pending.append(self.pool.apply_async(self.func, (task,)))
+        if not self.pending:
+            self.close()
+            raise StopIteration
+        try:
+            return self.pending.pop(0).get()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self.pool is not None:
+            # terminate() can deadlock on python 2 if a worker is killed
+            # while it holds the result queue, so let the tasks in flight,
+            # at most window of them, finish instead
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.pending = []
+
+    def __del__(self):
+        self.close()
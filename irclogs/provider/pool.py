@@ -0,0 +1,179 @@
+"""
+Pooled connections to chatlog databases.  Every channel can have its own
+database, so there is one ConnectionPool per connection URI, and opening a
+connection for every request, which costs a TCP and auth round trip on most
+servers, only happens when the pool is empty.
+"""
+
+# Copyright (c) 2009, Robert Corsaro
+
+import re
+import threading
+import time
+
+from trac.db.pool import TimeoutError
+
+def safe_uri(uri):
+    """uri without its password, for logging."""
+    return re.sub(r'(://[^:/@]*:)[^@]*@', r'\1***@', uri)
+
+class PooledConnection(object):
+    """A connection checked out of a ConnectionPool.  It behaves like the
+    connection, except that close() gives it back to the pool."""
+
+    def __init__(self, pool, cnx):
+        self._pool = pool
+        self.cnx = cnx
+
+    def __getattr__(self, name):
+        return getattr(self.cnx, name)
+
+    def close(self):
+        if self.cnx is not None:
+            cnx = self.cnx
+            self.cnx = None
+            self._pool._release(cnx)
+
+    def __del__(self):
+        self.close()
+
+class ConnectionPool(object):
+    """At most maxsize connections made by connect(), a function taking no
+    arguments.  Connections are handed out most recently used first, so
+    the ones that sit idle for idle_timeout seconds can be closed.  Ones
+    that were idle for check_interval seconds or more are checked with a
+    trivial query before they're handed out, and replaced if it fails,
+    since servers drop idle clients.
+
+    Connections are rolled back when they're given back.  get() waits for
+    one to be given back if all of them are in use."""
+
+    def __init__(self, connect, maxsize=5, idle_timeout=600,
+                 check_interval=30, name='', log=None):
+        self.connect = connect
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.name = name
+        self.log = log
+        # (connection, time it was given back), oldest first
+        self._idle = []
+        self._active = 0
+        self._available = threading.Condition(threading.Lock())
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.waits = 0
+
+    def get(self, timeout=None):
+        """A PooledConnection.  Raises TimeoutError if none is available
+        within timeout seconds."""
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
+        self._available.acquire()
+        try:
+            while True:
+                now = time.time()
+                self._prune(now)
+                if self._idle:
+                    cnx, since = self._idle.pop()
+                    break
+                if self._active < self.maxsize:
+                    cnx = since = None
+                    break
+                if deadline is not None and now >= deadline:
+                    raise TimeoutError("no connection to %s available "\
+                            "within %d seconds"%(self.name, timeout))
+                self.waits += 1
+                if deadline is None:
+                    self._available.wait()
+                else:
+                    self._available.wait(deadline - now)
+            self._active += 1
+        finally:
+            self._available.release()
+        # connecting and checking can be slow, don't hold up other threads
+        try:
+            if cnx is not None and now - since >= self.check_interval and \
+                    not self._healthy(cnx):
+                cnx = None
+            if cnx is None:
+                cnx = self.connect()
+        except:
+            self._release(None)
+            raise
+        self._available.acquire()
+        try:
+            if since is not None and cnx is not None:
+                self.reused += 1
+            else:
+                self.created += 1
+        finally:
+            self._available.release()
+        return PooledConnection(self, cnx)
+
+    def _healthy(self, cnx):
+        try:
+            cursor = cnx.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            return True
+        except Exception, e:
+            if self.log:
+                self.log.info("discarding broken connection to %s: %s"%(
+                    self.name, e))
+            self._close(cnx)
+            self._available.acquire()
+            try:
+                self.discarded += 1
+            finally:
+                self._available.release()
+            return False
+
+    def _release(self, cnx):
+        """Take back cnx, or make room for a new one if it's None."""
+        if cnx is not None:
+            try:
+                cnx.rollback()
+            except Exception:
+                self._close(cnx)
+                cnx = None
+        self._available.acquire()
+        try:
+            self._active -= 1
+            if cnx is not None:
+                self._idle.append((cnx, time.time()))
+            self._available.notify()
+        finally:
+            self._available.release()
+
+    def _prune(self, now):
+        """Close the connections idle for too long.  Called with the lock
+        held."""
+        while self._idle and now - self._idle[0][1] >= self.idle_timeout:
+            cnx, since = self._idle.pop(0)
+            self._close(cnx)
+            self.discarded += 1
+
+    def _close(self, cnx):
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+    def shutdown(self):
+        """Close the idle connections."""
+        self._available.acquire()
+        try:
+            for cnx, since in self._idle:
+                self._close(cnx)
+            self._idle = []
+        finally:
+            self._available.release()
+
+    def stats(self):
+        return 'chatlog connections to %s: %d in use, %d idle, %d created, '\
+                '%d reused, %d discarded, %d waits'%(self.name, self._active,
+                len(self._idle), self.created, self.reused, self.discarded,
+                self.waits)
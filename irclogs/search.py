@@ -1,17 +1,19 @@
 from datetime import datetime
 from os import path
+import re
 from pytz import timezone, UTC
-from time import strftime, strptime, gmtime, mktime, tzset
+from time import strftime, strptime, gmtime, mktime, time, tzset
 import os
 import sys
 
 from trac.util.datefmt import localtz
 from trac.core import *
-from trac.search import ISearchSource
+from trac.search import ISearchSource, shorten_result
 from trac.config import Option, IntOption
+from trac.db.api import _parse_db_str
 
 import web_ui
-from api import IIRCLogIndexer, IRCChannelManager
+from api import EventFilter, IIRCLogIndexer, IRCChannelManager
 
 whoosh_loaded = False
 try:
@@ -25,6 +27,162 @@ except Exception, e:
             "WARNING: Failed to load whoosh library.  Whoosh index disabled")
     sys.__stderr__.write(e.message)
 
+class ChatlogSearch(Component):
+    """Search the chatlog tables of db channels with the database's own
+    full text search, so results don't wait for an index update and no 
+    separate index is kept.  SQLite needs FTS5 and PostgreSQL a GIN index,
+    both set up by `trac-admin <env> irclogs fulltext`.
+
+    Only comments and actions of channels the user may view are searched,
+    the channels are part of the query.  Channels of databases without full
+    text search are left to the whoosh index."""
+
+    implements(ISearchSource)
+
+    search_config = Option('irclogs', 'db_search_config', 'simple',
+        doc="""PostgreSQL text search configuration of chatlog messages.
+        Run `trac-admin <env> irclogs fulltext` again after changing it.""")
+
+    search_limit = IntOption('irclogs', 'db_search_limit', 200,
+        doc="""Most chatlog search results from each database, newest 
+        first.""")
+
+    # seconds until databases without full text search are checked again
+    recheck_interval = 60
+
+    def __init__(self):
+        self._fulltext = {}
+
+    # ISearchSource methods
+    def get_search_filters(self, req):
+        if whoosh_loaded and self.env.is_component_enabled(WhooshIrcLogsIndex):
+            # it already offers the filter, and leaves db channels to us
+            return []
+        if self._channels(req):
+            return [('irclogs', 'IRC Logs', True)]
+        return []
+
+    def get_search_results(self, req, terms, filters):
+        if not 'irclogs' in filters or not terms:
+            return
+        chmgr = IRCChannelManager(self.env)
+        for ch, timestamp, nick, type, msg in self.search(
+                self._channels(req), terms):
+            dt = chmgr.to_user_tz(req, timestamp)
+            if type == 'action':
+                content = "* %s %s"%(nick, msg.lstrip('* '))
+            else:
+                content = "<%s> %s"%(nick, msg)
+            href = req.href.irclogs(ch.name(), '%04d'%(dt.year), 
+                    '%02d'%(dt.month), '%02d'%(dt.day))
+            yield "%s#%02d:%02d:%02d"%(href, dt.hour, dt.minute, dt.second), \
+                  'irclogs for %s'%(ch.channel()), dt, nick, \
+                  shorten_result(content, terms)
+
+    def _channels(self, req):
+        return [ch for ch in IRCChannelManager(self.env).channels() 
+                if req.perm.has_permission(ch.perm()) and self.searches(ch)]
+
+    def searches(self, channel):
+        """True if channel is searched here, a db channel whose database has
+        full text search set up.  That's checked once per database, and
+        again after recheck_interval for those that don't have it."""
+        if channel.provider() != 'db':
+            return False
+        from irclogs.provider.db import DBIRCLogProvider
+        uri = DBIRCLogProvider(self.env)._database(channel)
+        has, checked = self._fulltext.get(uri, (False, None))
+        if has or checked is not None and \
+                time() - checked < self.recheck_interval:
+            return has
+        has = self._has_fulltext(uri)
+        self._fulltext[uri] = has, time()
+        return has
+
+    def _has_fulltext(self, uri):
+        from irclogs.admin import has_fulltext
+        from irclogs.provider.db import IRCLogDatabaseManager
+        try:
+            cnx = IRCLogDatabaseManager(self.env).connect(uri)
+            try:
+                return has_fulltext(cnx, _parse_db_str(uri)[0])
+            finally:
+                cnx.close()
+        except Exception, e:
+            self.log.warn("can't tell if chatlog search is set up: %s"%(e))
+            return False
+
+    def search(self, channels, terms):
+        """Yield (channel, timestamp, nick, type, message) of the comments
+        and actions of channels matching all terms, newest first, at most
+        db_search_limit from each database."""
+        from irclogs.provider.db import DBIRCLogProvider, \
+                IRCLogDatabaseManager
+        provider = DBIRCLogProvider(self.env)
+        databases = {}
+        for ch in channels:
+            databases.setdefault(provider._database(ch), []).append(ch)
+        for uri, chs in databases.items():
+            scheme = _parse_db_str(uri)[0]
+            sql, args = self._query(scheme, chs, terms)
+            if sql is None:
+                self.log.warn("chatlog search isn't supported on %s "\
+                        "databases"%(scheme))
+                continue
+            byname = dict([((ch.network() or '', ch.channel()), ch) 
+                           for ch in chs])
+            cnx = IRCLogDatabaseManager(self.env).connect(uri)
+            try:
+                try:
+                    cur = cnx.cursor()
+                    cur.execute(sql, args)
+                    rows = cur.fetchall()
+                finally:
+                    cnx.close()
+            except Exception, e:
+                self.log.warn("chatlog search failed, has `trac-admin "\
+                        "<env> irclogs fulltext` been run? %s"%(e))
+                continue
+            for when, network, target, nick, type, msg in rows:
+                ch = byname[(network, target)]
+                tz = provider._timezones(ch, UTC.localize(when))[0]
+                yield ch, tz.localize(when), nick, type, msg
+
+    def _query(self, scheme, channels, terms):
+        """The SQL and arguments of a search of the chatlog of channels, or
+        None, None if the database isn't supported."""
+        args = []
+        if scheme == 'sqlite':
+            sql = """
+              SELECT c."time", c.network, c.target, c.nick, c.type, c.msg
+              FROM chatlog_fts JOIN chatlog c ON c.id = chatlog_fts.rowid
+              WHERE chatlog_fts MATCH %s"""
+            # each term a phrase, all of them must match
+            args.append(' '.join(['"%s"'%(t.replace('"', '""')) 
+                                  for t in terms]))
+        elif scheme == 'postgres':
+            from irclogs.admin import postgres_tsvector
+            config = self.search_config
+            if not re.match(r'^\w+$', config):
+                raise TracError("Invalid text search configuration %s"%(
+                    config))
+            sql = """
+              SELECT c."time", c.network, c.target, c.nick, c.type, c.msg
+              FROM chatlog c
+              WHERE %s @@ plainto_tsquery('%s'::regconfig, %%s)"""%(
+                    postgres_tsvector(config, 'c.msg'), config)
+            args.append(' '.join(terms))
+        else:
+            return None, None
+        sql += " AND c.type IN ('comment', 'action') AND (%s)"%(
+                ' OR '.join(['(c.network = %s AND c.target = %s)'] * 
+                            len(channels)))
+        for ch in channels:
+            args.extend([ch.network() or '', ch.channel()])
+        sql += ' ORDER BY c."time" DESC LIMIT %s'
+        args.append(self.search_limit)
+        return sql, args
+
 if whoosh_loaded:
     class WhooshIrcLogsIndex(Component):
         implements(ISearchSource)
@@ -78,7 +236,8 @@ if whoosh_loaded:
                 url = '/irclogs/%s%s'%(channel, d_str)
                 if not permcache.has_key(channel):
                     chobj = chmgr.channel(result['channel'])
-                    permcache[channel] = req.perm.has_permission(chobj.perm())
+                    permcache[channel] = req.perm.has_permission(
+                            chobj.perm()) and not self._searched_in_db(chobj)
                 if permcache[channel]:
                     yield "%s#%s"%(req.href(url), t_str), \
                         'irclogs for %s'%result['channel'], dt, \
@@ -92,8 +251,12 @@ if whoosh_loaded:
             writer = idx.writer()
             try:
                 chmgr = IRCChannelManager(self.env)
+                only = EventFilter(types=('comment', 'action'))
                 for channel in chmgr.channels():
-                    for line in channel.events_in_range(last_index_dt, now):
+                    if self._searched_in_db(channel):
+                        continue
+                    for line in channel.events_in_range(last_index_dt, now,
+                            parallel=True, filter=only):
                         if line['type'] == 'comment': 
                             content = "<%s> %s"%(line['nick'], 
                                     line['comment'])
@@ -128,6 +291,11 @@ if whoosh_loaded:
                 idx.close()
                 raise e
 
+        def _searched_in_db(self, channel):
+            """True if ChatlogSearch searches the channel instead."""
+            return self.env.is_component_enabled(ChatlogSearch) and \
+                    ChatlogSearch(self.env).searches(channel)
+
         def get_index(self):
             ip = self.indexpath
             if not self.indexpath.startswith('/'):
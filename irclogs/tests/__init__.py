@@ -1,10 +1,11 @@
 import unittest
 
 def suite():
-    from irclogs.tests import search, file_parser, api
+    from irclogs.tests import search, file_parser, api, db
     suite = unittest.TestSuite()
     suite.addTest(api.suite())
     suite.addTest(file_parser.suite())
+    suite.addTest(db.suite())
     suite.addTest(search.suite())
     return suite
 
@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
+import time
 import unittest
 from time import strptime
-from datetime import datetime
+from datetime import datetime, timedelta
 from pytz import timezone, UTC
 
 from trac.core import *
 from trac.test import EnvironmentStub, Mock
 
-from irclogs.api import IRCChannelManager 
+from irclogs.api import IRCChannelManager, IRCEvent, EVENT_TYPES, \
+        EventFilter, event_cursor, format_cursor, page_events, parse_cursor, \
+        resume_start
+from irclogs.web_ui import IrcLogsView
 
 class ApiTestCase(unittest.TestCase):
     def setUp(self):
@@ -73,6 +77,230 @@ class ApiTestCase(unittest.TestCase):
         nydt2 = NYC.normalize(udt.astimezone(NYC))
         self.assertEqual(nydt, nydt2)
 
+    def test_event(self):
+        e = IRCEvent({'type': u'comment', 'nick': u'bob', 'comment': u'hi',
+                      'message': u'<bob> hi'})
+        self.assertEqual('comment', e['type'])
+        self.assertEqual(1, e.code)
+        self.assertEqual(u'bob', e['nick'])
+        self.assertEqual(None, e.get('timestamp'))
+        self.failIf('timestamp' in e)
+        self.assertRaises(KeyError, lambda: e['kicked'])
+        # keys without a slot
+        e.update({'hidden': True})
+        e['kicked'] = u'alice'
+        self.assert_('kicked' in e)
+        self.assertEqual(u'alice', e.pop('kicked'))
+        self.failIf('kicked' in e)
+        self.assertEqual({'type': 'comment', 'nick': u'bob', 'comment': u'hi',
+                          'message': u'<bob> hi', 'hidden': True}, dict(e))
+        self.assertEqual(dict(e), e)
+        self.assertEqual('<%(nick)s> %(comment)s'%e, u'<bob> hi')
+        # copies are independent
+        c = e.copy()
+        c['nick'] = u'carol'
+        c['hidden'] = False
+        self.assertEqual(u'bob', e['nick'])
+        self.assertEqual(True, e['hidden'])
+        self.assertNotEqual(c, e)
+        # custom types get codes of their own
+        e['type'] = 'custom-type'
+        self.assertEqual('custom-type', EVENT_TYPES[e.code])
+        # pickled by type name
+        import pickle
+        for protocol in (0, 2):
+            self.assertEqual(e, pickle.loads(pickle.dumps(e, protocol)))
+
+    def test_last_events(self):
+        events = [IRCEvent(timestamp=UTC.localize(datetime(2009, 3, 8, h)),
+                           type='comment', nick='bob') for h in range(10)]
+        def events_in_range(channel, start, end):
+            return [e for e in events if start <= e['timestamp'] < end]
+        provider = Mock(get_events_in_range=events_in_range)
+        self.out.provider = lambda name: provider
+        c = self.out.channel('test2')
+        end = UTC.localize(datetime(2009, 3, 8, 5))
+        self.assertEqual(events[2:5], c.last_events(end, 3))
+        self.assertEqual(events[:5], c.last_events(end, 10))
+        # quiet channels give all they have
+        end = UTC.localize(datetime(2009, 3, 8, 7))
+        self.assertEqual(events[:7], c.last_events(end, 10))
+        view = IrcLogsView(self.env)
+        self.assertEqual(events[:7], view._last_lines(c, end, 10))
+        self.assertEqual([], view._last_lines(c, end, 0))
+        channels = [c, self.out.channel('test3')]
+        self.assertEqual(14, len(view._merged_last_lines(channels, end, 20)))
+        self.assertEqual(10, len(view._merged_last_lines(channels, end, 10)))
+        provider.get_last_events = lambda channel, end, count: events[:count]
+        self.assertEqual(events[:3], c.last_events(end, 3))
+
+    def test_pages(self):
+        t = [UTC.localize(datetime(2009, 3, 8, 12, 0, s)) for s in (0, 1, 1)]
+        events = [IRCEvent(timestamp=t[0], type='comment'), 
+                  IRCEvent(type='other'),
+                  IRCEvent(timestamp=t[1], type='comment'),
+                  IRCEvent(type='other'),
+                  IRCEvent(timestamp=t[2], type='comment')]
+        self.assertEqual(events[:2], list(page_events(events, limit=2)))
+        self.assertEqual([], list(page_events(events, limit=0)))
+        cursor = event_cursor(events[:4])
+        self.assertEqual((t[1], 2), cursor)
+        # resumed reads start at the cursor's timestamp
+        self.assertEqual(events[4:], 
+                list(page_events(events[1:], after=cursor)))
+        self.assertEqual((t[1], 3), event_cursor(events[4:], cursor))
+        self.assertEqual((None, 1), event_cursor(events[1:2]))
+        start = timezone('America/New_York').localize(datetime(2009, 3, 8))
+        self.assertEqual(t[1], resume_start(start, cursor))
+        self.assertEqual('America/New_York', 
+                resume_start(start, cursor).tzinfo.zone)
+        self.assertEqual(start, resume_start(start, (None, 3)))
+
+    def test_old_provider_pages(self):
+        t = [UTC.localize(datetime(2009, 3, 8, 12, 0, s)) for s in range(5)]
+        events = [IRCEvent(timestamp=ts, type='comment') for ts in t]
+        def events_in_range(channel, start, end):
+            return [e for e in events if start <= e['timestamp'] < end]
+        self.out.provider = lambda name: Mock(
+                get_events_in_range=events_in_range)
+        c = self.out.channel('test2')
+        end = t[0] + timedelta(days=1)
+        page = list(c.events_in_range(t[0], end, limit=2))
+        self.assertEqual(events[:2], page)
+        cursor = event_cursor(page)
+        page = list(c.events_in_range(t[0], end, limit=2, after=cursor))
+        self.assertEqual(events[2:4], page)
+        cursor = event_cursor(page, cursor)
+        self.assertEqual(events[4:], 
+                list(c.events_in_range(t[0], end, limit=2, after=cursor)))
+        self.assertEqual(events, list(c.events_in_range(t[0], end)))
+
+    def test_old_provider_filters(self):
+        t = [UTC.localize(datetime(2009, 3, 8, 12, 0, s)) for s in range(6)]
+        events = [IRCEvent(timestamp=ts, type=('comment', 'join')[i % 2])
+                  for i, ts in enumerate(t)]
+        def events_in_range(channel, start, end):
+            return [e for e in events if start <= e['timestamp'] < end]
+        provider = Mock(get_events_in_range=events_in_range,
+                        get_events_in_range_parallel=events_in_range)
+        self.out.provider = lambda name: provider
+        c = self.out.channel('test2')
+        end = t[0] + timedelta(days=1)
+        only = EventFilter(types=['comment'])
+        self.assertEqual(events[::2], 
+                list(c.events_in_range(t[0], end, filter=only)))
+        self.assertEqual(events[::2], list(c.events_in_range(t[0], end, 
+                                           parallel=True, filter=only)))
+        # pages are counted after filtering
+        page = list(c.events_in_range(t[0], end, limit=2, filter=only))
+        self.assertEqual(events[0:4:2], page)
+        self.assertEqual(events[4:5], list(c.events_in_range(t[0], end, 
+                limit=2, after=event_cursor(page), filter=only)))
+
+    def test_cursor_format(self):
+        for cursor in ((UTC.localize(datetime(2009, 3, 8, 12, 0, 1, 5)), 3),
+                       (UTC.localize(datetime(1970, 1, 1)), 0),
+                       (None, 2)):
+            self.assertEqual(cursor, parse_cursor(format_cursor(cursor)))
+        for text in ('', '12', 'a_1', '12_b', '12_-1', '1_2_3'):
+            self.assertRaises(ValueError, parse_cursor, text)
+
+    def test_snapshots(self):
+        c = self.out.channel('test2')
+        self.assert_(self.out.snapshot('test2') is self.out.snapshot('test2'))
+        self.assert_(c.settings() is self.out.channel('test2').settings())
+        self.assertRaises(TypeError, c.settings().__setitem__, 'perm', 'X')
+        self.assertRaises(TypeError, c.format().update, {'perm': 'X'})
+        self.assertEqual('IRCLOGS_VIEW', c.perm())
+        # changes made in memory are seen by channels got afterwards
+        self.config.set('irclogs', 'channel.test2.perm', 'TEST2_VIEW')
+        self.assertEqual('IRCLOGS_VIEW', c.perm())
+        c = self.out.channel('test2')
+        self.assertEqual('TEST2_VIEW', c.perm())
+        self.assertEqual('TEST2_VIEW', c.format()['perm'])
+        self.assert_(c.settings() is self.out.channel('test2').settings())
+        # and so is a reread trac.ini
+        snapshot = self.out.snapshot('test2')
+        self.config._lastmtime += 1
+        self.assert_(snapshot is not self.out.snapshot('test2'))
+        self.config.set('irclogs', 'channel.test5.format', 'gozer')
+        self.assertEqual('test5', self.out.channel('test5').name())
+        self.assertEqual(None, self.out.channel('test6').name())
+
+    def test_registry(self):
+        self.assertEqual([None, 'test2', 'test3', 'test4'],
+                sorted(self.out.channel_names()))
+        channels = list(self.out.channels())
+        self.assertEqual([c.name() for c in channels],
+                list(self.out.channel_names()))
+        self.assert_(channels[0] is list(self.out.channels())[0])
+        self.assert_(self.out.channel('test3') is self.out.channel('test3'))
+        # all unknown channels are the default one
+        self.assert_(self.out.channel('crap') is self.out.channel(None))
+        registry = self.out.registry()
+        self.assert_(registry is self.out.registry())
+        self.config.set('irclogs', 'channel.test5.channel', '#test5')
+        self.assert_(registry is not self.out.registry())
+        self.assertEqual('#test5', self.out.channel('test5').channel())
+        self.config.remove('irclogs', 'channel')
+        self.assertEqual(['test2', 'test3', 'test4', 'test5'],
+                sorted(self.out.channel_names()))
+
+    def test_providers(self):
+        from irclogs.provider.db import DBIRCLogProvider
+        from irclogs.provider.file import FileIRCLogProvider
+        env = EnvironmentStub(enable=['irclogs.*'])
+        chmgr = IRCChannelManager(env)
+        self.assert_(chmgr.provider('file') is FileIRCLogProvider(env))
+        self.assert_(chmgr.provider('db') is DBIRCLogProvider(env))
+        self.assertRaises(Exception, chmgr.provider, 'nope')
+
+    def test_merged_events(self):
+        t = [UTC.localize(datetime(2009, 3, 8, 12, 0, s)) for s in range(6)]
+        logs = {
+            '#test2': [IRCEvent(timestamp=t[0], type='comment'),
+                       IRCEvent(type='other'),
+                       IRCEvent(timestamp=t[3], type='comment')],
+            '#test3': [IRCEvent(timestamp=t[1], type='join'),
+                       IRCEvent(timestamp=t[2], type='comment'),
+                       IRCEvent(timestamp=t[5], type='comment')],
+        }
+        started = []
+        concurrent = []
+        def events_in_range(channel, start, end, filter=None):
+            # the first one only sees the second if they're read together
+            started.append(channel.channel())
+            for i in range(200):
+                if len(started) >= 2:
+                    break
+                time.sleep(0.01)
+            concurrent.append(len(started) >= 2)
+            for e in logs[channel.channel()]:
+                if filter is None or filter(e):
+                    yield e
+        self.out.provider = lambda name: Mock(
+                get_events_in_range=events_in_range)
+        end = t[0] + timedelta(days=1)
+        events = list(self.out.merged_events(['test2', 'test3'], t[0], end))
+        self.assertEqual([logs['#test2'][0], logs['#test2'][1],
+                          logs['#test3'][0], logs['#test3'][1],
+                          logs['#test2'][2], logs['#test3'][2]], events)
+        self.assertEqual(['test2', 'test2', 'test3', 'test3', 'test2',
+                          'test3'], [e['source'] for e in events])
+        self.assertEqual([True, True], concurrent)
+        # a single channel is read as is
+        channel = self.out.channel('test3')
+        events = list(self.out.merged_events([channel], t[0], end,
+                      filter=EventFilter(types=['comment'])))
+        self.assertEqual(logs['#test3'][1:], events)
+        # errors reach the reader
+        def broken(channel, start, end, filter=None):
+            yield IRCEvent(timestamp=t[0], type='comment')
+            raise ValueError('broken')
+        self.out.provider = lambda name: Mock(get_events_in_range=broken)
+        events = self.out.merged_events(['test2', 'test3'], t[0], end)
+        self.assertRaises(ValueError, list, events)
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ApiTestCase, 'test'))
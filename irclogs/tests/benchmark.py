@@ -0,0 +1,526 @@
+"""
+Micro benchmarks for the irclogs parsing paths.  These are not part of the
+test suite, run them by hand when touching the hot paths.
+
+Usage: python irclogs/tests/benchmark.py [benchmark ...]
+"""
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+from trac.test import EnvironmentStub
+
+from irclogs.api import IRCChannelManager
+from irclogs.provider.file import FileIRCLogProvider
+
+# line templates for each built-in format.  Comments dominate, like they do
+# in real channels.
+CORPORA = {
+    'supy': ('%Y-%m-%dT%H:%M:%S', (
+        '%s  <rcorsaro> will it work if I install it?',
+        '%s  <dgynn> ok.  i copied it over',
+        '%s  <cbalan> it works for me',
+        '%s  <rcorsaro> great, thanks',
+        '%s  * cbalan feels lonely...',
+        '%s  *** dgynn has joined #etf',
+        '%s  *** dgynn has left #etf',
+        '%s  *** dgynn has quit IRC',
+        '%s  *** rcorsaro is now known as bobby-robert',
+        '%s  -rcorsaro- hello there',
+        '* SOME SPECIAL MESSAGE *',
+    )),
+    'gozer': ('%Y-%m-%d %H:%M:%S', (
+        '%s | <rcorsaro> !chatlog-on',
+        '%s | <gozerbot> chatlog enabled on (default,#test2)',
+        '%s | <cbalan> it works for me',
+        '%s | <rcorsaro> great, thanks',
+        '%s | * rcorsaro feels strange',
+        '%s | gozerbot (gozerbot@opt-FAD2E711.verizon.net) has joined',
+        '%s | gozerbot (gozerbot@opt-FAD2E711.verizon.net) has left',
+        '%s | rcorsaro (Robert@opt-FAD2E711.verizon.net) has quit: Quit',
+        '%s | rcorsaro2 changes topic to "testing topic"',
+        '%s | -rcorsaro- hello there',
+        '* SOME SPECIAL MESSAGE *',
+    )),
+    'bip': ('%d-%m-%Y %H:%M:%S', (
+        '%s < rcorsaro!~r@host: will it work if I install it?',
+        '%s < dgynn!~d@host: ok.  i copied it over',
+        '%s < cbalan!~c@host: it works for me',
+        '%s < rcorsaro!~r@host: great, thanks',
+        '%s > * bobby!~r@host waves',
+        '%s -!- rcorsaro!~r@host has joined #test',
+        '%s -!- rcorsaro!~r@host has left #test [bye]',
+        '%s -!- rcorsaro!~r@host has quit [leaving]',
+        '%s -!- rcorsaro is now known as bobby',
+        '%s -!- mode/#test [+o rcorsaro] by bobby!~r@host',
+        '* SOME SPECIAL MESSAGE *',
+    )),
+}
+
+def corpus(name, count=20000, start=datetime(2009, 3, 8, 0, 0, 0)):
+    """count raw log lines of the named format, one second apart."""
+    tsformat, templates = CORPORA[name]
+    lines = []
+    delta = timedelta(seconds=1)
+    dt = start
+    for i in xrange(count):
+        template = templates[i % len(templates)]
+        if '%s' in template:
+            template = template%(dt.strftime(tsformat))
+        lines.append(template + '\n')
+        dt += delta
+    return lines
+
+def setup(name, options=None):
+    """Environment and channel set up to parse the named format, with the
+    extra irclogs options.  Channels keep the settings they were got with,
+    so they must all be set here."""
+    env = EnvironmentStub()
+    env.config.set('irclogs', 'channel.bench.channel', '#bench')
+    env.config.set('irclogs', 'channel.bench.format', name)
+    for option, value in (options or {}).items():
+        env.config.set('irclogs', option, value)
+    chmgr = IRCChannelManager(env)
+    return env, chmgr.channel('bench')
+
+def best_of(func, repeat=3):
+    """Best wall clock time of repeat calls to func."""
+    best = None
+    for i in range(repeat):
+        t = default_timer()
+        func()
+        t = default_timer() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+def report(label, count, seconds, baseline=None, unit='lines'):
+    line = '  %-28s %8.3fs %10d %s/s'%(label, seconds, count / seconds, unit)
+    if baseline:
+        line += '  x%.2f'%(baseline / seconds)
+    print line
+
+def bench_classifier():
+    """match_order regex loop vs. the marker dispatch classifier."""
+    for name in sorted(CORPORA):
+        env, channel = setup(name)
+        format = FileIRCLogProvider(env)._compiled_format(channel)
+        lines = [unicode(l.rstrip('\r\n')) for l in corpus(name)]
+        def _loop():
+            for line in lines:
+                format.classify_loop(line)
+        def _dispatch():
+            for line in lines:
+                format.classify(line)
+        print '%s:'%(name)
+        loop = best_of(_loop)
+        report('match_order loop', len(lines), loop)
+        report('marker dispatch', len(lines), best_of(_dispatch), loop)
+
+def bench_timestamps():
+    """strptime/localize/normalize per line vs. TimestampDecoder."""
+    from pytz import timezone
+    target = timezone('America/Los_Angeles')
+    for name in sorted(CORPORA):
+        env, channel = setup(name, 
+                {'channel.bench.timezone': 'America/New_York'})
+        format = FileIRCLogProvider(env)._compiled_format(channel)
+        stamps = []
+        for line in corpus(name):
+            result = format.classify(unicode(line.rstrip('\r\n')))
+            if result and result['timestamp']:
+                stamps.append(result['timestamp'])
+        def _strptime():
+            for tsstr in stamps:
+                format.parse_timestamp(tsstr, target)
+        def _decoder():
+            decode = format.decoder(target)
+            for tsstr in stamps:
+                decode(tsstr)
+        print '%s (across a DST transition):'%(name)
+        slow = best_of(_strptime)
+        report('strptime', len(stamps), slow)
+        report('TimestampDecoder', len(stamps), best_of(_decoder), slow)
+
+def bench_reader():
+    """line by line reading vs. the mmap reader, for a whole day and for
+    an hour of it."""
+    from pytz import UTC
+    from irclogs.provider.file import map_file, close_map
+    for name in sorted(CORPORA):
+        env, channel = setup(name, {'channel.bench.charset': 'utf-8'})
+        provider = FileIRCLogProvider(env)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'day.log')
+            lines = corpus(name, 86400)
+            f = open(path, 'w')
+            f.writelines(lines)
+            f.close()
+            start = datetime(2009, 3, 8, 12, 0, 0, tzinfo=UTC)
+            end = start + timedelta(hours=1)
+            def _lines(start=None, end=None):
+                f = open(path)
+                for event in provider.parse_lines(f, channel, UTC):
+                    if start and event.get('timestamp') and \
+                            not start <= event['timestamp'] < end:
+                        continue
+                f.close()
+            def _mmap(start=None, end=None):
+                f = open(path)
+                buf = map_file(f)
+                for event in provider.parse_buffer(buf, channel, UTC, 
+                                                   start, end):
+                    pass
+                close_map(buf)
+                f.close()
+            print '%s, %d lines:'%(name, len(lines))
+            slow = best_of(_lines)
+            report('lines, day', len(lines), slow)
+            report('mmap, day', len(lines), best_of(_mmap), slow)
+            slow = best_of(lambda: _lines(start, end))
+            report('lines, hour', len(lines), slow)
+            report('mmap, hour', len(lines), 
+                    best_of(lambda: _mmap(start, end)), slow)
+        finally:
+            shutil.rmtree(tmpdir)
+
+def bench_memory():
+    """bytes per parsed event held by a 40000 line day, dicts vs. 
+    IRCEvents.  Only the containers are counted, the field values are the
+    same objects either way."""
+    from pytz import UTC
+    for name in sorted(CORPORA):
+        env, channel = setup(name)
+        provider = FileIRCLogProvider(env)
+        events = list(provider.parse_lines(corpus(name, 40000), channel, UTC))
+        dicts = [dict(e) for e in events]
+        def _size(event):
+            size = sys.getsizeof(event)
+            if getattr(event, '_extra', None) is not None:
+                size += sys.getsizeof(event._extra)
+            return size
+        before = sum(map(_size, dicts))
+        after = sum(map(_size, events))
+        print '%s, %d events:'%(name, len(events))
+        print '  %-28s %10d bytes %6d per event'%('dict', before, 
+                before / len(events))
+        print '  %-28s %10d bytes %6d per event  x%.2f'%('IRCEvent', after,
+                after / len(events), float(before) / after)
+
+def _merge_iseq_24(iterables, key):
+    """merge_iseq() before it special cased single sources, for 
+    comparison."""
+    import heapq, itertools
+    def keyed(v):
+        return key(v), v
+    iterables = map(lambda x: itertools.imap(keyed, x), iterables)
+    heappop, siftup, _StopIteration = heapq.heappop, heapq._siftup, StopIteration
+    h = []
+    h_append = h.append
+    for it in map(iter, iterables):
+        try:
+            next = it.next
+            h_append([next(), next])
+        except _StopIteration:
+            pass
+    heapq.heapify(h)
+    while 1:
+        try:
+            while 1:
+                v, next = s = h[0]
+                yield v[1]
+                s[0] = next()
+                siftup(h, 0)
+        except _StopIteration:
+            heappop(h)
+        except IndexError:
+            return
+
+def bench_merge():
+    """merging the parsed files of a day, for 1, 2 and 8 files, the old
+    merge_iseq() vs. the current one."""
+    from pytz import UTC
+    from irclogs.api import merge_iseq
+    from irclogs.provider.file import OLDDATE
+    env, channel = setup('supy')
+    provider = FileIRCLogProvider(env)
+    events = list(provider.parse_lines(corpus('supy', 80000), channel, UTC))
+    for sources in (1, 2, 8):
+        # deal the events out, like files interleaved in time
+        files = [events[i::sources] for i in range(sources)]
+        def _old():
+            for event in _merge_iseq_24(files, 
+                    lambda x: x.get('timestamp', OLDDATE)):
+                pass
+        def _new():
+            for event in merge_iseq(files, lambda x: x.get('timestamp')):
+                pass
+        print '%d source%s:'%(sources, sources > 1 and 's' or '')
+        slow = best_of(_old)
+        report('2.4 heap merge', len(events), slow)
+        report('merge_iseq', len(events), best_of(_new), slow)
+
+def _db_events_24(ch, rows, tz, ttz):
+    """DBIRCLogProvider._events() before it converted in spans, for
+    comparison."""
+    from irclogs.api import IRCEvent
+    ignore_charset = False
+    for l in rows:
+        timestamp = tz.localize(l[0])
+        dt = ttz.normalize(timestamp.astimezone(ttz))
+        line = IRCEvent(timestamp=dt, network=l[1], channel=l[2], nick=l[3],
+                        type=l[4], message=l[5], comment=l[5],
+                        action=l[5].lstrip('* '))
+        ignore_charset = ignore_charset or isinstance(line['message'],
+                                                      unicode)
+        if (not ignore_charset) and ch.setting('charset'):
+            for k in ('network', 'channel', 'nick', 'type', 'message', 
+                      'comment'):
+                line[k] = unicode(line[k], ch.setting('charset'),
+                                  errors='ignore')
+        yield line
+
+def bench_db_rows():
+    """chatlog rows to events, per row conversion vs. the current
+    DBIRCLogProvider, on rows in memory and from a sqlite database."""
+    import sqlite3
+    from pytz import timezone
+    from irclogs.provider.db import DBIRCLogProvider
+    tz = timezone('America/New_York')
+    ttz = timezone('America/Los_Angeles')
+    start = datetime(2009, 3, 7)
+    templates = ['<rcorsaro> great, thanks', '* cbalan feels lonely...',
+                 'dgynn has joined #etf']
+    rows = []
+    for i in xrange(40000):
+        # three seconds apart, across the DST transition
+        rows.append((start + timedelta(seconds=i*3), 'freenode', '#bench',
+                     'nick%d'%(i % 7), ('comment', 'action', 'join')[i % 3],
+                     templates[i % 3], i))
+    unicode_rows = [tuple([isinstance(v, str) and unicode(v) or v 
+                           for v in row]) for row in rows]
+    env, channel = setup('gozer')
+    provider = DBIRCLogProvider(env)
+    # the old decoding looked up the charset setting for every row, which
+    # is slow enough to only time once, on fewer rows
+    for label, data, repeat in (('unicode rows', unicode_rows, 3), 
+                                ('utf-8 rows', rows[:4000], 1)):
+        def _old():
+            for event in _db_events_24(channel, data, tz, ttz):
+                pass
+        def _new():
+            for event in provider._events(channel, data, tz, ttz):
+                pass
+        print '%s, %d:'%(label, len(data))
+        slow = best_of(_old, repeat)
+        report('per row', len(data), slow, unit='rows')
+        report('converted in spans', len(data), best_of(_new), slow, 
+               unit='rows')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'chatlog.db')
+        cnx = sqlite3.connect(path)
+        cnx.execute("""CREATE TABLE chatlog (id INTEGER PRIMARY KEY,
+            time TIMESTAMP, network TEXT, target TEXT, nick TEXT, type TEXT,
+            msg TEXT)""")
+        cnx.executemany("""INSERT INTO chatlog (time, network, target, nick,
+            type, msg) VALUES (?, ?, ?, ?, ?, ?)""", 
+            [row[:6] for row in unicode_rows])
+        cnx.commit()
+        cnx.close()
+        env.config.set('irclogs', 'channel.bench.database', 'sqlite:' + path)
+        env.config.set('irclogs', 'channel.bench.timezone', 'America/New_York')
+        env.config.set('irclogs', 'channel.bench.network', 'freenode')
+        channel = IRCChannelManager(env).channel('bench')
+        qstart = ttz.localize(datetime(2009, 3, 6))
+        qend = qstart + timedelta(days=3)
+        def _query():
+            for event in provider.get_events_in_range(channel, qstart, qend):
+                pass
+        print 'sqlite, unicode rows, %d:'%(len(rows))
+        provider._events = lambda *args: _db_events_24(*args)
+        slow = best_of(_query)
+        report('per row', len(rows), slow, unit='rows')
+        del provider._events
+        report('converted in spans', len(rows), best_of(_query), slow,
+               unit='rows')
+    finally:
+        from irclogs.provider.db import IRCLogDatabaseManager
+        IRCLogDatabaseManager(env).shutdown()
+        shutil.rmtree(tmpdir)
+
+def bench_import():
+    """importing 30 days of file logs into a sqlite chatlog table, in 
+    batches of 100 and 5000 rows."""
+    import sqlite3
+    from datetime import date
+    from pytz import UTC
+    from irclogs.provider.db import IRCLogDatabaseManager
+    from irclogs.provider.importer import ChatlogImporter
+    tmpdir = tempfile.mkdtemp()
+    try:
+        env, channel = setup('supy', {'basepath': tmpdir, 
+                'cache_dir': os.path.join(tmpdir, 'cache')})
+        os.mkdir(os.path.join(tmpdir, '#bench'))
+        days = 30
+        for day in range(days):
+            dt = datetime(2009, 4, 1) + timedelta(days=day)
+            f = open(os.path.join(tmpdir, '#bench', 
+                                  dt.strftime('#bench.%Y-%m-%d.log')), 'w')
+            f.writelines(corpus('supy', 10000, dt))
+            f.close()
+        provider = FileIRCLogProvider(env)
+        dbmgr = IRCLogDatabaseManager(env)
+        for batch_size in (100, 5000):
+            path = os.path.join(tmpdir, 'chatlog%d.db'%(batch_size))
+            cnx = sqlite3.connect(path)
+            cnx.execute("""CREATE TABLE chatlog (id INTEGER PRIMARY KEY,
+                time TIMESTAMP, network TEXT, target TEXT, nick TEXT, 
+                type TEXT, msg TEXT)""")
+            cnx.close()
+            importer = ChatlogImporter(provider, channel, 
+                    lambda: dbmgr.connect('sqlite:' + path), UTC, batch_size)
+            importer.run(date(2009, 5, 1))
+            # every line of the corpus is an event
+            assert importer.events == days * 10000, \
+                    "imported %d events"%(importer.events)
+            report('batches of %d'%(batch_size), importer.events, 
+                   importer.seconds)
+        dbmgr.shutdown()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def _settings_22(chmgr, name):
+    """IRCChannel.settings() before channel snapshots, for comparison."""
+    import re
+    from irclogs.api import prefix_options
+    c = chmgr.config
+    default_op = lambda x: re.match('^[^.]+$', x[0])
+    retoptions = dict(filter(default_op, c.options('irclogs')))
+    options = prefix_options('channel.%s.'%(name), c.options('irclogs'))
+    retoptions.update(options)
+    return retoptions
+
+def bench_settings():
+    """channel setting lookups, like the ones of a page view, worked out
+    from the options every time vs. read from the channel's snapshot."""
+    env, channel = setup('supy')
+    chmgr = IRCChannelManager(env)
+    for i in range(20):
+        env.config.set('irclogs', 'channel.bench%d.channel'%(i), '#b%d'%(i))
+        env.config.set('irclogs', 'channel.bench%d.network'%(i), 'freenode')
+    count = 2000
+    def _old():
+        for i in xrange(count):
+            _settings_22(chmgr, 'bench').get('timezone')
+    def _new():
+        for i in xrange(count):
+            chmgr.channel('bench').setting('timezone')
+    slow = best_of(_old)
+    report('options every time', count, slow, unit='lookups')
+    report('snapshot', count, best_of(_new), slow, unit='lookups')
+
+def _channels_23(chmgr):
+    """IRCChannelManager.channels() before the channel registry, for
+    comparison."""
+    import re
+    from irclogs.api import IRCChannel
+    CHANNEL_RE = re.compile('^channel\.(?P<name>[^.]+)\..*$')
+    def _name(x):
+        m = CHANNEL_RE.match(x)
+        if m:
+            return m.groupdict()['name']
+    ops = chmgr.config.options('irclogs')
+    names = filter(None, set(map(_name, map(lambda x: x[0], ops))))
+    if chmgr.config.get('irclogs', 'channel'):
+        names.append(None)
+    for name in names:
+        yield IRCChannel(chmgr, name, chmgr.snapshot(name))
+
+def bench_navigation():
+    """the channel work of an unrelated page view with 20 channels: the
+    navigation items and permissions, channel names scanned for and
+    channels made every time vs. got from the registry."""
+    env, channel = setup('supy')
+    chmgr = IRCChannelManager(env)
+    for i in range(20):
+        env.config.set('irclogs', 'channel.bench%d.channel'%(i), '#b%d'%(i))
+        env.config.set('irclogs', 'channel.bench%d.network'%(i), 'freenode')
+    count = 200
+    def _page(channels):
+        for ch in channels():
+            ch.perm(), ch.name(), ch.navbutton(), ch.menuid()
+        for ch in channels():
+            ch.name()
+    def _old():
+        for i in xrange(count):
+            _page(lambda: _channels_23(chmgr))
+    def _new():
+        for i in xrange(count):
+            _page(chmgr.channels)
+    slow = best_of(_old)
+    report('names scanned every time', count, slow, unit='pages')
+    report('registry', count, best_of(_new), slow, unit='pages')
+
+def bench_merged():
+    """a merged view of 4 channels whose providers wait on I/O, like
+    databases fetching 1000 rows per round trip: channels read one after
+    the other vs. merged_events()."""
+    import time
+    from pytz import UTC
+    from trac.test import Mock
+    from irclogs.api import IRCEvent, merge_iseq
+    env, channel = setup('supy')
+    chmgr = IRCChannelManager(env)
+    names = ['bench%d'%(i) for i in range(4)]
+    for name in names:
+        env.config.set('irclogs', 'channel.%s.channel'%(name), '#' + name)
+    start = UTC.localize(datetime(2009, 3, 8))
+    count = 20000
+    def events_in_range(channel, start, end, filter=None):
+        offset = names.index(channel.name())
+        for i in xrange(count):
+            if i % 1000 == 0:
+                time.sleep(0.01)
+            yield IRCEvent(type='comment', 
+                timestamp=start + timedelta(seconds=4 * i + offset))
+    chmgr.provider = lambda name: Mock(get_events_in_range=events_in_range)
+    end = start + timedelta(days=1)
+    def _old():
+        sources = [list(chmgr.merged_events([name], start, end))
+                   for name in names]
+        for event in merge_iseq(sources, lambda x: x.get('timestamp')):
+            pass
+    def _new():
+        for event in chmgr.merged_events(names, start, end):
+            pass
+    slow = best_of(_old)
+    report('one after the other', count * len(names), slow, unit='events')
+    report('merged_events', count * len(names), best_of(_new), slow,
+           unit='events')
+
+BENCHMARKS = {
+    'db_rows': bench_db_rows,
+    'import': bench_import,
+    'merge': bench_merge,
+    'merged': bench_merged,
+    'navigation': bench_navigation,
+    'memory': bench_memory,
+    'reader': bench_reader,
+    'settings': bench_settings,
+    'classifier': bench_classifier,
+    'timestamps': bench_timestamps,
+}
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        bench = BENCHMARKS[name]
+        print '== %s: %s'%(name, bench.__doc__)
+        bench()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,513 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import date, datetime, timedelta
+from pytz import UTC, timezone
+
+from StringIO import StringIO
+from trac.admin.api import AdminCommandError
+from trac.db.pool import TimeoutError
+from trac.test import EnvironmentStub, Mock
+from trac.web.href import Href
+
+from irclogs.admin import IRCLogsAdmin, INDEX_NAME
+from irclogs.api import IRCChannelManager, EventFilter, event_cursor
+from irclogs.provider.archive import open_log
+from irclogs.provider.db import DBIRCLogProvider, IRCLogDatabaseManager, \
+        read_ahead, streaming_cursor
+from irclogs.provider.file import FileIRCLogProvider
+from irclogs.provider.importer import ChatlogImporter
+from irclogs.provider.pool import ConnectionPool, safe_uri
+from irclogs.search import ChatlogSearch
+
+SCHEMA = """
+    CREATE TABLE chatlog (
+        id      INTEGER PRIMARY KEY,
+        time    TIMESTAMP,
+        network TEXT NOT NULL,
+        target  TEXT NOT NULL,
+        nick    TEXT NOT NULL,
+        type    TEXT NOT NULL,
+        msg     TEXT NOT NULL
+    )"""
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+    def cursor(self):
+        if self.broken:
+            raise Exception("server has gone away")
+        return self
+    def execute(self, sql):
+        pass
+    def fetchall(self):
+        return [(1,)]
+    def rollback(self):
+        if self.broken:
+            raise Exception("server has gone away")
+    def close(self):
+        self.closed = True
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.made = []
+        def _connect():
+            cnx = FakeConnection()
+            self.made.append(cnx)
+            return cnx
+        self.pool = ConnectionPool(_connect, 2, 600, 30)
+
+    def test_reuse(self):
+        cnx = self.pool.get()
+        cnx.close()
+        cnx.close()
+        cnx = self.pool.get()
+        self.assertEquals(1, len(self.made))
+        self.assert_(cnx.cnx is self.made[0])
+        other = self.pool.get()
+        self.assertEquals(2, len(self.made))
+        self.assertEquals((2, 1, 2),
+                (self.pool.created, self.pool.reused, self.pool._active))
+        del cnx, other
+        self.assertEquals(2, len(self.pool._idle))
+
+    def test_timeout(self):
+        first, second = self.pool.get(), self.pool.get()
+        self.assertRaises(TimeoutError, self.pool.get, 0.05)
+        # a connection given back by another thread is handed on
+        threading.Timer(0.05, first.close).start()
+        self.assert_(self.pool.get(5).cnx is self.made[0])
+        self.assert_(self.pool.waits >= 2)
+
+    def test_health_check(self):
+        cnx = self.pool.get()
+        cnx.close()
+        self.made[0].broken = True
+        self.pool._idle[0] = (self.made[0], time.time() - 60)
+        cnx = self.pool.get()
+        self.assert_(cnx.cnx is self.made[1])
+        self.assert_(self.made[0].closed)
+        self.assertEquals(1, self.pool.discarded)
+        # broken connections aren't put back
+        self.made[1].broken = True
+        cnx.close()
+        self.assertEquals([], self.pool._idle)
+        self.assertEquals(0, self.pool._active)
+
+    def test_idle_timeout(self):
+        self.pool.get().close()
+        self.pool._idle[0] = (self.made[0], time.time() - 601)
+        self.pool.get()
+        self.assert_(self.made[0].closed)
+        self.assertEquals(2, len(self.made))
+
+    def test_safe_uri(self):
+        self.assertEquals('postgres://irc:***@db/logs',
+                safe_uri('postgres://irc:secret@db/logs'))
+        self.assertEquals('sqlite:db/chat.db', safe_uri('sqlite:db/chat.db'))
+
+class ReadAheadTestCase(unittest.TestCase):
+    def test_read_ahead(self):
+        made = []
+        def _items():
+            for i in range(5):
+                made.append(i)
+                yield i
+        items = read_ahead(_items())
+        self.assertEquals(0, items.next())
+        time.sleep(0.05)
+        # one waiting to be read, and one waiting to be queued
+        self.assertEquals([0, 1, 2], made)
+        self.assertEquals([1, 2, 3, 4], list(items))
+
+    def test_errors(self):
+        def _items():
+            yield 1
+            raise ValueError('broken')
+        items = read_ahead(_items())
+        self.assertEquals(1, items.next())
+        self.assertRaises(ValueError, items.next)
+
+    def test_abandoned(self):
+        def _broken():
+            yield 1
+            yield 2
+            raise ValueError('broken')
+        # the last batch is left unread, with the end still to be queued
+        for source, batch in ((lambda: iter(range(10)), 1), (_broken, 1),
+                              (lambda: iter(range(3)), 2)):
+            count = threading.activeCount()
+            items = read_ahead(source(), 0.01, batch)
+            items.next()
+            del items
+            for i in range(100):
+                if threading.activeCount() == count:
+                    break
+                time.sleep(0.01)
+            self.assertEquals(count, threading.activeCount())
+
+class DBIRCLogProviderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = EnvironmentStub()
+        config = self.env.config
+        config.set('irclogs', 'channel', '#test')
+        config.set('irclogs', 'provider', 'db')
+        config.set('irclogs', 'database', self._db('one.db', '#test', 10))
+        config.set('irclogs', 'channel.other.channel', '#other')
+        config.set('irclogs', 'channel.other.database',
+                   self._db('two.db', '#other', 20))
+        self.out = DBIRCLogProvider(self.env)
+        self.chmgr = IRCChannelManager(self.env)
+        self.start = UTC.localize(datetime(2009, 3, 8))
+        self.end = self.start + timedelta(days=1)
+
+    def tearDown(self):
+        IRCLogDatabaseManager(self.env).shutdown()
+        shutil.rmtree(self.dir)
+
+    def _db(self, name, channel, count):
+        path = os.path.join(self.dir, name)
+        cnx = sqlite3.connect(path)
+        cnx.execute(SCHEMA)
+        for i in range(count):
+            cnx.execute("INSERT INTO chatlog (time, network, target, nick, "
+                        "type, msg) VALUES (?, ?, ?, ?, ?, ?)",
+                        (datetime(2009, 3, 8) + timedelta(seconds=i // 3),
+                         '', channel, 'nick%d'%(i % 3),
+                         i % 4 and 'comment' or 'join', 'message %d'%(i)))
+        cnx.commit()
+        cnx.close()
+        return 'sqlite:' + path
+
+    def _events(self, name, **kw):
+        channel = self.chmgr.channel(name)
+        return list(self.out.get_events_in_range(channel, self.start,
+                                                 self.end, **kw))
+
+    def test_databases(self):
+        self.assertEquals(10, len(self._events(None)))
+        self.assertEquals(20, len(self._events('other')))
+        # from threads at once
+        results = []
+        def _read(name):
+            for i in range(20):
+                results.append((name, len(self._events(name))))
+        threads = [threading.Thread(target=_read, args=(name,))
+                   for name in (None, 'other', None, 'other')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(80, len(results))
+        for name, count in results:
+            self.assertEquals(name and 20 or 10, count)
+        pools = IRCLogDatabaseManager(self.env)._pools
+        self.assertEquals(2, len(pools))
+        for pool in pools.values():
+            self.assertEquals(0, pool._active)
+            self.assert_(pool.created <= 5)
+
+    def test_pages_and_filters(self):
+        events = self._events('other')
+        pages = []
+        after = None
+        while True:
+            page = self._events('other', limit=4, after=after)
+            if not page:
+                break
+            pages.extend(page)
+            after = event_cursor(page, after)
+        self.assertEquals(events, pages)
+        only = EventFilter(types=('comment',), nicks=('nick1',))
+        self.assertEquals([e for e in events if only(e)],
+                          self._events('other', filter=only))
+        channel = self.chmgr.channel('other')
+        self.assertEquals(events[-5:],
+                self.out.get_last_events(channel, self.end, 5))
+        for pool in IRCLogDatabaseManager(self.env)._pools.values():
+            self.assertEquals(0, pool._active)
+
+    def test_stopped_early(self):
+        # held here, so only close() gives them back
+        getdb = self.out._getdb
+        held = []
+        def _getdb(channel):
+            held.append(getdb(channel))
+            return held[-1]
+        self.out._getdb = _getdb
+        channel = self.chmgr.channel('other')
+        events = self.out.get_events_in_range(channel, self.start, self.end)
+        events.next()
+        events.close()
+        self.assertEquals(4, len(self._events('other', limit=4)))
+        self.assertEquals(2, len(held))
+        for pool in IRCLogDatabaseManager(self.env)._pools.values():
+            self.assertEquals(0, pool._active)
+
+    def test_streaming(self):
+        events = self._events('other')
+        for size in (1, 3, 20, 0):
+            self.env.config.set('irclogs', 'db_fetch_size', str(size))
+            self.assertEquals(events, self._events('other'))
+        # rows come in batches, not all at once at execute()
+        channel = self.chmgr.channel('other')
+        cnx = self.out._getdb(channel)
+        cur = streaming_cursor(cnx)
+        self.assertEquals('PyFormatCursor', cur.cursor.__class__.__name__)
+        cur.execute("SELECT id FROM chatlog ORDER BY id")
+        self.assertEquals([(1,), (2,), (3,)], cur.fetchmany(3))
+        self.assertEquals([(4,)], cur.fetchmany(1))
+        cnx.close()
+        for pool in IRCLogDatabaseManager(self.env)._pools.values():
+            self.assertEquals(0, pool._active)
+
+    def test_chunks(self):
+        events = self._events('other')
+        config = self.env.config
+        config.set('irclogs', 'db_chunk_hours', '1')
+        config.set('irclogs', 'db_fetch_size', '2')
+        for prefetch in ('false', 'true'):
+            config.set('irclogs', 'db_read_ahead', prefetch)
+            self.assertEquals(events, self._events('other'))
+            self.assertEquals(events[:7], self._events('other', limit=7))
+            after = event_cursor(events[:7])
+            self.assertEquals(events[7:12],
+                    self._events('other', limit=5, after=after))
+            only = EventFilter(types=('comment',), nicks=('nick1',))
+            self.assertEquals([e for e in events if only(e)],
+                              self._events('other', filter=only))
+        for pool in IRCLogDatabaseManager(self.env)._pools.values():
+            self.assertEquals(0, pool._active)
+
+    def test_row_conversion(self):
+        tz = timezone('America/New_York')
+        ttz = timezone('Europe/Paris')
+        channel = self.chmgr.channel('other')
+        # across the spring and autumn transitions of both timezones
+        times = []
+        for day in (datetime(2009, 3, 8), datetime(2009, 3, 29),
+                    datetime(2009, 10, 25), datetime(2009, 11, 1)):
+            times.extend([day + timedelta(minutes=17*i) for i in range(200)])
+        rows = [(t, 'net', '#other', 'n\xc3\xa9ck', 'action',
+                 '* caf\xc3\xa9 %d'%(i), i) for i, t in enumerate(times)]
+        events = list(self.out._events(channel, rows, tz, ttz))
+        self.assertEquals(len(rows), len(events))
+        for row, event in zip(rows, events):
+            expected = ttz.normalize(tz.localize(row[0]).astimezone(ttz))
+            self.assertEquals(expected, event['timestamp'])
+            self.assertEquals(expected.tzname(), event['timestamp'].tzname())
+            self.assertEquals(u'n\xe9ck', event['nick'])
+            self.assertEquals('action', event['type'])
+            self.assertEquals(u'caf\xe9 %d'%(row[6]), event['action'])
+            self.assertEquals(event['message'], event['comment'])
+        # unicode from the driver isn't decoded again
+        rows = [(times[0], u'net', u'#other', u'n\xe9ck', u'comment',
+                 u'caf\xe9', 1)]
+        event = list(self.out._events(channel, rows, tz, ttz))[0]
+        self.assertEquals(u'caf\xe9', event['message'])
+
+    def test_search(self):
+        self.env.config.set('irclogs', 'channel.other.perm', 'OTHER_VIEW')
+        perms = ['IRCLOGS_VIEW', 'OTHER_VIEW']
+        req = Mock(perm=Mock(has_permission=lambda p: p in perms),
+                   href=Href('/trac'), session={'tz': 'UTC'})
+        search = ChatlogSearch(self.env)
+        # databases without full text search are left to whoosh
+        self.assertEquals([], search.get_search_filters(req))
+        self.assert_('setting up' in self._admin('fulltext', 'other'))
+        # checked once, until recheck_interval is up
+        self.failIf(search.searches(self.chmgr.channel('other')))
+        search.recheck_interval = 0
+        self.assert_(search.searches(self.chmgr.channel('other')))
+        self.failIf(search.searches(self.chmgr.channel(None)))
+        self.assertEquals(['other'], [ch.name() for ch in 
+                                      search._channels(req)])
+        out = self._admin('fulltext')
+        self.assertEquals(1, out.count('setting up full text search'))
+        self.assert_('already' in out)
+        self.assertEquals(2, len(search._channels(req)))
+        self.assertEquals([('irclogs', 'IRC Logs', True)], 
+                          search.get_search_filters(req))
+        def _results(*terms):
+            return list(search.get_search_results(req, terms, ['irclogs']))
+        results = _results('message', '13')
+        self.assertEquals(1, len(results))
+        href, title, dt, author, excerpt = results[0]
+        self.assertEquals('/trac/irclogs/other/2009/03/08#00:00:04', href)
+        self.assertEquals('irclogs for #other', title)
+        self.assertEquals(datetime(2009, 3, 8, 0, 0, 4, tzinfo=UTC), dt)
+        self.assertEquals(('nick1', '<nick1> message 13'), (author, excerpt))
+        # joins aren't searched
+        self.assertEquals([], _results('message', '12'))
+        self.assertEquals(2, len(_results('message', '5')))
+        # rows added later are found through the triggers
+        cnx = sqlite3.connect(os.path.join(self.dir, 'two.db'))
+        cnx.execute("INSERT INTO chatlog (time, network, target, nick, type, "
+                    "msg) VALUES ('2009-03-08 12:00:00', '', '#other', "
+                    "'late', 'action', '* waves \"hello\"')")
+        cnx.commit()
+        cnx.close()
+        results = _results('"hello"')
+        self.assertEquals(1, len(results))
+        self.assertEquals('* late waves "hello"', results[0][4])
+        # only channels the user may view
+        perms.remove('OTHER_VIEW')
+        self.assertEquals([], _results('hello'))
+        self.assertEquals(1, len(_results('message', '5')))
+        self.assertEquals([], _results())
+
+    def _admin(self, command, *args):
+        stdout = sys.stdout
+        sys.stdout = out = StringIO()
+        try:
+            getattr(IRCLogsAdmin(self.env), '_do_' + command)(*args)
+        finally:
+            sys.stdout = stdout
+        return out.getvalue()
+
+    def test_admin(self):
+        out = self._admin('explain', 'other', '2009-03-08')
+        self.assert_('#other day view' in out)
+        self.assert_(INDEX_NAME not in out)
+        out = self._admin('index')
+        self.assertEquals(2, out.count('creating index %s'%(INDEX_NAME)))
+        cnx = sqlite3.connect(os.path.join(self.dir, 'two.db'))
+        self.assertEquals([(INDEX_NAME,)], cnx.execute("SELECT name FROM "
+                "sqlite_master WHERE type = 'index'").fetchall())
+        cnx.close()
+        out = self._admin('index', 'other')
+        self.assertEquals(1, out.count('already indexed by %s'%(INDEX_NAME)))
+        out = self._admin('explain', 'other', '2009-03-08')
+        self.assertEquals(2, out.count(INDEX_NAME))
+        self.assertEquals(20, len(self._events('other')))
+        self.assertRaises(AdminCommandError, self._admin, 'index', 'nope')
+        self.assertRaises(AdminCommandError, self._admin, 'explain', None,
+                          '8 March')
+
+class ChatlogImporterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = EnvironmentStub()
+        config = self.env.config
+        config.set('irclogs', 'basepath', self.dir)
+        config.set('irclogs', 'cache_dir', os.path.join(self.dir, 'cache'))
+        config.set('irclogs', 'channel.files.channel', '#files')
+        config.set('irclogs', 'channel.files.network', 'freenode')
+        config.set('irclogs', 'channel.files.timezone', 'America/New_York')
+        path = os.path.join(self.dir, 'chatlog.db')
+        cnx = sqlite3.connect(path)
+        cnx.execute(SCHEMA)
+        cnx.close()
+        config.set('irclogs', 'channel.files.database', 'sqlite:' + path)
+        os.mkdir(os.path.join(self.dir, '#files'))
+        for day in range(7, 10):
+            f = open(os.path.join(self.dir, '#files', 
+                                  '#files.2009-02-%02d.log'%(day)), 'w')
+            dt = datetime(2009, 2, day)
+            f.write('* untimestamped start *\n')
+            for i in range(50):
+                stamp = (dt + timedelta(minutes=i*29)).strftime(
+                        '%Y-%m-%dT%H:%M:%S')
+                f.write('%s  <nick%d> message %d\n'%(stamp, i % 3, i))
+                f.write('%s  * nick%d waves %d\n'%(stamp, i % 3, i))
+                f.write('%s  *** nick%d has joined #files\n'%(stamp, i % 3))
+            f.close()
+        self.chmgr = IRCChannelManager(self.env)
+        self.channel = self.chmgr.channel('files')
+        self.files = FileIRCLogProvider(self.env)
+        self.db = DBIRCLogProvider(self.env)
+        self.tz = timezone('America/New_York')
+
+    def tearDown(self):
+        IRCLogDatabaseManager(self.env).shutdown()
+        shutil.rmtree(self.dir)
+
+    def _importer(self, batch_size=5000):
+        uri = self.db._database(self.channel)
+        return ChatlogImporter(self.files, self.channel, 
+                lambda: IRCLogDatabaseManager(self.env).connect(uri), 
+                self.tz, batch_size)
+
+    def _count(self):
+        cnx = sqlite3.connect(os.path.join(self.dir, 'chatlog.db'))
+        count = cnx.execute("SELECT COUNT(*) FROM chatlog").fetchone()[0]
+        cnx.close()
+        return count
+
+    def test_import(self):
+        importer = self._importer(40)
+        progress = []
+        importer.run(date(2009, 2, 9), lambda *args: progress.append(args))
+        # the last day isn't over yet
+        self.assertEquals([(date(2009, 2, 7), 151), (date(2009, 2, 8), 151)],
+                          progress)
+        self.assertEquals((302, 2), (importer.events, importer.days))
+        self.assert_(importer.rate() > 0)
+        start = self.tz.localize(datetime(2009, 2, 7))
+        end = self.tz.localize(datetime(2009, 2, 9))
+        expected = list(self.files.get_events_in_range(self.channel, start, 
+                                                       end))
+        events = list(self.db.get_events_in_range(self.channel, start, end))
+        self.assertEquals(len(expected), len(events))
+        for e, event in zip(expected, events):
+            # lines before a day's first timestamp get the start of the day
+            self.assertEquals(e.get('timestamp') or self.tz.localize(
+                datetime(*event['timestamp'].timetuple()[:3])), 
+                event['timestamp'])
+            self.assertEquals(e['type'], event['type'])
+            self.assertEquals(e.get('nick', ''), event['nick'])
+            if e['type'] == 'comment':
+                self.assertEquals(e['comment'], event['comment'])
+            if e['type'] == 'action':
+                self.assertEquals(e['action'], event['action'])
+        # a second run adds nothing
+        importer = self._importer()
+        importer.run(date(2009, 2, 9))
+        self.assertEquals((0, 0), (importer.events, importer.days))
+        self.assertEquals(302, self._count())
+
+    def test_resume(self):
+        importer = self._importer(20)
+        insert = importer._insert
+        calls = []
+        def _failing(*args):
+            calls.append(args)
+            if len(calls) == 4:
+                raise IOError("connection lost")
+            return insert(*args)
+        importer._insert = _failing
+        from irclogs.provider import importer as module
+        opened = []
+        def _open_log(path):
+            opened.append(open_log(path))
+            return opened[-1]
+        module.open_log = _open_log
+        try:
+            self.assertRaises(IOError, importer.run, date(2009, 2, 10))
+        finally:
+            module.open_log = open_log
+        self.assertEquals(60, self._count())
+        # the files of the failed day are closed all the same
+        self.assertEquals([True] * len(opened), [f.closed for f in opened])
+        importer = self._importer(20)
+        importer.run(date(2009, 2, 10))
+        self.assertEquals(453 - 60, importer.events)
+        self.assertEquals(453, self._count())
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ConnectionPoolTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ReadAheadTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(DBIRCLogProviderTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ChatlogImporterTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -1,14 +1,22 @@
 import unittest
 from time import strptime
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from pytz import timezone, UTC
 import re
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+import time
 
 from trac.core import *
 from trac.test import EnvironmentStub
 
-from irclogs.provider.file import FileIRCLogProvider
-from irclogs.api import merge_iseq, IRCChannelManager
+from irclogs.provider.file import FileIRCLogProvider, required_literals, \
+                                  reverse_blocks, timestamp_layout
+from irclogs.api import merge_iseq, EventFilter, IRCChannelManager, \
+                        event_cursor, format_cursor, parse_cursor
 
 class FileIRCLogProviderTestCase(unittest.TestCase):
     def setUp(self):
@@ -172,6 +180,23 @@ class FileIRCLogProviderTestCase(unittest.TestCase):
         self.assertEquals('other', results[13]['type'])
         self.assertEquals('* SOME SPECIAL MESSAGE *', results[13]['message'])
     
+    def test_parse_filter(self):
+        f = self.chmgr.channel(None)
+        everything = list(self.out.parse_lines(self.supylines, f))
+        for only in (EventFilter(types=('comment', 'action')),
+                     EventFilter(nicks=('dgynn',)),
+                     EventFilter(types=('join', 'other'), nicks=('rcorsaro',)),
+                     EventFilter(types=())):
+            self.assertEquals([e for e in everything if only(e)],
+                    list(self.out.parse_lines(self.supylines, f, 
+                                              filter=only)))
+        format = self.out._compiled_format(f)
+        # comment part join quit action kick ...
+        self.assertEquals(5, format.dispatch_length(('comment', 'action')))
+        self.assertEquals(len(format.dispatch), 
+                format.dispatch_length(('comment', 'other')))
+        self.assertEquals(0, format.dispatch_length(()))
+
     def test_parse_simple_gozerbot(self):
         self.out.config.set('irclogs', 'channel.test.format', 'gozer')
         f = self.chmgr.channel('test')
@@ -448,6 +473,12 @@ class FileIRCLogProviderTestCase(unittest.TestCase):
         self.assertEquals(self._date("20090102060000").date(), days[0]);
         self.assertEquals(self._date("20090105060000").date(), days[3]);
 
+    def test_get_file_dates_midnight(self):
+        s = self._date("20090308000000")
+        e = self._date("20090309000000")
+        self.assertEquals([s.date()], list(self.out._get_file_dates(s, e)))
+        self.assertEquals([s.date()], list(self.out._get_file_dates(s, s)))
+
     def test_merge_iseq(self):
         parsers = []
         self.out.config.set('irclogs', 'channel.test.format', 'gozer')
@@ -462,6 +493,19 @@ class FileIRCLogProviderTestCase(unittest.TestCase):
         lines = list(merge_iseq(parsers, key=_key))
         self.assertEquals(40, len(lines))
 
+    def test_merge_iseq_untimestamped(self):
+        def _key(x):
+            return x[0]
+        a = [(None, 'a0'), (1, 'a1'), (None, 'a1+'), (4, 'a4')]
+        b = [(1, 'b1'), (2, 'b2'), (None, 'b2+'), (None, 'b2++'), (3, 'b3')]
+        c = [(None, 'c0'), (None, 'c0+')]
+        self.assertEquals(['a0', 'c0', 'c0+', 'a1', 'a1+', 'b1', 'b2', 'b2+',
+                           'b2++', 'b3', 'a4'], 
+                [x[1] for x in merge_iseq([a, b, c, []], _key)])
+        self.assertEquals(a, list(merge_iseq([a], _key)))
+        self.assertEquals([], list(merge_iseq([], _key)))
+        self.assertEquals([], list(merge_iseq([[], []], _key)))
+
     def test_file_dates(self):
         start = self._date("20090215120000").replace(tzinfo=UTC)
         end = self._date("20090215121500").replace(tzinfo=UTC)
@@ -469,9 +513,546 @@ class FileIRCLogProviderTestCase(unittest.TestCase):
         for i in range(0, len(dates)-1):
             self.assertTrue(dates[i] < dates[i+1], "(%s) Assertion Failed: %s < %s"%(dates, dates[i], dates[i+1]))
 
+    def test_compiled_format_registry(self):
+        ch = self.chmgr.channel(None)
+        compiled = self.out._compiled_format(ch)
+        self.assert_(compiled is self.out._compiled_format(ch))
+        self.out.config.set('irclogs', 'channel.test.channel', '#test')
+        self.assert_(compiled is \
+                self.out._compiled_format(self.chmgr.channel('test')))
+        self.out.config.set('irclogs', 'channel.test.format', 'gozer')
+        gozer = self.out._compiled_format(self.chmgr.channel('test'))
+        self.assert_(compiled is not gozer)
+        self.assertEquals('%Y-%m-%d %H:%M:%S', gozer.timestamp_format)
+        # a reread trac.ini empties the registry
+        self.out.config._lastmtime += 1
+        self.assert_(compiled is not self.out._compiled_format(ch))
+
+    def test_classifier(self):
+        biplines = (
+            '03-07-2009 22:18:00 < rcorsaro!~r@host: hello',
+            '03-07-2009 22:19:00 -!- rcorsaro!~r@host has joined #test',
+            '03-07-2009 22:20:00 -!- rcorsaro!~r@host has left #test [bye]',
+            '03-07-2009 22:21:00 -!- rcorsaro!~r@host has quit [leaving]',
+            '03-07-2009 22:22:00 -!- rcorsaro is now known as bobby',
+            '03-07-2009 22:23:00 -!- bobby!~r@host changed topic of #test to: hi',
+            '03-07-2009 22:24:00 -!- mode/#test [+o rcorsaro] by bobby!~r@host',
+            '03-07-2009 22:25:00 -!- rcorsaro has been kicked by bobby!~r@host [x]',
+            '03-07-2009 22:26:00 > * bobby!~r@host waves',
+            '* SOME SPECIAL MESSAGE *',
+        )
+        self.out.config.set('irclogs', 'channel.gozer.channel', '#gozer')
+        self.out.config.set('irclogs', 'channel.gozer.format', 'gozer')
+        self.out.config.set('irclogs', 'channel.bip.channel', '#bip')
+        self.out.config.set('irclogs', 'channel.bip.format', 'bip')
+        for name, lines in ((None, self.supylines), 
+                (None, self.supygozerlines),
+                ('gozer', self.simplegozerlines), 
+                ('bip', biplines)):
+            format = self.out._compiled_format(self.chmgr.channel(name))
+            for line in lines:
+                self.assertEquals(format.classify_loop(line), 
+                        format.classify(line))
+
+    def test_required_literals(self):
+        lits = required_literals(re.compile(
+            r'^(?P<n>\w+)\shas\s(joined|left)( #[a-z]+)?( ok)+\*{0,3}$'))
+        self.assertEquals(set(('has', ' ok')), set(lits))
+        lits = required_literals(re.compile(r'(?i)^\w+ has joined$'))
+        self.assertEquals((), lits)
+
+    def test_timestamp_decoder_dst(self):
+        # every 10 minutes over two days around each transition, in file
+        # timezones with and without DST, to a few target timezones
+        days = ('20090307', '20090328', '20091024', '20091031', '20091003')
+        for tzname in ('America/New_York', 'Europe/London', 
+                'Australia/Lord_Howe', 'Etc/GMT+5', 'UTC'):
+            self.out.config.set('irclogs', 'channel.dst.channel', '#dst')
+            self.out.config.set('irclogs', 'channel.dst.timezone', tzname)
+            format = self.out._compiled_format(self.chmgr.channel('dst'))
+            for target in (None, UTC, timezone('America/Los_Angeles'),
+                    timezone('Europe/Moscow'), timezone('Etc/GMT-3')):
+                decode = format.decoder(target)
+                for day in days:
+                    dt = datetime(*strptime(day, '%Y%m%d')[:6])
+                    for i in range(0, 2 * 24 * 6):
+                        tsstr = dt.strftime('%Y-%m-%dT%H:%M:%S')
+                        expected = format.parse_timestamp(tsstr, target)
+                        actual = decode(tsstr)
+                        self.assertEquals(expected, actual)
+                        self.assertEquals(expected.tzinfo, actual.tzinfo)
+                        self.assertEquals(expected.replace(tzinfo=None), 
+                                actual.replace(tzinfo=None))
+                        dt += timedelta(minutes=10)
+
+    def test_timestamp_decoder_fallback(self):
+        format = self.out._compiled_format(self.chmgr.channel(None))
+        decode = format.decoder(timezone('America/New_York'))
+        for tsstr in ('2009-03-08T06:59:59', '2009-3-8T7:00:00', 
+                '2009-03-08T07:00:01'):
+            self.assertEquals(format.parse_timestamp(tsstr, 
+                timezone('America/New_York')), decode(tsstr))
+        self.assertRaises(ValueError, decode, '2009-03-08 07:00:01')
+        self.assertRaises(ValueError, decode, '2009-13-08T07:00:01')
+        self.assertEquals(None, timestamp_layout('%b %d %H:%M:%S'))
+        self.assertEquals(5, timestamp_layout('%H:%M')[0])
+
+class FileIRCLogProviderFilesTestCase(unittest.TestCase):
+    """Reading actual log files from disk."""
+
+    def setUp(self):
+        self.basepath = tempfile.mkdtemp()
+        self.env = EnvironmentStub()
+        self.env.config.set('irclogs', 'channel', '#test')
+        self.env.config.set('irclogs', 'basepath', self.basepath)
+        self.env.config.set('irclogs', 'cache_dir', 
+                os.path.join(self.basepath, 'cache'))
+        self.env.config.set('irclogs', 'tail_cursors', '0')
+        self.out = FileIRCLogProvider(self.env)
+        self.chmgr = IRCChannelManager(self.env)
+        os.mkdir(os.path.join(self.basepath, '#test'))
+        self.path = self._write_day(datetime(2009, 3, 8))
+
+    def tearDown(self):
+        shutil.rmtree(self.basepath)
+
+    def _lines(self, day, count=2400, step=30):
+        dt = day
+        for i in range(count):
+            yield '%s  <nick%d> message %d\n'%(
+                    dt.strftime('%Y-%m-%dT%H:%M:%S'), i % 5, i)
+            if i % 100 == 0:
+                yield 'untimestamped line %d\n'%(i)
+            dt += timedelta(seconds=step)
+
+    def _write_day(self, day, mode='w', lines=None):
+        path = os.path.join(self.basepath, '#test', 
+                day.strftime('#test.%Y-%m-%d.log'))
+        f = open(path, mode)
+        f.writelines(lines or self._lines(day))
+        f.close()
+        return path
+
+    def _events(self, start, end, tz='UTC'):
+        tz = timezone(tz)
+        start = tz.localize(datetime(*strptime(start, '%Y%m%d%H%M%S')[:6]))
+        end = tz.localize(datetime(*strptime(end, '%Y%m%d%H%M%S')[:6]))
+        channel = self.chmgr.channel(None)
+        return list(self.out.get_events_in_range(channel, start, end))
+
+    def test_offset_index_range(self):
+        ranges = (('20090308100000', '20090308100010'),
+                  ('20090308000000', '20090308000100'),
+                  ('20090308235900', '20090309000000'),
+                  ('20090308120000', '20090308130000'))
+        for start, end in ranges:
+            self.env.config.set('irclogs', 'offset_interval', '0')
+            expected = [l for l in self._events(start, end)
+                    if l.get('timestamp')]
+            self.env.config.set('irclogs', 'offset_interval', '60')
+            actual = self._events(start, end)
+            self.assertEquals(expected, [l for l in actual 
+                if l.get('timestamp')])
+            # no more than a minute of untimestamped noise is read
+            self.assert_(len(actual) - len(expected) <= 1)
+        self.assertEquals(3, len(self._events('20090308100000', 
+            '20090308100100')))
+        self.assertEquals(2, len(self._events('20090308050000', 
+            '20090308050100', 'America/New_York')))
+        # lines before the first timestamp are read with the start of day
+        self._write_day(datetime(2009, 3, 8), 'w', ['untimestamped start\n']
+                + list(self._lines(datetime(2009, 3, 8), 10, 60)))
+        self.assertEquals(u'untimestamped start', 
+            self._events('20090308000000', '20090308000500')[0]['message'])
+
+    def test_offset_index_update(self):
+        self._events('20090308100000', '20090308100010')
+        index = self.out._indexes[self.path]
+        self.assertEquals(os.path.getsize(self.path), index.size)
+        self.assertEquals(20 * 60, len(index.entries))
+        entries = list(index.entries)
+        # reloaded from the sidecar by a new provider
+        other = FileIRCLogProvider(EnvironmentStub())
+        other.config.set('irclogs', 'cache_dir', 
+                os.path.join(self.basepath, 'cache'))
+        format = self.out._compiled_format(self.chmgr.channel(None))
+        self.assertEquals(entries, 
+                other._offset_index(self.path, format).entries)
+        # appended lines are indexed incrementally
+        os.utime(self.path, (0, 0))
+        self._write_day(datetime(2009, 3, 8), 'a', 
+                self._lines(datetime(2009, 3, 8, 21), 10, 60))
+        self.assertEquals(1, len(self._events('20090308210500', 
+            '20090308210600')))
+        index = self.out._indexes[self.path]
+        self.assertEquals(entries, index.entries[:len(entries)])
+        self.assertEquals(len(entries) + 10, len(index.entries))
+        # rewritten files are reindexed
+        self._write_day(datetime(2009, 3, 8), 'w', 
+                self._lines(datetime(2009, 3, 8), 10, 60))
+        self.assertEquals(1, len(self._events('20090308000500', 
+            '20090308000600')))
+        self.assertEquals(10, len(self.out._indexes[self.path].entries))
+
+    def test_day_cache(self):
+        ranges = (('20090308100000', '20090308100010', 'UTC'),
+                  ('20090308000000', '20090309000000', 'UTC'),
+                  ('20090308000000', '20090309000000', 'America/New_York'))
+        expected = [self._events(*r) for r in ranges]
+        cache = self.out._day_cache
+        self.assertEquals(0, cache.hits + cache.misses)
+        old = time.time() - 7200
+        os.utime(self.path, (old, old))
+        for i in range(2):
+            for r, e in zip(ranges, expected):
+                actual = self._events(*r)
+                self.assertEquals(e, actual)
+                self.assertEquals([l.get('timestamp') and \
+                        l['timestamp'].tzinfo for l in e], 
+                    [l.get('timestamp') and \
+                        l['timestamp'].tzinfo for l in actual])
+        self.assertEquals(1, cache.misses)
+        self.assertEquals(5, cache.hits)
+        # changed files are parsed again
+        self._write_day(datetime(2009, 3, 8), 'a', 
+                self._lines(datetime(2009, 3, 8, 21), 10, 60))
+        os.utime(self.path, (old, old))
+        self.assertEquals(1, len(self._events('20090308210500', 
+            '20090308210600')))
+        self.assertEquals(2, cache.misses)
+        # least recently used days are evicted past day_cache_size
+        cache.max_size = cache._size * 3 / 2
+        other = self._write_day(datetime(2009, 3, 7))
+        os.utime(other, (old, old))
+        self._events('20090307100000', '20090307100010')
+        self.assert_(cache.evictions > 0)
+        self.assert_(cache._size <= cache.max_size)
+        self.assertEquals(1, len(os.listdir(cache.path)))
+
+    def _tomorrow(self):
+        """The end of an open ended read, after the last write to any log
+        file of the test."""
+        return (datetime.utcnow() + timedelta(days=1)).strftime(
+                '%Y%m%d%H%M%S')
+
+    def test_tail_cursor(self):
+        self.env.config.set('irclogs', 'tail_cursors', '1')
+        day = ('20090308000000', self._tomorrow())
+        self.assertEquals(2424, len(self._events(*day)))
+        cursor = self.out._cursors[self.path]
+        self.assertEquals(os.path.getsize(self.path), cursor.offset)
+        # only appended lines are parsed, partial lines wait
+        f = open(self.path, 'a')
+        f.write('2009-03-08T21:00:00  <nick> appended\n')
+        f.write('2009-03-08T21:00:01  <nick> partial')
+        f.close()
+        parsed = []
+        def _parse_lines(lines, channel=None, target_tz=None, filter=None):
+            lines = list(lines)
+            parsed.extend(lines)
+            return FileIRCLogProvider.parse_lines(self.out, lines, 
+                    channel=channel, target_tz=target_tz, filter=filter)
+        self.out.parse_lines = _parse_lines
+        events = self._events(*day)
+        self.assertEquals(['2009-03-08T21:00:00  <nick> appended'], parsed)
+        self.assertEquals(2425, len(events))
+        self.assertEquals('appended', events[-1]['comment'])
+        self.assertEquals(timezone('UTC'), events[-1]['timestamp'].tzinfo)
+        f = open(self.path, 'a')
+        f.write('\n')
+        f.close()
+        self.assertEquals(2426, len(self._events(*day)))
+        self.assertEquals(2, len(self._events('20090308205959', 
+            '20090308210002')))
+        # a rotated file is read from the start
+        parsed[:] = []
+        os.rename(self.path, self.path + '.1')
+        self._write_day(datetime(2009, 3, 8), 'w', 
+                self._lines(datetime(2009, 3, 8), 10, 60))
+        self.assertEquals(11, len(self._events(*day)))
+        self.assertEquals(11, len(parsed))
+        # and so is a truncated one
+        self._write_day(datetime(2009, 3, 8), 'w', 
+                self._lines(datetime(2009, 3, 8), 5, 60))
+        self.assertEquals(6, len(self._events(*day)))
+        # only tail_cursors files keep one
+        other = self._write_day(datetime(2009, 3, 7))
+        self._events('20090307000000', self._tomorrow())
+        self.assertEquals(1, len(self.out._cursors))
+
+    def test_tail_cursor_defaults(self):
+        self.env.config.remove('irclogs', 'tail_cursors')
+        channel = self.chmgr.channel(None)
+        # bounded reads, like quotes, seek with the offset index
+        self.assertEquals(3, len(self._events('20090308100000', 
+            '20090308100100')))
+        self.assert_(self.path in self.out._indexes)
+        self.assertEquals({}, self.out._cursors)
+        last = self._events('20090308190000', '20090309000000')[-3:]
+        self.assertEquals({}, self.out._cursors)
+        # open ended ones, like the feed, take the tail cursor
+        end = UTC.localize(datetime.utcnow() + timedelta(days=1))
+        self.assertEquals(last, self.out.get_last_events(channel, end, 3))
+        self.assertEquals([self.path], self.out._cursors.keys())
+        offset = self.out._cursors[self.path].offset
+        self.assertEquals(2424, len(self._events('20090308000000',
+            self._tomorrow())))
+        self.assertEquals(offset, self.out._cursors[self.path].offset)
+
+    def test_mmap_reader(self):
+        self.env.config.set('irclogs', 'charset', 'utf-8')
+        self._write_day(datetime(2009, 3, 8), 'a', [
+            '2009-03-08T23:59:58  <nick\xc3\xa9> caf\xc3\xa9\r\n',
+            '2009-03-08T23:59:59  * nick waves\n',
+            '\n',
+            'trailing junk'])
+        ranges = (('20090308000000', '20090309000000', 'UTC'),
+                  ('20090308000000', '20090309000000', 'America/New_York'),
+                  ('20090308100000', '20090308100010', 'UTC'),
+                  ('20090308235900', '20090309000000', 'UTC'))
+        for offset_interval in ('0', '60'):
+            self.env.config.set('irclogs', 'offset_interval', offset_interval)
+            for r in ranges:
+                self.env.config.set('irclogs', 'mmap_reader', 'false')
+                expected = self._events(*r)
+                self.env.config.set('irclogs', 'mmap_reader', 'true')
+                actual = self._events(*r)
+                self.assertEquals([l for l in expected if l.get('timestamp')],
+                        [l for l in actual if l.get('timestamp')])
+        events = self._events('20090308235900', '20090309000000')
+        self.assertEquals(u'nick\xe9', events[-3]['nick'])
+        self.assertEquals(u'caf\xe9', events[-3]['comment'])
+        self.assertEquals('action', events[-2]['type'])
+        self.assertEquals(u'trailing junk', events[-1]['message'])
+        self.assertEquals(unicode, type(events[-1]['message']))
+        # whole day, untimestamped lines included
+        day = self._events('20090308000000', '20090309000000')
+        self.env.config.set('irclogs', 'mmap_reader', 'false')
+        self.assertEquals(self._events('20090308000000', '20090309000000'),
+                day)
+        # charsets that aren't ASCII compatible are read line by line
+        channel = self.chmgr.channel(None)
+        self.assert_(self.out._compiled_format(channel).byte_format())
+        self.env.config.set('irclogs', 'charset', 'utf-16')
+        # channels keep the settings they were got with
+        channel = self.chmgr.channel(None)
+        self.assertEquals(None, 
+                self.out._compiled_format(channel).byte_format())
+
+    def test_compressed_logs(self):
+        day = ('20090308000000', '20090309000000')
+        expected = self._events(*day)
+        minute = ('20090308100000', '20090308100100')
+        expected_minute = [l for l in self._events(*minute)
+                if l.get('timestamp')]
+        data = open(self.path).read()
+        for suffix, opener in (('.gz', gzip.GzipFile), ('.bz2', bz2.BZ2File)):
+            f = opener(self.path + suffix, 'wb')
+            f.write(data)
+            f.close()
+            os.remove(self.path)
+            self.assertEquals(expected, self._events(*day))
+            self.assertEquals(expected_minute, [l for l 
+                in self._events(*minute) if l.get('timestamp')])
+            open(self.path, 'w').write(data)
+            os.remove(self.path + suffix)
+
+    def test_compress_logs(self):
+        ranges = (('20090308000000', '20090309000000'),
+                  ('20090308100000', '20090308100100'),
+                  ('20090308235900', '20090309000000'))
+        expected = [self._events(*r) for r in ranges]
+        data = open(self.path).read()
+        other = self._write_day(datetime(2009, 3, 7))
+        channel = self.chmgr.channel(None)
+        self.assertEquals([(date(2009, 3, 7), other), 
+                           (date(2009, 3, 8), self.path)],
+                sorted(self.out._log_paths(channel)))
+        written = self.out.compress_logs(channel, date(2009, 3, 8))
+        self.assertEquals([other + '.gz'], written)
+        self.failIf(os.path.exists(other))
+        written = self.out.compress_logs(channel, date(2009, 3, 9))
+        self.assertEquals([self.path + '.gz'], written)
+        self.assertEquals([], self.out.compress_logs(channel, 
+                                                     date(2009, 3, 9)))
+        # readable by anything that reads gzip
+        self.assertEquals(data, gzip.open(self.path + '.gz').read())
+        # one member per chunk_interval, each of them indexed
+        index = self.out._indexes[self.path + '.gz']
+        self.assertEquals(20 * 4, len(index.entries))
+        for r, e in zip(ranges, expected):
+            actual = self._events(*r)
+            self.assertEquals([l for l in e if l.get('timestamp')],
+                    [l for l in actual if l.get('timestamp')])
+        start = timezone('UTC').localize(datetime(2009, 3, 8, 10))
+        self.assert_(index.seek(start) > 0)
+        # rebuilt from the archive when the sidecar is lost
+        entries = index.entries
+        shutil.rmtree(os.path.join(self.basepath, 'cache'))
+        self.out._indexes.clear()
+        self._events(*ranges[1])
+        self.assertEquals(entries, self.out._indexes[self.path + '.gz'].entries)
+
+    def test_parallel_range(self):
+        for day in (datetime(2009, 3, 6), datetime(2009, 3, 7), 
+                    datetime(2009, 3, 10)):
+            self._write_day(day)
+        gzip.GzipFile(self.path + '.gz', 'wb').write(open(self.path).read())
+        os.remove(self.path)
+        self.env.config.set('irclogs', 'parse_workers', '2')
+        channel = self.chmgr.channel(None)
+        for tz in ('UTC', 'America/New_York'):
+            tz = timezone(tz)
+            start = tz.localize(datetime(2009, 3, 6, 12))
+            end = tz.localize(datetime(2009, 3, 10, 12))
+            expected = [l for l in self.out.get_events_in_range(channel, 
+                start, end) if l.get('timestamp')]
+            actual = list(self.out.get_events_in_range_parallel(channel, 
+                start, end))
+            self.assertEquals(expected, [l for l in actual 
+                if l.get('timestamp')])
+            self.assertEquals([l['timestamp'].tzinfo for l in expected],
+                    [l['timestamp'].tzinfo for l in actual
+                        if l.get('timestamp')])
+        # abandoning the iteration part way shuts the pool down
+        events = self.out.get_events_in_range_parallel(channel, start, end)
+        events.next()
+        del events
+
+    def test_last_events(self):
+        self._write_day(datetime(2009, 3, 6))
+        self._write_day(datetime(2009, 3, 9), 
+                lines=self._lines(datetime(2009, 3, 9), 10))
+        channel = self.chmgr.channel(None)
+        for tz in ('UTC', 'America/New_York'):
+            tz = timezone(tz)
+            start = tz.localize(datetime(2009, 3, 1))
+            for end in (tz.localize(datetime(2009, 3, 8, 12, 0, 10)),
+                        tz.localize(datetime(2009, 3, 10))):
+                expected = list(self.out.get_events_in_range(channel, 
+                    start, end))
+                for count in (1, 5, 150, 2500, 10000):
+                    actual = self.out.get_last_events(channel, end, count)
+                    self.assertEquals(expected[-count:], actual)
+                    self.assertEquals(expected[-1]['timestamp'].tzinfo,
+                                      actual[-1]['timestamp'].tzinfo)
+        end = UTC.localize(datetime(2009, 3, 6))
+        self.assertEquals([], self.out.get_last_events(channel, end, 10))
+
+    def test_pages(self):
+        # a burst of lines in the same second
+        self._write_day(datetime(2009, 3, 9), 
+                lines=self._lines(datetime(2009, 3, 9), 250, 0))
+        channel = self.chmgr.channel(None)
+        for tz in ('UTC', 'America/New_York'):
+            tz = timezone(tz)
+            start = tz.localize(datetime(2009, 3, 8, 6))
+            end = tz.localize(datetime(2009, 3, 10))
+            expected = list(self.out.get_events_in_range(channel, start, end))
+            for size in (7, 100):
+                events = []
+                after = None
+                while True:
+                    page = list(self.out.get_events_in_range(channel, 
+                        start, end, limit=size, after=after))
+                    if not page:
+                        break
+                    self.assert_(len(page) <= size)
+                    events.extend(page)
+                    after = parse_cursor(format_cursor(
+                        event_cursor(page, after)))
+                self.assertEquals(expected, events)
+                self.assertEquals(
+                    [str(e['timestamp'].tzinfo.zone) for e in expected
+                     if e.get('timestamp')],
+                    [str(e['timestamp'].tzinfo.zone) for e in events 
+                     if e.get('timestamp')])
+
+    def test_filtered_range(self):
+        lines = []
+        for line in self._lines(datetime(2009, 3, 9), 600):
+            lines.append(line)
+            if line[0] == '2':
+                lines.append('%s  *** nick%d has joined #test\n'%(line[:19],
+                                                                len(lines) % 3))
+        path = self._write_day(datetime(2009, 3, 9), lines=lines)
+        channel = self.chmgr.channel(None)
+        start = UTC.localize(datetime(2009, 3, 9, 1))
+        end = UTC.localize(datetime(2009, 3, 9, 3))
+        everything = list(self.out.get_events_in_range(channel, start, end))
+        self.assert_('join' in [e['type'] for e in everything])
+        for mmap_reader, old in ((False, False), (True, False), (False, True)):
+            self.env.config.set('irclogs', 'mmap_reader', str(mmap_reader))
+            if old:
+                # served from the day cache
+                os.utime(path, (time.time() - 7200, time.time() - 7200))
+            for only in (EventFilter(types=('comment',)),
+                         EventFilter(types=('join', 'other'), 
+                                     nicks=('nick1',))):
+                self.assertEquals([e for e in everything if only(e)],
+                        list(self.out.get_events_in_range(channel, start, end,
+                                                          filter=only)))
+
+    def test_reverse_blocks(self):
+        f = open(self.path, 'rb')
+        lines = f.read().split('\n')
+        for size in (1, 7, 100, 64 * 1024):
+            blocks = list(reverse_blocks(f, size))
+            self.assertEquals(lines, reduce(lambda x, y: y + x, blocks))
+        f.close()
+
+    def test_catalog(self):
+        channel = self.chmgr.channel(None)
+        catalog = self.out._catalog(channel)
+        self.assertEquals({date(2009, 3, 8): [self.path]}, catalog.days)
+        self.assert_(catalog.has_day(date(2009, 3, 8)))
+        self.failIf(catalog.has_day(date(2009, 3, 7)))
+        self.assertEquals([8], self.out.get_log_days(channel, 2009, 3))
+        self.assertEquals([], self.out.get_log_days(channel, 2009, 4))
+        # unchanged directories aren't scanned again
+        old = time.time() - 60
+        os.utime(os.path.dirname(self.path), (old, old))
+        catalog.refresh()
+        scans = catalog.scans
+        self.assertEquals([8], self.out.get_log_days(channel, 2009, 3))
+        self.assertEquals(scans, catalog.scans)
+        # new files and compressed ones are found
+        other = self._write_day(datetime(2009, 4, 1))
+        gzip.GzipFile(other + '.gz', 'wb').write('')
+        self.assertEquals([1], self.out.get_log_days(channel, 2009, 4))
+        self.assertEquals(scans + 1, catalog.scans)
+        self.assertEquals([other], catalog.files(date(2009, 4, 1)))
+        os.remove(other)
+        self.assertEquals([other + '.gz'], 
+                self.out._catalog(channel).files(date(2009, 4, 1)))
+        # files that don't match the date pattern are ignored
+        open(os.path.join(self.basepath, '#test', '#test.notes.log'), 
+                'w').close()
+        self.assertEquals(2, len(self.out._catalog(channel).days))
+
+    def test_catalog_subdirectories(self):
+        self.env.config.set('irclogs', 'paths', 
+                '#test/%Y-%m/#test.%d.log')
+        channel = self.chmgr.channel(None)
+        catalog = self.out._catalog(channel)
+        self.assertEquals({}, catalog.days)
+        month = os.path.join(self.basepath, '#test', '2009-03')
+        os.mkdir(month)
+        self.assertEquals([], self.out.get_log_days(channel, 2009, 3))
+        old = time.time() - 60
+        os.utime(os.path.join(self.basepath, '#test'), (old, old))
+        os.utime(month, (old, old))
+        self.out._catalog(channel)
+        scans = catalog.scans
+        # a file in a directory that was empty at the last scan
+        open(os.path.join(month, '#test.09.log'), 'w').close()
+        self.assertEquals([9], self.out.get_log_days(channel, 2009, 3))
+        self.assertEquals(scans + 1, catalog.scans)
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(FileIRCLogProviderTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(FileIRCLogProviderFilesTestCase, 'test'))
     return suite
 
 if __name__ == '__main__':
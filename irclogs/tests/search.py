@@ -27,7 +27,7 @@ class SearchTestCase(unittest.TestCase):
         self.config.set('irclogs', 'search_db_path', self.indexdir)
         self.config.set('irclogs', 'last_index', None)
         self.chmgr = IRCChannelManager(self.env)
-        def events(start, end):
+        def events(start, end, parallel=False, filter=None):
             self.assertTrue(start < end)
             self.dt = start
             dt = self.dt
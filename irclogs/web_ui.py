@@ -13,7 +13,7 @@ from itertools import imap, ifilter
 
 from trac.core import *
 from trac.perm import IPermissionRequestor
-from trac.config import Option, ListOption
+from trac.config import IntOption, Option, ListOption
 from trac.web.chrome import INavigationContributor, ITemplateProvider, \
                             add_stylesheet, add_script, add_link
 from trac.web.main import IRequestHandler
@@ -48,6 +48,10 @@ class IrcLogsView(Component):
                      [u'comment', u'action'],
                      doc='There are message types to show by default')
 
+    page_size = IntOption('irclogs', 'page_size', 1000,
+                     doc="""Lines of a day shown at once.  More are loaded
+                           when asked for.  0 shows whole days.""")
+
 
     # ITemplateProvider methods
     def get_templates_dirs(self):
@@ -96,29 +100,104 @@ class IrcLogsView(Component):
             l['nickcls'] = 'nick-%d' % (sum(ord(c) for c in l['nick']) % 8)
         return l
 
+    def _hidden_filter(self):
+        """EventFilter dropping the lines of hidden_users, or None.  Other
+        types than show_msg_types are still sent, to be shown on demand."""
+        if self.hidden_users:
+            return EventFilter(nicks=self.hidden_users)
+        return None
+
+    def _page(self, req, context, channel, start, end):
+        """The page of events of the day view to show, and the link to the
+        next one, if there is one, in context['more']."""
+        after = None
+        if req.args.get('after'):
+            try:
+                after = parse_cursor(req.args['after'])
+            except ValueError:
+                raise TracError("Invalid page %s"%(req.args['after']))
+        events = list(channel.events_in_range(start, end, 
+            limit=self.page_size + 1, after=after, 
+            filter=self._hidden_filter()))
+        if len(events) > self.page_size:
+            events = events[:self.page_size]
+            context['more'] = req.href.irclogs(context['channel'], 
+                '%04d'%(context['year']), '%02d'%(context['month']), 
+                '%02d'%(context['day']), 
+                after=format_cursor(event_cursor(events, after)))
+        return events
+
+    def _last_lines(self, channel, end, limit):
+        """The last limit lines of channel before end that aren't hidden.
+        Asks for more events while hidden users leave it short."""
+        count = limit
+        while True:
+            events = channel.last_events(end, count)
+            lines = [l for l in map(self._map_lines, events) 
+                     if not l.get('hidden')]
+            if len(lines) >= limit or len(events) < count:
+                return lines[max(0, len(lines) - limit):]
+            count *= 2
+
+    def _merged_last_lines(self, channels, end, limit):
+        """The last limit lines of several channels before end, merged, 
+        each with the name of its channel as 'source'."""
+        sources = []
+        for channel in channels:
+            lines = self._last_lines(channel, end, limit)
+            for line in lines:
+                line['source'] = channel.name()
+            sources.append(lines)
+        lines = list(merge_iseq(sources, lambda x: x.get('timestamp')))
+        return lines[max(0, len(lines) - limit):]
+
+    def _view_channels(self, ch_mgr, name):
+        """The channels of a view: the one called name, or the ones of a
+        merged view, named like +chanA+chanB."""
+        if not name or not name.startswith('+'):
+            return [ch_mgr.channel(name)]
+        channels = []
+        for chname in name.split('+'):
+            if not chname or chname in [ch.name() for ch in channels]:
+                continue
+            channel = ch_mgr.channel(chname)
+            if channel.name() != chname:
+                raise TracError("No channel named %s"%(chname))
+            channels.append(channel)
+        if not channels:
+            raise TracError("No channels in %s"%(name))
+        return channels
+
     def _render_line(self, line):
         hidden = line['type'] in self.show_msg_types and ' ' or 'hidden'
+        source = ''
+        if line.get('source'):
+            # lines of merged views say which channel they're from
+            source = '<td class="source">%s</td>'%(escape(line['source']))
         line.update({
             'time': line.get('timestamp') and line['timestamp'].time() or '',
             'message': escape(line['message']),
             'comment': escape(line.get('comment')),
             'action': escape(line.get('action')),
             'hidden': hidden,
+            'source_cell': source,
         })
         if line['type'] == 'comment':
             return ('<tr class="%(type)s %(hidden)s"><td class="time">' + \
                    '[<a name="%(time)s" href="#%(time)s">%(time)s</a>]' + \
-                   '</td><td class="left %(nickcls)s">&lt;%(nick)s&gt;' + \
+                   '</td>%(source_cell)s' + \
+                   '<td class="left %(nickcls)s">&lt;%(nick)s&gt;' + \
                    '</td><td class="right">%(comment)s</td></tr>')%line 
         if line['type'] == 'action':
             return ('<tr class="%(type)s %(hidden)s"><td class="time">' + \
                    '[<a name="%(time)s" href="#%(time)s">%(time)s</a>]' + \
-                   '</td><td class="left">*</td><td class="right">' + \
+                   '</td>%(source_cell)s<td class="left">*</td>' + \
+                   '<td class="right">' + \
                    '%(action)s</td></tr>')%line
         else: 
             return ('<tr class="%(type)s %(hidden)s"><td class="time">' + \
                    '[<a name="%(time)s" href="#%(time)s">%(time)s</a>]' + \
-                   '</td><td class="left"></td><td class=' + \
+                   '</td>%(source_cell)s<td class="left"></td><td class=' + \
                    '"right">%(message)s</td></tr>')%line
 
     def process_request(self, req):
@@ -139,7 +218,6 @@ class IrcLogsView(Component):
         _alt_css(req, 'irclogs/css/irclogs-brief.css', 'Brief');
 
         context = {}
-        entries = {}
         today = datetime.now()
         context['channel'] = req.args['channel'] 
         context['calendar'] = req.href.chrome('common', 'ics.png')
@@ -150,23 +228,44 @@ class IrcLogsView(Component):
         context['firstDay'] = 3
         context['firstMonth'] = 8
         context['firstYear'] = 1977
-        context['nojscal'] = generate_nojs_calendar(req, context, entries)
         ch_mgr = IRCChannelManager(self.env)
 
-        # TODO: do this for each channel, instead of hardcode
-        channel = ch_mgr.channel(context['channel'])
-        req.perm.assert_permission(channel.perm())
+        channels = self._view_channels(ch_mgr, context['channel'])
+        channel = channels[0]
+        entries = None
+        for ch in channels:
+            req.perm.assert_permission(ch.perm())
+            provider = ch_mgr.provider(ch.provider())
+            if hasattr(provider, 'get_log_days'):
+                if entries is None:
+                    entries = {}
+                entries.update(dict([(d, True) for d in provider.get_log_days(
+                    ch, context['year'], context['month'])]))
+        context['nojscal'] = generate_nojs_calendar(req, context, entries)
         oneday = timedelta(days=1)
         reqtz = timezone(str(req.tz))
         start = reqtz.localize(datetime(context['year'], context['month'], 
             context['day'], 0, 0, 0))
-        # cheezy hack to give us enough lines as long as the channel is 
-        # somewhat active.  Without this we get a shortage of feed lines
-        # at day break.
         end = start + oneday
         if req.args.get('feed') == 'feed':
-            start = start - oneday
-        lines = channel.events_in_range(start, end)
+            limit = int(req.args.get('feed_count', 10))
+            if len(channels) > 1:
+                context['lines'] = self._merged_last_lines(channels, end, 
+                                                           limit)
+            else:
+                context['lines'] = self._last_lines(channel, end, limit)
+            context['rows'] = imap(self._render_line, context['lines'])
+            return 'irclogs_feed.html', context, None 
+        context['more'] = None
+        if len(channels) > 1:
+            # whole days, the providers are read at the same time
+            lines = ch_mgr.merged_events(channels, start, end, 
+                                         filter=self._hidden_filter())
+        elif self.page_size > 0:
+            lines = self._page(req, context, channel, start, end)
+        else:
+            lines = channel.events_in_range(start, end, 
+                                            filter=self._hidden_filter())
 
         context['viewmode'] = 'day'
         context['current_date'] = '%02d/%02d/%04d'%(context['month'], 
@@ -176,12 +275,5 @@ class IrcLogsView(Component):
             lambda x: not x.get('hidden'), 
             imap(self._map_lines, lines)
         )
-
-        if req.args.get('feed') == 'feed':
-            limit = int(req.args.get('feed_count', 10))
-            context['lines'] = list(context['lines'])[-limit:]
-            context['rows'] = imap(self._render_line, context['lines'])
-            return 'irclogs_feed.html', context, None 
-        else:
-            context['rows'] = imap(self._render_line, context['lines'])
-            return 'irclogs.html', context, None
+        context['rows'] = imap(self._render_line, context['lines'])
+        return 'irclogs.html', context, None
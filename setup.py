@@ -23,6 +23,7 @@ setup(
     },
     entry_points = {
         'trac.plugins': [
+            'irclogs.admin = irclogs.admin',
             'irclogs.api = irclogs.api',
             'irclogs.macros = irclogs.macros',
             'irclogs.nojs = irclogs.nojs',
@@ -32,7 +33,11 @@ setup(
             'irclogs.provider.file = irclogs.provider.file',
             'irclogs.provider.db = irclogs.provider.db',
         ],
-        'console_scripts': ['update-irc-search = irclogs.console:update_irc_search',],
+        'console_scripts': [
+            'update-irc-search = irclogs.console:update_irc_search',
+            'compress-irc-logs = irclogs.console:compress_irc_logs',
+            'import-irc-logs = irclogs.console:import_irc_logs',
+        ],
     },
     install_requires = ['pytz>=2005m'],
     # optional pyndexter